@@ -0,0 +1,107 @@
+import redis.asyncio
+import redis.asyncio.retry
+
+import metrics
+import settings
+
+from redis_client import (get_pool_options, get_zone_keys, parse_state, parse_state_version, queue_command,
+                          wait_for_messages)
+from zones import get_zone
+
+
+class AsyncRedisClient:
+
+    """Asyncio counterpart of RedisClient for the ASGI app, calls are served by a shared connection pool"""
+
+    def __init__(self, url=None, max_connections=None):
+        # Blocking pool makes a request wait for a free connection instead of failing once the pool is exhausted,
+        # a stalled Redis fails requests by the same timeouts and retries as the sync pool does
+        pool = redis.asyncio.BlockingConnectionPool.from_url(
+            url or settings.REDIS_URL,
+            max_connections=max_connections or settings.ASYNC_REDIS_MAX_CONNECTIONS,
+            timeout=settings.ASYNC_REDIS_POOL_TIMEOUT,
+            **get_pool_options(redis.asyncio.retry.Retry)
+        )
+        self._conn = redis.asyncio.Redis(connection_pool=pool)
+
+
+    @metrics.async_redis_call("get_state_version")
+    async def get_state_version(self):
+        """Returns counter of state writes, it's bumped by every one of them"""
+        return parse_state_version(await self._conn.get(settings.STATE_VERSION_KEY))
+
+
+    @metrics.async_redis_call("snapshot")
+    async def snapshots(self, zones, sensors=True, fans=True):
+        """Reads state of all the given zones with a single MGET and returns them as immutable States"""
+        zones_keys = [get_zone_keys(zone, sensors, fans) for zone in zones]
+        values = await self._conn.mget([k for keys in zones_keys for k in keys])
+        states = []
+        for zone, keys in zip(zones, zones_keys):
+            states.append(parse_state(zone, values[:len(keys)], sensors, fans))
+            values = values[len(keys):]
+        return states
+
+
+    async def snapshot(self, zone_id=settings.DEFAULT_ZONE, sensors=True, fans=True):
+        """Reads state of a given zone with a single MGET and returns it as an immutable State"""
+        return (await self.snapshots([get_zone(zone_id)], sensors, fans))[0]
+
+
+    @metrics.async_redis_call("send_command")
+    async def send_command(self, values):
+        """Atomically writes the given values and queues a command for the controller to acknowledge.
+
+        Returns id of the command to wait for.
+        """
+        pipe = self._conn.pipeline()
+        command_id = queue_command(pipe, values)
+        await pipe.execute()
+        return command_id
+
+
+    @metrics.async_redis_call("get_profiles")
+    async def get_profiles(self):
+        """Returns stored JSONs of all the scheduled profiles by name"""
+        return await self._conn.hgetall(settings.PROFILES_KEY)
+
+
+    @metrics.async_redis_call("set_profile")
+    async def set_profile(self, name, raw):
+        await self._conn.hset(settings.PROFILES_KEY, name, raw)
+
+
+    @metrics.async_redis_call("delete_profile")
+    async def delete_profile(self, name):
+        """Deletes a scheduled profile, returns False if there's no such one"""
+        return await self._conn.hdel(settings.PROFILES_KEY, name) > 0
+
+
+    @metrics.async_redis_call("read_stream")
+    async def read_stream(self, k, start_ms, end_ms):
+        """Returns fields of stream entries added within a given time range"""
+        return [fields for _, fields in await self._conn.xrange(k, min=start_ms, max=end_ms)]
+
+
+    @metrics.async_redis_call("wait_for_ack")
+    async def wait_for_ack(self, command_id, timeout):
+        """Waits until the controller acknowledges a given command or timeout expires, the event loop isn't blocked"""
+        return await self._conn.blpop(settings.COMMAND_ACK_KEY.format(command_id), timeout=timeout) is not None
+
+
+    async def subscribe(self):
+        """Returns pub/sub object subscribed to state changes"""
+        pubsub = self._conn.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(settings.STATE_CHANNEL)
+        return pubsub
+
+
+    async def wait_for_changes(self, pubsub, timeout, keys=None):
+        """Waits until any of the given keys changes or timeout expires, see wait_for_messages"""
+        waits = wait_for_messages(timeout, keys)
+        try:
+            wait = next(waits)
+            while True:
+                wait = waits.send(await pubsub.get_message(timeout=wait))
+        except StopIteration as e:
+            return e.value
@@ -0,0 +1,141 @@
+"""Closed-loop benchmark running simulated sensors -> Redis -> controller -> simulated fans faster than real time.
+
+Needs redis-server binary on PATH, a throwaway instance is started for each run.
+
+    python benchmarks/closed_loop.py --mode pid --hours 6
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+
+from local_redis import LocalRedis
+from zones import get_sensor_keys, get_zone
+
+
+def _read_sensor(sensor):
+    try:
+        return sensor.read()
+    except RuntimeError:
+        return None
+
+
+def _get_settle_time(samples, threshold, band):
+    """Returns time the temperature entered the band around threshold for good, None if it never did"""
+    settled_at = None
+    for ts, t in samples:
+        if abs(t - threshold) > band:
+            settled_at = None
+        elif settled_at is None:
+            settled_at = ts
+    return settled_at
+
+
+def run(mode, hours, threshold, band, dt=1.0, ambient=20.0, heat=20.0):
+    with LocalRedis() as local_redis, tempfile.TemporaryDirectory(prefix="pi_fan_checkpoint_") as checkpoint_dir:
+        # Modules below connect to Redis and pick hardware at import, so settings go first
+        settings.REDIS_URL = local_redis.url
+        settings.HARDWARE_BACKEND = "sim"
+        settings.CHECKPOINT_PATH = os.path.join(checkpoint_dir, "checkpoint.json")
+        settings.SAMPLE_LOG_PATH = os.path.join(checkpoint_dir, "{}_samples.bin")
+
+        import hardware
+        backend = hardware.SimBackend(model=hardware.ThermalModel(ambient=ambient, heat=heat))
+        hardware.set_backend(backend)
+
+        import dht_sensors
+        import pwm_controls
+
+        redis_client = pwm_controls.redis_client
+        initial = {
+            settings.PWM_ENABLED: False,
+            settings.NEW_PWM_ENABLED: True,
+            settings.LIGHTS_ENABLED: False,
+            settings.NEW_LIGHTS_ENABLED: False,
+            settings.CURR_CTRL_MODE: mode,
+            settings.NEW_CTRL_MODE: mode,
+            settings.CURR_PWM_DUTY: 0,
+            settings.NEW_PWM_DUTY: settings.PWM_DEFAULT_DUTY,
+            settings.CURR_TEMP_THRESHOLD: threshold,
+            settings.NEW_TEMP_THRESHOLD: threshold,
+        }
+        for k, v in initial.items():
+            redis_client.set_value(k, v)
+
+        zone = get_zone(settings.DEFAULT_ZONE)
+        sensors = [
+            (backend.temperature_sensor(pin), dht_sensors.SensorPublisher(k, quality_k, read_at_k))
+            for _, k, quality_k, read_at_k, pin in get_sensor_keys(zone)
+        ]
+
+        started = time.time()
+        duration = hours*3600
+        sim = 0.0
+        next_reading = 0.0
+        next_heartbeat = 0.0
+        ticks = 0
+        cpu = 0.0
+        samples = []
+
+        while sim < duration:
+            now = started + sim
+            cpu_started = time.process_time()
+
+            # A new temperature wakes the controller up, otherwise it's the heartbeat
+            woken = False
+            if sim >= next_reading:
+                for sensor, publisher in sensors:
+                    publisher.publish(sensor.pin, _read_sensor(sensor), now, now=now)
+                dht_sensors.state_publisher.flush()
+                next_reading += settings.DHT_POLLING_TIMEOUT_SECONDS
+                woken = True
+            if woken or sim >= next_heartbeat:
+                pwm_controls.run_pwm_controls_tick(now=now)
+                next_heartbeat = sim + settings.PWM_CTRL_HEARTBEAT
+                ticks += 1
+
+            cpu += time.process_time() - cpu_started
+            samples.append((sim, backend.model.step(dt)))
+            sim += dt
+
+        wall = time.time() - started
+
+    crossed = [t for _, t in samples if t >= threshold]
+    fans = backend.outputs.get(settings.FANS_PIN)
+    return {
+        "mode": mode,
+        "simulated_hours": hours,
+        "wall_seconds": round(wall, 3),
+        "speedup": round(duration/wall, 1) if wall else None,
+        "settle_seconds": _get_settle_time(samples, threshold, band),
+        "overshoot": round(max(crossed) - threshold, 3) if crossed else None,
+        "final_temperature": round(samples[-1][1], 3),
+        "duty_changes_per_hour": round((fans.changes if fans else 0)/hours, 2),
+        "controller_ticks": ticks,
+        "loop_cpu_seconds": round(cpu, 4),
+        "loop_cpu_ms_per_tick": round(cpu*1000/ticks, 4) if ticks else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", default=settings.AUTO_MODE, choices=settings.CTRL_MODES[1:])
+    parser.add_argument("--hours", type=float, default=6)
+    parser.add_argument("--threshold", type=float, default=settings.DEFAULT_TEMPERATURE_THRESHOLD)
+    parser.add_argument("--band", type=float, default=0.5, help="Band around threshold temperature settles within")
+    parser.add_argument("--ambient", type=float, default=20.0)
+    parser.add_argument("--heat", type=float, default=20.0, help="Heat load of the cabinet, W")
+    args = parser.parse_args()
+
+    result = run(args.mode, args.hours, args.threshold, args.band, ambient=args.ambient, heat=args.heat)
+    print(json.dumps(result, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import itertools
+import sys
+import types
+
+
+class FakePwm:
+
+    """RPi.GPIO's software PWM doing nothing but keeping its duty"""
+
+    def __init__(self, pin, frequency):
+        self.pin = pin
+        self.frequency = frequency
+        self.duty = None
+
+
+    def start(self, duty):
+        self.duty = duty
+
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+
+
+    def stop(self):
+        self.duty = None
+
+
+class FakeDht22:
+
+    """adafruit_dht sensor reading temperatures of a fixed sequence"""
+
+    _temperatures = itertools.cycle([24.0, 24.1, 24.3, 24.2, 24.0, 23.9])
+
+    def __init__(self, pin):
+        self.pin = pin
+
+
+    @property
+    def temperature(self):
+        return next(self._temperatures)
+
+
+    def exit(self):
+        pass
+
+
+class FakeUnit:
+
+    """pystemd's unit of an always active service"""
+
+    def __init__(self, name):
+        self.name = name
+        self.Unit = types.SimpleNamespace(ActiveState=b"active")
+
+
+    def load(self):
+        pass
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+def install():
+    """Replaces RPi.GPIO, adafruit_dht and pystemd with fakes, so that the real code paths run off a Pi"""
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.BCM = "BCM"
+    gpio.IN = "IN"
+    gpio.OUT = "OUT"
+    gpio.LOW = 0
+    gpio.HIGH = 1
+    gpio.PUD_UP = "PUD_UP"
+    gpio.FALLING = "FALLING"
+    gpio.setmode = gpio.setwarnings = gpio.setup = gpio.cleanup = gpio.add_event_detect = _noop
+    gpio.PWM = FakePwm
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+
+    adafruit_dht = types.ModuleType("adafruit_dht")
+    adafruit_dht.DHT22 = FakeDht22
+
+    systemd1 = types.ModuleType("pystemd.systemd1")
+    systemd1.Unit = FakeUnit
+    pystemd = types.ModuleType("pystemd")
+    pystemd.systemd1 = systemd1
+
+    sys.modules.update({
+        "RPi": rpi,
+        "RPi.GPIO": gpio,
+        "adafruit_dht": adafruit_dht,
+        "pystemd": pystemd,
+        "pystemd.systemd1": systemd1,
+    })
@@ -0,0 +1,99 @@
+"""Load test comparing throughput and latency of web app deployments, e.g. Flask/uWSGI vs the ASGI app.
+
+Each of the concurrent clients keeps its own connection and fires requests back to back for a given time.
+Mind that POST endpoints send commands to the controller, so run it against a test setup.
+
+    python benchmarks/load_test.py --url flask=http://raspberrypi.local:8080 --url asgi=http://raspberrypi.local:8000 \\
+        --clients 32 --seconds 30
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+
+DEFAULT_ENDPOINTS = (
+    "GET /stats",
+    "GET /get-average-temperature",
+    "POST /pwm/set-temp-threshold/30",
+)
+
+
+def _percentile(latencies, p):
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(len(latencies)*p/100))]
+
+
+def _run_client(url, endpoints, deadline, results):
+    parsed = urllib.parse.urlsplit(url)
+    conn_cls = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    conn = conn_cls(parsed.netloc, timeout=30)
+    latencies = []
+    errors = 0
+    i = 0
+    while time.monotonic() < deadline:
+        method, path = endpoints[i % len(endpoints)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            conn.request(method, parsed.path.rstrip("/") + path)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            continue
+        latencies.append(time.perf_counter() - started)
+    conn.close()
+    results.append((latencies, errors))
+
+
+def run(url, endpoints, clients, seconds):
+    results = []
+    deadline = time.monotonic() + seconds
+    threads = [
+        threading.Thread(target=_run_client, args=(url, endpoints, deadline, results), daemon=True)
+        for _ in range(clients)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.monotonic() - started
+
+    latencies = sorted(l for client_latencies, _ in results for l in client_latencies)
+    return {
+        "url": url,
+        "clients": clients,
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors in results),
+        "requests_per_second": round(len(latencies)/wall, 1),
+        "p50_ms": round(_percentile(latencies, 50)*1000, 2) if latencies else None,
+        "p99_ms": round(_percentile(latencies, 99)*1000, 2) if latencies else None,
+        "max_ms": round(latencies[-1]*1000, 2) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", action="append", required=True, help="name=base URL of a deployment, repeatable")
+    parser.add_argument("--endpoint", action="append", help="\"METHOD /path\" to request, repeatable")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=30)
+    args = parser.parse_args()
+
+    endpoints = [tuple(e.split(" ", 1)) for e in args.endpoint or DEFAULT_ENDPOINTS]
+    report = {}
+    for deployment in args.url:
+        name, _, url = deployment.rpartition("=")
+        report[name or url] = run(url, endpoints, args.clients, args.seconds)
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
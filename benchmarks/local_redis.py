@@ -0,0 +1,54 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+class LocalRedis:
+
+    """Throwaway redis-server listening on a unix socket in a temporary directory, nothing is persisted"""
+
+    def __init__(self, redis_server="redis-server"):
+        self._redis_server = shutil.which(redis_server) or redis_server
+        self._dir = None
+        self._process = None
+
+
+    @property
+    def url(self):
+        return "unix://{}?db=0".format(os.path.join(self._dir, "redis.sock"))
+
+
+    def start(self, timeout=5):
+        self._dir = tempfile.mkdtemp(prefix="pi_fan_redis_")
+        socket_path = os.path.join(self._dir, "redis.sock")
+        self._process = subprocess.Popen(
+            [self._redis_server, "--port", "0", "--unixsocket", socket_path, "--save", "", "--appendonly", "no",
+             "--dir", self._dir],
+            stdout=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(socket_path):
+            if self._process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("Unable to start {}".format(self._redis_server))
+            time.sleep(0.01)
+        return self
+
+
+    def stop(self):
+        if self._process:
+            self._process.terminate()
+            self._process.wait()
+            self._process = None
+        if self._dir:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,280 @@
+"""Benchmark suite of the state client, controller ticks, commands and the web app runnable on any Linux box.
+
+RPi.GPIO, adafruit_dht and pystemd are faked, Redis backend needs redis-server binary on PATH, a throwaway instance
+is started for the run. Results are saved as JSON and compared against a baseline saved by a previous run, the suite
+fails once latency or throughput of anything regresses by more than the threshold.
+
+    python benchmarks/suite.py --output baseline.json
+    python benchmarks/suite.py --baseline baseline.json --threshold 15 --groups control http
+"""
+import argparse
+import atexit
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+import fakes
+
+from local_redis import LocalRedis
+from temperature_filter import QUALITY_OK
+from zones import get_sensor_keys, get_zone, zone_key
+
+GROUPS = ("state", "control", "command", "http")
+
+# Calls made before measuring, e.g. to fill connection pools and caches
+WARMUP_CALLS = 20
+
+
+def _percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies)*p/100))]
+
+
+def measure(fn, seconds, setup=None, ok=None):
+    """Calls fn(i) back to back for given seconds, setup(i) goes ahead of each call and isn't measured.
+
+    Calls whose results ok tells apart as failed are counted as errors.
+    """
+    for i in range(WARMUP_CALLS):
+        if setup:
+            setup(i)
+        fn(i)
+
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + seconds
+    i = 0
+    while time.monotonic() < deadline:
+        if setup:
+            setup(i)
+        started = time.perf_counter()
+        result = fn(i)
+        latencies.append(time.perf_counter() - started)
+        if ok and not ok(result):
+            errors += 1
+        i += 1
+
+    latencies.sort()
+    return {
+        "calls": len(latencies),
+        "errors": errors,
+        "ops_per_second": round(len(latencies)/sum(latencies), 1),
+        "p50_us": round(_percentile(latencies, 50)*1e6, 1),
+        "p99_us": round(_percentile(latencies, 99)*1e6, 1),
+        "max_us": round(latencies[-1]*1e6, 1),
+    }
+
+
+def _key(name, zone_id=settings.DEFAULT_ZONE):
+    return zone_key(zone_id, getattr(settings, name))
+
+
+def bench_state(seconds):
+    """State client calls the services make the most"""
+    from redis_client import get_client
+    client = get_client()
+    values = {_key("CURR_PWM_DUTY"): 40, _key("CURR_CTRL_MODE"): settings.AUTO_MODE, _key("PWM_ENABLED"): True}
+    return {
+        "state.property_read": measure(lambda i: client.pwm_enabled, seconds),
+        "state.property_write": measure(lambda i: client.set_value(_key("NEW_PWM_DUTY"), i % 100), seconds),
+        "state.snapshot": measure(lambda i: client.snapshot(), seconds),
+        "state.set_values": measure(lambda i: client.set_values(values), seconds),
+        "state.get_state_version": measure(lambda i: client.get_state_version(), seconds),
+    }
+
+
+def _get_temperatures(i):
+    values = {}
+    for _, k, quality_k, read_at_k, _ in get_sensor_keys(get_zone(settings.DEFAULT_ZONE)):
+        values[k] = 25 + i % 10/10
+        values[quality_k] = QUALITY_OK
+        values[read_at_k] = time.time()
+    return values
+
+
+def _get_branches():
+    """Returns values put ahead of an unmeasured tick if the branch needs it along with values of each measured tick"""
+    enabled = {_key("NEW_PWM_ENABLED"): True}
+    return {
+        "idle": (None, lambda i: {_key("NEW_PWM_ENABLED"): False}),
+        "enable": (
+            {_key("NEW_PWM_ENABLED"): False},
+            lambda i: dict(enabled, **{_key("NEW_CTRL_MODE"): settings.MANUAL_MODE}),
+        ),
+        "disable": (enabled, lambda i: {_key("NEW_PWM_ENABLED"): False}),
+        "manual_duty": (None, lambda i: dict(enabled, **{
+            _key("NEW_CTRL_MODE"): settings.MANUAL_MODE,
+            _key("NEW_PWM_DUTY"): 40 + 20*(i % 2),
+        })),
+        "auto": (None, lambda i: dict(enabled, **_get_temperatures(i), **{_key("NEW_CTRL_MODE"): settings.AUTO_MODE})),
+        "pid": (None, lambda i: dict(enabled, **_get_temperatures(i), **{_key("NEW_CTRL_MODE"): settings.PID_MODE})),
+        "lights": (None, lambda i: {_key("NEW_LIGHTS_ENABLED"): i % 2 == 0}),
+        "threshold": (None, lambda i: {_key("NEW_TEMP_THRESHOLD"): 25 + i % 2}),
+    }
+
+
+def bench_control(seconds):
+    """Single controller tick under each branch of applying changes"""
+    import pwm_controls
+    pwm_controls.restore_state()
+    client = pwm_controls.redis_client
+    # Controller's clock goes by heartbeats, so every tick records history as a real one does
+    now = [time.time()]
+
+    def tick(i):
+        now[0] += settings.PWM_CTRL_HEARTBEAT
+        pwm_controls.run_pwm_controls_tick(now=now[0])
+
+    results = {}
+    for name, (prepare, get_values) in _get_branches().items():
+        def setup(i):
+            if prepare:
+                client.set_values(prepare)
+                tick(i)
+            client.set_values(get_values(i))
+        results["control.tick_{}".format(name)] = measure(tick, seconds, setup=setup)
+    return results
+
+
+_controller_started = False
+
+
+def _start_controller():
+    """Runs the controller loop in the background, so that commands get acknowledged"""
+    global _controller_started
+    if _controller_started:
+        return
+    import pwm_controls
+    pwm_controls.restore_state()
+    threading.Thread(target=pwm_controls.run_pwm_controls, name="pwm_controls", daemon=True).start()
+    _controller_started = True
+
+
+def bench_command(seconds):
+    """Round trip of a command from the web app to the controller and back"""
+    import pi_fan_app
+    _start_controller()
+    pi_fan_app._send_and_wait({_key("NEW_PWM_ENABLED"): True, _key("NEW_CTRL_MODE"): settings.MANUAL_MODE})
+    return {
+        "command.send_and_wait": measure(
+            lambda i: pi_fan_app._send_and_wait({_key("NEW_PWM_DUTY"): 40 + 20*(i % 2)}), seconds, ok=bool),
+    }
+
+
+def bench_http(seconds):
+    """Requests served by the WSGI app, POST ones wait for the controller"""
+    from pi_fan_app import app
+    _start_controller()
+    client = app.test_client()
+
+    def request(method, *paths):
+        return lambda i: client.open(paths[i % len(paths)], method=method)
+
+    def ok(response):
+        return response.status_code < 500
+
+    client.post("/pwm/enable/manual")
+    return {
+        "http.get_stats": measure(request("GET", "/stats"), seconds, ok=ok),
+        "http.get_stats_sensors": measure(request("GET", "/stats?fields=sensors"), seconds, ok=ok),
+        "http.get_index": measure(request("GET", "/"), seconds, ok=ok),
+        "http.post_pwm_set_duty": measure(request("POST", "/pwm/set-duty/40", "/pwm/set-duty/60"), seconds, ok=ok),
+        "http.post_pwm_enable_disable": measure(
+            request("POST", "/pwm/enable/manual", "/pwm/disable"), seconds, ok=ok),
+    }
+
+
+BENCHMARKS = {
+    "state": bench_state,
+    "control": bench_control,
+    "command": bench_command,
+    "http": bench_http,
+}
+
+
+def compare(results, baseline, threshold):
+    """Returns descriptions of results regressed against the baseline ones by more than threshold percent"""
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric in ("p50_us", "p99_us"):
+            if result[metric] > base[metric]*(1 + threshold/100):
+                regressions.append("{} {}: {} -> {}".format(name, metric, base[metric], result[metric]))
+        if result["ops_per_second"] < base["ops_per_second"]*(1 - threshold/100):
+            regressions.append("{} ops_per_second: {} -> {}".format(
+                name, base["ops_per_second"], result["ops_per_second"]))
+    return regressions
+
+
+def run(groups, seconds, backend):
+    tmp_dir = tempfile.mkdtemp(prefix="pi_fan_bench_")
+    # Registered ahead of the services' handlers, so it runs after they've stopped fans and closed logs
+    atexit.register(shutil.rmtree, tmp_dir, ignore_errors=True)
+
+    with contextlib.ExitStack() as stack:
+        # Modules below pick their clients, hardware and files at import, so settings go first
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(tmp_dir, "metrics")
+        if backend == "redis":
+            settings.REDIS_URL = stack.enter_context(LocalRedis()).url
+        settings.STATE_BACKEND = backend
+        settings.STATE_SHM_PATH = os.path.join(tmp_dir, "state")
+        settings.STATE_PROFILES_PATH = os.path.join(tmp_dir, "profiles.json")
+        settings.HARDWARE_BACKEND = "rpi"
+        settings.SYSTEMD_STATUS_BACKEND = "pystemd"
+        settings.CHECKPOINT_PATH = os.path.join(tmp_dir, "checkpoint.json")
+        settings.SAMPLE_LOG_PATH = os.path.join(tmp_dir, "{}_samples.bin")
+        settings.PWM_SYSFS_ROOT = os.path.join(tmp_dir, "pwm")
+        fakes.install()
+
+        import hardware
+        hardware.create_mock_sysfs_pwm(settings.PWM_SYSFS_ROOT, chip=settings.PWM_SYSFS_CHIP)
+
+        results = {}
+        for group in groups:
+            results.update(BENCHMARKS[group](seconds))
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--groups", nargs="+", choices=GROUPS, default=list(GROUPS))
+    parser.add_argument("--seconds", type=float, default=2, help="Time each benchmark runs for")
+    parser.add_argument("--backend", choices=["redis", "shm", "memory"], default="redis", help="State backend")
+    parser.add_argument("--output", help="File to save results to, e.g. to be the next baseline")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=10, help="Regression threshold, percent")
+    args = parser.parse_args()
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "backend": args.backend,
+            "seconds": args.seconds,
+        },
+        "results": run(args.groups, args.seconds, args.backend),
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(report["results"], json.load(f)["results"], args.threshold)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    print(json.dumps(report, indent=4))
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import json
+import os
+import time
+
+import settings
+
+from logger import logger
+
+
+class Checkpoint:
+
+    """Versioned on-disk copy of the controls state, it's only written once the state changes.
+
+    Changes of only the volatile keys, e.g. duty set by automatic engines, are written at most once a
+    CHECKPOINT_VOLATILE_INTERVAL, so the SD card isn't written on every sensors update.
+    """
+
+    def __init__(self, path=None, version=None, volatile_keys=()):
+        self._path = path or settings.CHECKPOINT_PATH
+        self._version = settings.CHECKPOINT_VERSION if version is None else version
+        self._volatile_keys = frozenset(volatile_keys)
+        self._saved = None
+        self._saved_at = 0
+
+
+    def load(self):
+        """Returns values of the checkpoint, empty dict if there's none or it's unusable"""
+        try:
+            with open(self._path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error("Unable to read checkpoint {}: {}".format(self._path, e))
+            return {}
+
+        if not isinstance(checkpoint, dict) or checkpoint.get("version") != self._version:
+            logger.warning("Ignoring checkpoint {} of unknown version".format(self._path))
+            return {}
+        self._saved = checkpoint.get("values", {})
+        return dict(self._saved)
+
+
+    def _is_volatile_change(self, values):
+        if self._saved is None:
+            return False
+        changed = {k for k in set(values) | set(self._saved) if values.get(k) != self._saved.get(k)}
+        return changed <= self._volatile_keys
+
+
+    def save(self, values, now=None):
+        """Atomically replaces the checkpoint with given values unless they are the saved ones"""
+        now = time.time() if now is None else now
+        if values == self._saved:
+            return False
+        if self._is_volatile_change(values) and now - self._saved_at < settings.CHECKPOINT_VOLATILE_INTERVAL:
+            return False
+
+        # Rename is atomic, so the checkpoint is never left half-written on a power loss
+        tmp_path = "{}.tmp".format(self._path)
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"version": self._version, "saved_at": now, "values": values}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logger.error("Unable to write checkpoint {}: {}".format(self._path, e))
+            return False
+        self._saved = dict(values)
+        self._saved_at = now
+        return True
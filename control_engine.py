@@ -0,0 +1,143 @@
+import time
+
+import settings
+
+
+def _clamp(v, low, high):
+    return max(low, min(high, v))
+
+
+def _interpolate(points, x):
+    """Piecewise-linear interpolation over (x, y) points sorted by x"""
+    if x <= points[0][0]:
+        return points[0][1]
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        if x <= x1:
+            return y0 + (y1 - y0)*(x - x0)/(x1 - x0)
+    return points[-1][1]
+
+
+class CurveEngine:
+
+    """Fan curve of (degrees above threshold, duty) points with a hysteresis on the way down"""
+
+    def __init__(self, points=None, hysteresis=None):
+        self._points = sorted(points or settings.FAN_CURVE)
+        self._hysteresis = settings.CONTROL_HYSTERESIS if hysteresis is None else hysteresis
+        self._duty = None
+
+
+    def _get_duty(self, delta):
+        return int(round(_interpolate(self._points, delta)))
+
+
+    def reset(self):
+        self._duty = None
+
+
+    def resume(self, duty):
+        """Continues from a given duty, e.g. the one applied before a restart"""
+        self._duty = duty
+
+
+    def update(self, temperature, threshold, now=None):
+        """Returns duty for a given temperature, the duty only goes down once temperature drops by the hysteresis"""
+        delta = temperature - threshold
+        duty_up = self._get_duty(delta)
+        duty_down = self._get_duty(delta + self._hysteresis)
+        if self._duty is None or duty_up > self._duty:
+            self._duty = duty_up
+        elif duty_down < self._duty:
+            self._duty = duty_down
+        return self._duty
+
+
+class StepEngine(CurveEngine):
+
+    """Former auto mode: 0, default duty, +5 and 100 at threshold, +1 and +2 degrees, with a hysteresis"""
+
+    def __init__(self, hysteresis=None):
+        super().__init__(points=[(0, 0)], hysteresis=hysteresis)
+
+
+    def _get_duty(self, delta):
+        if delta > 2:
+            return 100
+        elif delta > 1:
+            return settings.PWM_DEFAULT_DUTY + 5
+        elif delta > 0:
+            return settings.PWM_DEFAULT_DUTY
+        return 0
+
+
+class PidEngine:
+
+    """PID controller holding temperature at the threshold, integral is frozen while the output saturates"""
+
+    def __init__(self, kp=None, ki=None, kd=None, min_duty=None, max_duty=None, min_step=None):
+        self._kp = settings.PID_KP if kp is None else kp
+        self._ki = settings.PID_KI if ki is None else ki
+        self._kd = settings.PID_KD if kd is None else kd
+        self._min_duty = settings.PID_MIN_DUTY if min_duty is None else min_duty
+        self._max_duty = settings.PID_MAX_DUTY if max_duty is None else max_duty
+        self._min_step = settings.PID_MIN_DUTY_STEP if min_step is None else min_step
+        self.reset()
+
+
+    def reset(self):
+        self._integral = 0.0
+        self._last_error = None
+        self._last_update = None
+        self._duty = None
+        self._resume_duty = None
+
+
+    def resume(self, duty):
+        """Continues from a given duty, integral is preset by the first update so that the output doesn't jump"""
+        self.reset()
+        self._resume_duty = duty
+
+
+    def update(self, temperature, threshold, now=None):
+        """Returns duty for a given temperature, changes smaller than PID_MIN_DUTY_STEP are ignored"""
+        now = time.monotonic() if now is None else now
+        error = temperature - threshold
+        dt = now - self._last_update if self._last_update is not None else 0
+        derivative = (error - self._last_error)/dt if dt > 0 else 0.0
+
+        if self._resume_duty is not None:
+            if self._ki:
+                self._integral = (self._resume_duty - self._kp*error)/self._ki
+            self._duty = self._resume_duty
+            self._resume_duty = None
+
+        integral = self._integral + error*dt
+        output = self._kp*error + self._ki*integral + self._kd*derivative
+        duty = _clamp(output, self._min_duty, self._max_duty)
+
+        # Anti-windup: keep integrating only while the output isn't pushed further into saturation
+        if duty == output or (output > self._max_duty and error < 0) or (output < self._min_duty and error > 0):
+            self._integral = integral
+
+        self._last_error = error
+        self._last_update = now
+
+        duty = int(round(duty))
+        if self._duty is None or abs(duty - self._duty) >= self._min_step or duty in (self._min_duty, self._max_duty):
+            self._duty = duty
+        return self._duty
+
+
+# Engines of automatic control modes
+ENGINES = {
+    settings.AUTO_MODE: StepEngine,
+    settings.PID_MODE: PidEngine,
+    settings.CURVE_MODE: CurveEngine,
+}
+
+
+def get_engine(mode):
+    """Returns control engine of a given mode, None for manual control"""
+    engine_cls = ENGINES.get(mode)
+    if engine_cls:
+        return engine_cls()
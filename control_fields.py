@@ -0,0 +1,49 @@
+import math
+
+import settings
+
+from zones import zone_key
+
+
+def is_valid_threshold(v):
+    """Threshold has to be a finite number within the range DHT22 sensors measure"""
+    return (isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v)
+            and settings.MIN_TEMPERATURE_THRESHOLD <= v <= settings.MAX_TEMPERATURE_THRESHOLD)
+
+
+# Fields of a desired controls document along with the checks of their values
+CONTROL_FIELDS = {
+    "pwm_enabled": lambda v: isinstance(v, bool),
+    "mode": lambda v: v in settings.CTRL_MODES,
+    "threshold": is_valid_threshold,
+    "duty": lambda v: isinstance(v, int) and not isinstance(v, bool) and 0 <= v <= 100,
+    "lights_enabled": lambda v: isinstance(v, bool),
+}
+
+# Keys the controller takes each field's value from
+CONTROL_KEYS = {
+    "pwm_enabled": settings.NEW_PWM_ENABLED,
+    "mode": settings.NEW_CTRL_MODE,
+    "threshold": settings.NEW_TEMP_THRESHOLD,
+    "duty": settings.NEW_PWM_DUTY,
+    "lights_enabled": settings.NEW_LIGHTS_ENABLED,
+}
+
+
+def validate_control_fields(fields):
+    """Raises ValueError describing the first bad one of the given fields"""
+    if not isinstance(fields, dict):
+        raise ValueError("fields must be an object")
+    for name, v in fields.items():
+        if name not in CONTROL_FIELDS:
+            raise ValueError("unknown field {}".format(name))
+        if not CONTROL_FIELDS[name](v):
+            raise ValueError("bad value of {}".format(name))
+
+
+def get_control_values(zone_id, fields):
+    """Returns zone's Redis values of the given fields"""
+    values = {}
+    for name, v in fields.items():
+        values[zone_key(zone_id, CONTROL_KEYS[name])] = float(v) if name == "threshold" else v
+    return values
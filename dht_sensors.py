@@ -1,54 +1,164 @@
 import time
 import sys
-import adafruit_dht
+import threading
 
+import metrics
 import settings
 
-from redis_client import RedisClient
+from redis import RedisError
+
+from hardware import get_backend
+from redis_client import get_client
+from sample_log import STATUS_ERROR, STATUS_FAILED, STATUS_OK, get_sample_log
+from state_publisher import StatePublisher
+from temperature_filter import TemperatureFilter
+from zones import get_sensor_keys, get_zones
 from logger import logger
 
-# Redis client wrapper
-redis_client = RedisClient()
+# Redis client wrapper or its shared memory counterpart, see STATE_BACKEND
+redis_client = get_client()
+
+# Readings of all the sensors are published at once
+state_publisher = StatePublisher(redis_client)
+
+# Every read attempt of all the sensors
+sample_log = get_sample_log("dht_sensors")
+
+# Readers of all the sensors along with their publishers, they outlive restarts of the loop by the supervisor
+sensors = []
+
+# Monotonic time the loop has last started an iteration at, the supervisor tells a hung loop by it
+heartbeat = None
+
+
+class SensorReader(threading.Thread):
+
+    """Reads a single DHT22 sensor on its own thread keeping the device open between reads"""
+
+    def __init__(self, pin, interval=settings.DHT_POLLING_TIMEOUT_SECONDS):
+        super().__init__(name="dht-{}".format(pin), daemon=True)
+        self.pin = pin
+        self._interval = interval
+        self._device = None
+        self._lock = threading.Lock()
+        self._temperature = None
+        self._read_at = None
+
+
+    def _get_device(self):
+        """Returns DHT sensor instance, it's created once and reused"""
+        if self._device is None:
+            self._device = get_backend().temperature_sensor(self.pin)
+        return self._device
+
+
+    def _reset_device(self):
+        if self._device is not None:
+            try:
+                self._device.close()
+            except Exception as e:
+                logger.error(str(e))
+        self._device = None
 
 
-def _get_dht_sensor(pin):
-    """Returns DHT sesnor instance"""
-    d = None
-    try:
-        d = adafruit_dht.DHT22(pin)
-    except RuntimeError as e:
-        d.exit()
-        d = adafruit_dht.DHT22(pin)
-        logger.error(str(e))
-    return d
+    def read(self):
+        """Gets temperature measure retrying failed reads with an exponential backoff"""
+        backoff = settings.DHT_RETRY_BACKOFF_SECONDS
+        for retries in range(settings.DHT_READ_RETRIES):
+            status = STATUS_FAILED
+            try:
+                with metrics.SENSOR_READ_DURATION.labels(self.pin).time():
+                    t = self._get_device().read()
+                if t is not None:
+                    sample_log.append(self.pin, t, STATUS_OK, retries=retries)
+                    return t
+            except RuntimeError as e:
+                # Checksum and timing errors are common for DHT22, just try again
+                logger.debug("DHT{}: {}".format(self.pin, e))
+            except Exception as e:
+                logger.error("DHT{}: {}".format(self.pin, e))
+                self._reset_device()
+                status = STATUS_ERROR
+            sample_log.append(self.pin, None, status, retries=retries)
+            metrics.SENSOR_READ_FAILURES.labels(self.pin).inc()
+            # There's nothing to wait for after the last attempt, the next cycle starts right away
+            if retries == settings.DHT_READ_RETRIES - 1:
+                break
+            time.sleep(backoff)
+            backoff = min(backoff*2, settings.DHT_MAX_BACKOFF_SECONDS)
 
 
-def _get_sensor_temperature(pin):
-    """Gets tempreature mesure of a given sensor"""
-    try:
-        d = _get_dht_sensor(pin)
-        if d:
-            t = d.temperature
-            d.exit()
-            return t
-    except Exception as e:
-        logger.error(str(e))
-        if d:
-            d.exit()
+    def run(self):
+        while True:
+            started = time.monotonic()
+            t = self.read()
+            if t is not None:
+                with self._lock:
+                    self._temperature = t
+                    self._read_at = time.time()
+            time.sleep(max(0, self._interval - (time.monotonic() - started)))
+
+
+    @property
+    def latest(self):
+        """Returns the latest temperature and the time it was read at"""
+        with self._lock:
+            return self._temperature, self._read_at
+
+
+class SensorPublisher:
+
+    """Filters readings of a single sensor and stages its filtered value and quality to state_publisher"""
+
+    def __init__(self, k, quality_k, read_at_k):
+        self._k = k
+        self._quality_k = quality_k
+        self._read_at_k = read_at_k
+        self._filter = TemperatureFilter()
+        self._filtered_at = None
+
+
+    def publish(self, pin, t, read_at, now=None):
+        """Feeds the latest reading to the filter unless it's been seen already and stages changes"""
+        if t is not None and self._filtered_at != read_at:
+            if not self._filter.add(t, ts=read_at):
+                logger.info("DHT{}: rejected outlier {}".format(pin, t))
+            self._filtered_at = read_at
+
+        # Only changes are published, a stale sensor is published once it becomes stale
+        value, quality = self._filter.get(now)
+        if value is not None:
+            state_publisher.set(self._k, value)
+            state_publisher.set(self._read_at_k, round(self._filter.updated_at, 3))
+        state_publisher.set(self._quality_k, quality)
+
+
+def _start_readers():
+    for zone in get_zones():
+        for _, k, quality_k, read_at_k, pin in get_sensor_keys(zone):
+            reader = SensorReader(pin)
+            reader.start()
+            sensors.append((reader, SensorPublisher(k, quality_k, read_at_k)))
 
 
 def run_sensors_readings():
+    global heartbeat
+    if not sensors:
+        _start_readers()
+
     while True:
-        t1 = _get_sensor_temperature(settings.DHT_PIN_16)
-        t2 = _get_sensor_temperature(settings.DHT_PIN_20)
-        
-        if t1:
-            redis_client.set_value(settings.CURR_T1_TEMP, t1)
-        
-        if t2:
-            redis_client.set_value(settings.CURR_T2_TEMP, t2)
-        
+        heartbeat = time.monotonic()
         time.sleep(settings.DHT_POLLING_TIMEOUT_SECONDS)
+        with metrics.LOOP_DURATION.labels("dht_sensors").time():
+            for reader, publisher in sensors:
+                t, read_at = reader.latest
+                publisher.publish(reader.pin, t, read_at)
+            sample_log.flush()
+            try:
+                state_publisher.flush()
+            except RedisError as e:
+                # Readings are kept by the publisher and published once Redis is back
+                logger.warning("Unable to publish readings: {}".format(e))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,16 @@
+def estimate_rpm(pwm_enabled, pwm_duty, max_rpm):
+    """Returns RPM value of a fan based on PWM status and its values of duty"""
+
+    if not pwm_enabled:
+        return max_rpm
+    elif pwm_enabled and not pwm_duty:
+        return 0
+    elif pwm_enabled and pwm_duty == 100:
+        return max_rpm
+    else:
+        return (pwm_duty*max_rpm)/100
+
+
+def estimate_zone_rpm(zone, pwm_enabled, pwm_duty):
+    """Returns RPM estimates of each zone's fan by its name"""
+    return {fan.name: estimate_rpm(pwm_enabled, pwm_duty, fan.max_rpm) for fan in zone.fans}
@@ -0,0 +1,313 @@
+import os
+import random
+import time
+
+import settings
+
+from tach import SimTachSource
+from logger import logger
+
+# Hardware PWM channel of each BCM pin able to output it
+SYSFS_PWM_CHANNELS = {12: 0, 18: 0, 13: 1, 19: 1}
+
+
+class RPiPwmOutput:
+
+    """PWM output driven by RPi.GPIO"""
+
+    def __init__(self, gpio, pin, frequency):
+        self._gpio = gpio
+        self.pin = pin
+        self._gpio.setup(pin, self._gpio.OUT, initial=self._gpio.LOW)
+        self._pwm = self._gpio.PWM(pin, frequency)
+
+
+    def start(self, duty):
+        self._pwm.start(duty)
+
+
+    def change_duty(self, duty):
+        self._pwm.ChangeDutyCycle(duty)
+
+
+    def stop(self):
+        self._pwm.stop()
+
+
+    def close(self):
+        self._gpio.cleanup(self.pin)
+
+
+class SysfsPwmOutput:
+
+    """PWM output generated by the kernel's PWM driver, it takes no CPU and doesn't jitter.
+
+    Root may point to a mock tree having pwmchipN/pwmM directories of exported channels in place.
+    """
+
+    def __init__(self, pin, frequency, root=None, chip=None):
+        if pin not in SYSFS_PWM_CHANNELS:
+            raise ValueError("BCM {} has no hardware PWM".format(pin))
+        self.pin = pin
+        chip_path = os.path.join(root or settings.PWM_SYSFS_ROOT, "pwmchip{}".format(
+            settings.PWM_SYSFS_CHIP if chip is None else chip))
+        self._channel = SYSFS_PWM_CHANNELS[pin]
+        self._chip_path = chip_path
+        self._path = os.path.join(chip_path, "pwm{}".format(self._channel))
+        self._period = round(1e9/frequency)
+
+        if not os.path.exists(self._path):
+            self._export()
+        # Duty can't exceed the period, so it goes down first
+        self._write("enable", 0)
+        self._write("duty_cycle", 0)
+        self._write("period", self._period)
+
+
+    def _export(self):
+        with open(os.path.join(self._chip_path, "export"), "w") as f:
+            f.write(str(self._channel))
+        # Channel's files show up and get their permissions by udev a bit later
+        deadline = time.monotonic() + settings.PWM_SYSFS_EXPORT_TIMEOUT
+        while not os.access(os.path.join(self._path, "period"), os.W_OK):
+            if time.monotonic() > deadline:
+                raise OSError("PWM channel {} isn't exported".format(self._path))
+            time.sleep(0.01)
+
+
+    def _write(self, name, v):
+        with open(os.path.join(self._path, name), "w") as f:
+            f.write(str(v))
+
+
+    def start(self, duty):
+        self.change_duty(duty)
+        self._write("enable", 1)
+
+
+    def change_duty(self, duty):
+        self._write("duty_cycle", round(self._period*duty/100))
+
+
+    def stop(self):
+        self._write("enable", 0)
+
+
+    def close(self):
+        with open(os.path.join(self._chip_path, "unexport"), "w") as f:
+            f.write(str(self._channel))
+
+
+def create_mock_sysfs_pwm(root, chip=0, channels=2):
+    """Creates a tree of a PWM chip with exported channels SysfsPwmOutput can drive, e.g. for tests"""
+    chip_path = os.path.join(root, "pwmchip{}".format(chip))
+    os.makedirs(chip_path, exist_ok=True)
+    for name, v in (("export", ""), ("unexport", ""), ("npwm", channels)):
+        with open(os.path.join(chip_path, name), "w") as f:
+            f.write(str(v))
+    for channel in range(channels):
+        path = os.path.join(chip_path, "pwm{}".format(channel))
+        os.makedirs(path, exist_ok=True)
+        for name, v in (("period", 0), ("duty_cycle", 0), ("enable", 0), ("polarity", "normal")):
+            with open(os.path.join(path, name), "w") as f:
+                f.write(str(v))
+    return chip_path
+
+
+class Dht22Sensor:
+
+    """DHT22 temperature sensor read by adafruit_dht"""
+
+    def __init__(self, pin):
+        import adafruit_dht
+        self.pin = pin
+        self._device = adafruit_dht.DHT22(pin)
+
+
+    def read(self):
+        """Returns temperature, raises RuntimeError on a failed read"""
+        return self._device.temperature
+
+
+    def close(self):
+        self._device.exit()
+
+
+class RPiBackend:
+
+    """Raspberry Pi GPIO and DHT22 sensors"""
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+        self._gpio.setmode(GPIO.BCM)
+        self._gpio.setwarnings(False)
+
+
+    def pwm_output(self, pin, frequency):
+        """Returns PWM output of a driver configured by PWM_CHANNELS, software PWM is the fallback of hardware one"""
+        driver, sysfs_frequency = settings.PWM_CHANNELS.get(pin, ("gpio", frequency))
+        if driver == "sysfs":
+            try:
+                return SysfsPwmOutput(pin, sysfs_frequency)
+            except (OSError, ValueError) as e:
+                logger.warning("Falling back to software PWM on BCM {}: {}".format(pin, e))
+        return RPiPwmOutput(self._gpio, pin, frequency)
+
+
+    def temperature_sensor(self, pin):
+        return Dht22Sensor(pin)
+
+
+    def tach_input(self, pin, callback):
+        """Calls callback on each falling edge of a fan tach signal, callbacks run on RPi.GPIO's thread"""
+        self._gpio.setup(pin, self._gpio.IN, pull_up_down=self._gpio.PUD_UP)
+        self._gpio.add_event_detect(pin, self._gpio.FALLING, callback=lambda channel: callback())
+
+
+    def cleanup(self):
+        self._gpio.cleanup()
+
+
+class ThermalModel:
+
+    """Lumped thermal model of a cabinet: constant heat load, fans increase heat transfer to the ambient air"""
+
+    def __init__(self, ambient=20.0, heat=20.0, capacity=2000.0, idle_conductance=0.5, fans_conductance=4.5):
+        self.ambient = ambient
+        self.heat = heat
+        self.capacity = capacity
+        self.idle_conductance = idle_conductance
+        self.fans_conductance = fans_conductance
+        self.temperature = ambient
+        self.fans_duty = 0
+
+
+    def step(self, dt):
+        """Advances the model by dt seconds"""
+        conductance = self.idle_conductance + self.fans_conductance*self.fans_duty/100
+        self.temperature += dt*(self.heat - conductance*(self.temperature - self.ambient))/self.capacity
+        return self.temperature
+
+
+class SimPwmOutput:
+
+    """Simulated PWM output, fans pin drives the thermal model"""
+
+    def __init__(self, pin, model):
+        self.pin = pin
+        self._model = model
+        self.duty = 0
+        self.changes = 0
+
+
+    def _set_duty(self, duty):
+        if duty != self.duty:
+            self.changes += 1
+        self.duty = duty
+        if self.pin == settings.FANS_PIN:
+            self._model.fans_duty = duty
+
+
+    def start(self, duty):
+        self._set_duty(duty)
+
+
+    def change_duty(self, duty):
+        self._set_duty(duty)
+
+
+    def stop(self):
+        self._set_duty(0)
+        # 4-pin fans spin at full speed without PWM signal
+        if self.pin == settings.FANS_PIN:
+            self._model.fans_duty = 100
+
+
+    def close(self):
+        pass
+
+
+class SimTemperatureSensor:
+
+    """Simulated sensor reading the thermal model with a noise, failed reads and spikes"""
+
+    def __init__(self, pin, model, rng, noise=0.1, failure_rate=0.1, spike_rate=0.01):
+        self.pin = pin
+        self._model = model
+        self._rng = rng
+        self._noise = noise
+        self._failure_rate = failure_rate
+        self._spike_rate = spike_rate
+
+
+    def read(self):
+        if self._rng.random() < self._failure_rate:
+            raise RuntimeError("Checksum did not validate. Try again.")
+        t = self._model.temperature + self._rng.gauss(0, self._noise)
+        if self._rng.random() < self._spike_rate:
+            t += self._rng.choice([-1, 1])*self._rng.uniform(5, 20)
+        return round(t, 1)
+
+
+    def close(self):
+        pass
+
+
+class SimBackend:
+
+    """Simulated outputs and sensors sharing a thermal model"""
+
+    def __init__(self, model=None, seed=0, tach_max_rpm=settings.DEFAULT_RPM_A6):
+        self.model = model or ThermalModel()
+        self.outputs = {}
+        self.stalled_tach_pins = set()
+        self._tach_max_rpm = tach_max_rpm
+        self._rng = random.Random(seed)
+
+
+    def pwm_output(self, pin, frequency):
+        output = SimPwmOutput(pin, self.model)
+        self.outputs[pin] = output
+        return output
+
+
+    def temperature_sensor(self, pin):
+        return SimTemperatureSensor(pin, self.model, self._rng)
+
+
+    def _get_tach_rpm(self, pin):
+        if pin in self.stalled_tach_pins:
+            return 0
+        return self.model.fans_duty*self._tach_max_rpm/100
+
+
+    def tach_input(self, pin, callback):
+        """Feeds callback with simulated pulses, add pin to stalled_tach_pins to simulate a stall"""
+        SimTachSource(callback, lambda: self._get_tach_rpm(pin)).start()
+
+
+    def cleanup(self):
+        pass
+
+
+BACKENDS = {
+    "rpi": RPiBackend,
+    "sim": SimBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    """Returns process wide instance of a configured hardware backend"""
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[settings.HARDWARE_BACKEND]()
+    return _backend
+
+
+def set_backend(backend):
+    """Replaces process wide hardware backend, e.g. with a simulated one"""
+    global _backend
+    _backend = backend
@@ -0,0 +1,114 @@
+import time
+
+from collections import defaultdict
+
+import settings
+
+from zones import zone_key
+
+
+class HistoryRecorder:
+
+    """Rolls zone's samples up into coarser aggregates, each aggregate keeps an average of every sample's field"""
+
+    def __init__(self, zone_id):
+        self._zone_id = zone_id
+        self._last_sample_ts = 0
+        # Per resolution accumulators: bucket start, samples count and sums of each field
+        self._buckets = {}
+
+
+    def _accumulate(self, name, bucket_seconds, ts, sample):
+        """Adds sample to the current bucket, returns the finished aggregate if the bucket has rolled over"""
+        bucket_start = int(ts // bucket_seconds * bucket_seconds)
+        bucket = self._buckets.get(name)
+        finished = None
+
+        if bucket and bucket["ts"] != bucket_start:
+            finished = {"ts": bucket["ts"], "n": bucket["n"]}
+            for f, count in bucket["counts"].items():
+                finished[f] = round(bucket["sums"][f]/count, 2)
+            bucket = None
+
+        if not bucket:
+            bucket = {"ts": bucket_start, "n": 0, "sums": defaultdict(float), "counts": defaultdict(int)}
+            self._buckets[name] = bucket
+
+        bucket["n"] += 1
+        for f, v in sample.items():
+            if v is not None:
+                bucket["sums"][f] += v
+                bucket["counts"][f] += 1
+
+        return finished
+
+
+    def record(self, sample, ts=None):
+        """Records a sample of field values, returns (key, fields, max length) stream entries to append.
+
+        Samples coming more often than HISTORY_SAMPLE_SECONDS are dropped.
+        """
+        ts = time.time() if ts is None else ts
+        if ts - self._last_sample_ts < settings.HISTORY_SAMPLE_SECONDS:
+            return []
+        self._last_sample_ts = ts
+
+        entries = []
+        for name, bucket_seconds, key, maxlen in settings.HISTORY_RESOLUTIONS:
+            key = zone_key(self._zone_id, key)
+            if name == "raw":
+                entry = {"ts": round(ts, 3)}
+                entry.update({f: v for f, v in sample.items() if v is not None})
+                entries.append((key, entry, maxlen))
+                continue
+            finished = self._accumulate(name, bucket_seconds, ts, sample)
+            if finished:
+                entries.append((key, finished, maxlen))
+
+        return entries
+
+
+def _get_resolution(start, end):
+    """Picks the finest resolution which fits the window into HISTORY_MAX_POINTS"""
+    for resolution in settings.HISTORY_RESOLUTIONS:
+        _, bucket_seconds, _, _ = resolution
+        if (end - start)/bucket_seconds <= settings.HISTORY_MAX_POINTS:
+            return resolution
+    return settings.HISTORY_RESOLUTIONS[-1]
+
+
+def _get_stream_range(start, end, resolution=None, zone_id=settings.DEFAULT_ZONE):
+    """Returns resolution to read a given time range in along with its stream key and range of the stream ids"""
+    if resolution:
+        resolution = next(r for r in settings.HISTORY_RESOLUTIONS if r[0] == resolution)
+    else:
+        resolution = _get_resolution(start, end)
+    _, bucket_seconds, key, _ = resolution
+
+    # Stream ids are the time entries were added at, aggregates are added once their bucket is over
+    return resolution, zone_key(zone_id, key), int(start*1000), int((end + bucket_seconds)*1000)
+
+
+def _get_points(entries, start, end, resolution):
+    """Returns points of stream entries within a given time range"""
+    _, bucket_seconds, _, _ = resolution
+    points = []
+    for entry in entries:
+        point = {k: float(v) for k, v in entry.items()}
+        if start < point["ts"] + bucket_seconds and point["ts"] <= end:
+            points.append(point)
+    return points
+
+
+def read_history(redis_client, start, end, resolution=None, zone_id=settings.DEFAULT_ZONE):
+    """Returns name of the resolution used and zone's points of a given time range"""
+    resolution, key, start_ms, end_ms = _get_stream_range(start, end, resolution, zone_id)
+    entries = redis_client.read_stream(key, start_ms, end_ms)
+    return resolution[0], _get_points(entries, start, end, resolution)
+
+
+async def async_read_history(redis_client, start, end, resolution=None, zone_id=settings.DEFAULT_ZONE):
+    """Counterpart of read_history reading by the asyncio client"""
+    resolution, key, start_ms, end_ms = _get_stream_range(start, end, resolution, zone_id)
+    entries = await redis_client.read_stream(key, start_ms, end_ms)
+    return resolution[0], _get_points(entries, start, end, resolution)
@@ -1,20 +1,25 @@
 import logging
 import time
-from systemd.journal import JournaldLogHandler
+
+try:
+    from systemd.journal import JournaldLogHandler
+except ImportError:
+    # off a systemd host, e.g. when running simulations
+    JournaldLogHandler = None
 
 # get an instance of the logger object this module will use
 logger = logging.getLogger(__name__)
 
 # instantiate the JournaldLogHandler to hook into systemd
-journald_handler = JournaldLogHandler()
+handler = JournaldLogHandler() if JournaldLogHandler else logging.StreamHandler()
 
 # set a formatter to include the level name
-journald_handler.setFormatter(logging.Formatter(
+handler.setFormatter(logging.Formatter(
     "[%(levelname)s] %(message)s"
 ))
 
-# add the journald handler to the current logger
-logger.addHandler(journald_handler)
+# add the handler to the current logger
+logger.addHandler(handler)
 
 # optionally set the logging level
 logger.setLevel(logging.INFO)
@@ -0,0 +1,234 @@
+import threading
+import time
+
+from array import array
+from collections import deque
+
+import settings
+
+from redis_client import StateProperties
+from shm_state import get_layout, get_state, load_profiles_file, save_profiles_file, to_type
+from zones import get_zone
+
+
+class MemorySubscription:
+
+    """Number of the last change seen by a subscriber"""
+
+    def __init__(self, seq):
+        self.seq = seq
+
+
+    def close(self):
+        pass
+
+
+class MemoryStateClient(StateProperties):
+
+    """Counterpart of RedisClient keeping the state in memory of a single process running all the services.
+
+    Values are kept typed and every call is served under a single condition, so a write wakes its waiters
+    right away. History is kept in memory as well, capped by STATE_MEMORY_HISTORY_MAXLEN, profiles are kept in a JSON
+    file.
+    """
+
+    def __init__(self, profiles_path=None):
+        self._profiles_path = profiles_path or settings.STATE_PROFILES_PATH
+        self._types = dict(get_layout())
+        self._values = dict.fromkeys(self._types)
+        self._state_version = 0
+        self._commands_seq = 0
+        self._acked_seq = 0
+        self._popped = 0
+        self._streams = {}
+        # Number of the last change along with the number each key has changed by
+        self._seq = 0
+        self._changed = {}
+        self._changes = threading.Condition()
+
+
+    def _put(self, values):
+        """Writes typed values, raises ValueError before writing anything if a key isn't known"""
+        for k in values:
+            if k not in self._types:
+                raise ValueError("{} isn't kept by the state".format(k))
+        self._seq += 1
+        for k, v in values.items():
+            self._values[k] = to_type(v, self._types[k])
+            self._changed[k] = self._seq
+        self._changes.notify_all()
+
+
+    def _get(self, k):
+        with self._changes:
+            return self._values[k]
+
+
+    def _get_state_value(self, k):
+        v = self._get(k)
+        return False if v is None and self._types[k] == bool else v
+
+
+    def set_value(self, k, v):
+        self.set_values({k: v})
+
+
+    def set_values(self, values):
+        """Atomically writes the given values"""
+        with self._changes:
+            self._put(values)
+            self._state_version += 1
+
+
+    def set_missing_values(self, values):
+        """Writes only those of the given values whose keys aren't set, returns the written keys"""
+        with self._changes:
+            written = [k for k in values if self._values.get(k) is None]
+            if written:
+                self._put({k: values[k] for k in written})
+                self._state_version += 1
+        return written
+
+
+    def get_state_version(self):
+        """Returns counter of state writes, it's bumped by every one of them"""
+        with self._changes:
+            return self._state_version
+
+
+    def snapshots(self, zones, sensors=True, fans=True):
+        """Reads consistent state of all the given zones and returns them as immutable States"""
+        with self._changes:
+            return [get_state(zone, self._values, sensors, fans) for zone in zones]
+
+
+    def snapshot(self, zone_id=settings.DEFAULT_ZONE, sensors=True, fans=True):
+        """Reads state of a given zone and returns it as an immutable State"""
+        return self.snapshots([get_zone(zone_id)], sensors, fans)[0]
+
+
+    def send_command(self, values):
+        """Atomically writes the given values and numbers a command for the controller to acknowledge.
+
+        Returns id of the command to wait for.
+        """
+        with self._changes:
+            self._commands_seq += 1
+            self._put(dict(values))
+            if values:
+                self._state_version += 1
+            self._changed[settings.COMMANDS_KEY] = self._seq
+            return str(self._commands_seq)
+
+
+    def wait_for_ack(self, command_id, timeout):
+        """Blocks until the controller acknowledges a given command or timeout expires"""
+        with self._changes:
+            return self._changes.wait_for(lambda: self._acked_seq >= int(command_id), timeout)
+
+
+    def pop_commands(self):
+        """Takes ids of the commands sent since the last call"""
+        with self._changes:
+            command_ids = [str(command_id) for command_id in range(self._popped + 1, self._commands_seq + 1)]
+            self._popped = self._commands_seq
+            return command_ids
+
+
+    def ack_commands(self, command_ids):
+        """Acknowledges given commands along with all the preceding ones"""
+        if not command_ids:
+            return
+        with self._changes:
+            self._acked_seq = max([self._acked_seq] + [int(command_id) for command_id in command_ids])
+            self._changes.notify_all()
+
+
+    def get_profiles(self):
+        """Returns stored JSONs of all the scheduled profiles by name"""
+        with self._changes:
+            return load_profiles_file(self._profiles_path)
+
+
+    def set_profile(self, name, raw):
+        with self._changes:
+            profiles = load_profiles_file(self._profiles_path)
+            profiles[name] = raw
+            save_profiles_file(self._profiles_path, profiles)
+
+
+    def delete_profile(self, name):
+        """Deletes a scheduled profile, returns False if there's no such one"""
+        with self._changes:
+            profiles = load_profiles_file(self._profiles_path)
+            if profiles.pop(name, None) is None:
+                return False
+            save_profiles_file(self._profiles_path, profiles)
+            return True
+
+
+    def append_streams(self, entries):
+        """Appends (key, fields, max length) entries to streams, at most STATE_MEMORY_HISTORY_MAXLEN of each.
+
+        Entries are kept compact, an array of the time they're added at and their values along with a tuple of field
+        names shared by the entries of the same fields.
+        """
+        with self._changes:
+            ms = int(time.time()*1000)
+            for k, fields, maxlen in entries:
+                maxlen = min(maxlen, settings.STATE_MEMORY_HISTORY_MAXLEN)
+                stream = self._streams.get(k)
+                if stream is None or stream.maxlen != maxlen:
+                    stream = self._streams[k] = deque(stream or (), maxlen=maxlen)
+                names = tuple(fields)
+                if stream and stream[-1][0] == names:
+                    names = stream[-1][0]
+                stream.append((names, array("d", [ms] + [fields[f] for f in names])))
+
+
+    def read_stream(self, k, start_ms, end_ms):
+        """Returns fields of stream entries added within a given time range, values are floats"""
+        with self._changes:
+            return [dict(zip(names, values[1:])) for names, values in self._streams.get(k, ())
+                    if start_ms <= values[0] <= end_ms]
+
+
+    def subscribe(self):
+        """Returns subscription to state changes"""
+        with self._changes:
+            return MemorySubscription(self._seq)
+
+
+    def wait_for_changes(self, subscription, timeout, keys=None):
+        """Blocks until any of the given keys changes or timeout expires.
+
+        Returns True if anything of interest has changed.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changes:
+            while True:
+                if keys is None:
+                    changed = self._seq > subscription.seq
+                else:
+                    changed = any(self._changed.get(k, 0) > subscription.seq for k in keys)
+                subscription.seq = self._seq
+                if changed:
+                    return True
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return False
+                self._changes.wait(wait)
+
+
+# State shared by all the clients of the process
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_memory_client():
+    """Returns process wide client, so that all the services of the process share the state"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = MemoryStateClient()
+        return _client
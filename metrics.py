@@ -0,0 +1,142 @@
+import atexit
+import functools
+import glob
+import os
+import threading
+
+import settings
+
+# Multiprocess mode keeps samples of each process in its own memory-mapped files, the web app aggregates
+# them on scrape, so the daemons are never asked for anything. Mind that it must be set before the import.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", settings.METRICS_DIR)
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SLOW_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Metrics are created on first use, their files are created along with them, so the import doesn't touch the directory
+_DEFINITIONS = {
+    "LOOP_DURATION": lambda: Histogram(
+        "pi_fan_loop_duration_seconds", "Duration of a single control or sensors loop iteration", ["loop"],
+        buckets=FAST_BUCKETS,
+    ),
+    "SENSOR_READ_DURATION": lambda: Histogram(
+        "pi_fan_sensor_read_duration_seconds", "Duration of a single sensor read attempt", ["pin"],
+        buckets=SLOW_BUCKETS,
+    ),
+    "SENSOR_READ_FAILURES": lambda: Counter(
+        "pi_fan_sensor_read_failures_total", "Failed sensor read attempts", ["pin"],
+    ),
+    "REDIS_CALL_DURATION": lambda: Histogram(
+        "pi_fan_redis_call_duration_seconds", "Duration of RedisClient calls", ["call"],
+        buckets=FAST_BUCKETS,
+    ),
+    "COMMAND_WAIT_DURATION": lambda: Histogram(
+        "pi_fan_command_wait_seconds", "Time web app waits for the controller to acknowledge a command",
+        buckets=SLOW_BUCKETS,
+    ),
+    "COMMAND_TIMEOUTS": lambda: Counter(
+        "pi_fan_command_timeouts_total", "Commands the controller didn't acknowledge in time",
+    ),
+    "DUTY_CHANGES": lambda: Counter(
+        "pi_fan_duty_changes_total", "Duty cycle changes applied to PWM outputs", ["pin"],
+    ),
+    "HTTP_REQUEST_DURATION": lambda: Histogram(
+        "pi_fan_http_request_duration_seconds", "Duration of HTTP requests handling", ["endpoint", "method", "status"],
+        buckets=FAST_BUCKETS + (2.5, 5.0),
+    ),
+}
+
+_metrics = {}
+_lock = threading.Lock()
+# Process the directory has been prepared by, workers forked by uWSGI prepare it on their own
+_pid = None
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_dead_processes():
+    """Removes files of processes that aren't running anymore, e.g. of previous runs of the services and workers"""
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        try:
+            pid = int(os.path.basename(path)[:-len(".db")].rsplit("_", 1)[1])
+        except (IndexError, ValueError):
+            continue
+        if not _is_running(pid):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process starting meanwhile has removed it
+                pass
+
+
+def _start():
+    """Prepares the directory once per process, files of the process are given up once it exits"""
+    global _pid
+    with _lock:
+        if _pid == os.getpid():
+            return
+        os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+        remove_dead_processes()
+        atexit.register(multiprocess.mark_process_dead, os.getpid())
+        _pid = os.getpid()
+
+
+def _get(name):
+    if _pid != os.getpid():
+        _start()
+    metric = _metrics.get(name)
+    if metric is None:
+        with _lock:
+            metric = _metrics.get(name)
+            if metric is None:
+                metric = _metrics[name] = _DEFINITIONS[name]()
+    return metric
+
+
+def __getattr__(name):
+    """Returns metric of a given name, e.g. metrics.LOOP_DURATION, creating it on first use"""
+    if name not in _DEFINITIONS:
+        raise AttributeError("module {} has no attribute {}".format(__name__, name))
+    return _get(name)
+
+
+def redis_call(name):
+    """Decorator timing RedisClient call of a given name"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with _get("REDIS_CALL_DURATION").labels(name).time():
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def async_redis_call(name):
+    """Decorator timing AsyncRedisClient coroutine of a given name, Prometheus' own one only times coroutine creation"""
+    def decorator(f):
+        @functools.wraps(f)
+        async def wrapper(*args, **kwargs):
+            with _get("REDIS_CALL_DURATION").labels(name).time():
+                return await f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Returns metrics of all the processes aggregated along with their content type"""
+    if _pid != os.getpid():
+        _start()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
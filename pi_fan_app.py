@@ -1,73 +1,41 @@
-
-import atexit
 import json
 import time
 
-from datetime import datetime
+import metrics
 
 from http import HTTPStatus
-from flask import Flask, jsonify, request, render_template, redirect
-from werkzeug.exceptions import InternalServerError
-from pystemd.systemd1 import Unit
-
-from redis_client import RedisClient
+from flask import Flask, Response, g, jsonify, request, render_template, redirect
+from werkzeug.exceptions import InternalServerError, NotFound
+
+from history import read_history
+from redis_client import get_client
+from schedule import dump_profile, format_profile
+from stats_stream import StatsBroadcaster
+from web_common import (RequestError, get_applied_controls, get_control_command, get_formatted_profile,
+                        get_formatted_profiles, get_index_data, get_lights_command, get_not_modified_response,
+                        get_profiles_preview, get_pwm_disable_command, get_pwm_enable_command, get_reset_command,
+                        get_set_duty_command, get_state_average_temperature, get_stats, get_stats_etag,
+                        get_stop_fans_command, get_threshold_command, get_unable_to_set_msg, parse_control_request,
+                        parse_duty, parse_history_request, parse_mode, parse_preview_hours, parse_profile_request,
+                        parse_stats_request, parse_threshold, tag_response)
+from zones import get_zone, get_zones
 from logger import logger
 
 # Flask app
 app = Flask(__name__)
 app.config.from_object("settings")
 
-# Redis client
-redis_client = RedisClient()
-
-OK = HTTPStatus.OK.value
-BAD_REQUEST = HTTPStatus.BAD_REQUEST.value
-INTERNAL_SERVER_ERROR = HTTPStatus.INTERNAL_SERVER_ERROR.value
-
-
-def _init_redis():
-    """Fills Redis with default values"""
-    redis_client.set_value(app.config["PWM_ENABLED"], False)
-    redis_client.set_value(app.config["LIGHTS_ENABLED"], False)
-    redis_client.set_value(app.config["NEW_LIGHTS_ENABLED"], False)
-    redis_client.set_value(app.config["NEW_PWM_ENABLED"], False)
-    redis_client.set_value(app.config["CURR_CTRL_MODE"], app.config["AUTO_MODE"])
-    redis_client.set_value(app.config["NEW_CTRL_MODE"], app.config["AUTO_MODE"])
-    redis_client.set_value(app.config["CURR_PWM_DUTY"], 0)
-    redis_client.set_value(app.config["NEW_PWM_DUTY"], 0)
-    redis_client.set_value(app.config["CURR_T1_TEMP"], -100.0)
-    redis_client.set_value(app.config["CURR_T2_TEMP"], -100.0)
-
-
-def _get_current_rpm(pwm_enabled, current_pwm_duty):
-    """Returns RPM values based on PWM status and its values of duty"""
+# Redis client or its shared memory counterpart, see STATE_BACKEND
+redis_client = get_client()
 
-    if not pwm_enabled:
-        return app.config["DEFAULT_RPM_A6"], app.config["DEFAULT_RPM_A12"]
-    elif pwm_enabled and current_pwm_duty == 0:
-        return 0, 0
-    elif pwm_enabled and current_pwm_duty == 100:
-        return app.config["DEFAULT_RPM_A6"], app.config["DEFAULT_RPM_A12"]
-    else:
-        return (
-            (current_pwm_duty*app.config["DEFAULT_RPM_A6"])/100,
-            (current_pwm_duty*app.config["DEFAULT_RPM_A12"])/100
-        )
+# Live stats of the default zone for the dashboard
+stats_broadcaster = StatsBroadcaster(redis_client, lambda state: get_stats(get_zone(app.config["DEFAULT_ZONE"]), state))
 
+DEFAULT_ZONE = app.config["DEFAULT_ZONE"]
 
-def _get_systemd_service_status(service_name):
-    """Returns state of a given service"""
-    unit = Unit(service_name)
-    unit.load()
-    return unit.Unit.ActiveState.decode("utf-8")
-
-
-def _get_average_temperature():
-    """Gets average temperature from two available sensors"""
-    t1 = redis_client.current_t1_temperature
-    t2 = redis_client.current_t2_temperature
-    if t1 and t2:
-        return (t1 + t2)/2
+OK = HTTPStatus.OK.value
+INTERNAL_SERVER_ERROR = HTTPStatus.INTERNAL_SERVER_ERROR.value
+SERVICE_UNAVAILABLE = HTTPStatus.SERVICE_UNAVAILABLE.value
 
 
 def _get_response(msg, status=OK):
@@ -81,21 +49,61 @@ def _get_error_response(msg):
     return json, INTERNAL_SERVER_ERROR
 
 
-def _set_and_wait(k, v):
-    """Sets the given value provided by key and wait until it"s set or failed."""
+def _send_and_wait(values):
+    """Sends the given values to the controller as one command and waits until it"s applied or failed."""
     try:
-        redis_client.set_value(k, v)
-        start = datetime.now()
-        delta = 0
-        while delta < app.config["SET_AND_WAIT_TIMEOUT"]:
-            time.sleep(app.config["POLLING_INTERVAL"])
-            if getattr(redis_client, k) == v:
-                return True
-            delta = (datetime.now() - start).seconds
+        command_id = redis_client.send_command(values)
+        with metrics.COMMAND_WAIT_DURATION.time():
+            acked = redis_client.wait_for_ack(command_id, app.config["SET_AND_WAIT_TIMEOUT"])
+        if not acked:
+            metrics.COMMAND_TIMEOUTS.inc()
+        return acked
     except Exception as e:
         logger.error(str(e))
 
 
+def _get_unable_to_set_response(values):
+    """Wraps failed command into error response"""
+    return _get_error_response(get_unable_to_set_msg(values))
+
+
+def _run_command(values, msg):
+    """Sends a command if there's anything to change and wraps its result into response"""
+    if values and not _send_and_wait(values):
+        return _get_unable_to_set_response(values)
+    return _get_response(msg)
+
+
+@app.before_request
+def check_zone():
+    """Rejects requests addressing unknown zones"""
+    if request.view_args and get_zone(request.view_args.get("zone_id", DEFAULT_ZONE)) is None:
+        return _get_response(app.config["UNKNOWN_ZONE_MSG"], status=NotFound.code)
+
+
+@app.before_request
+def start_timer():
+    """Remembers when request handling has started"""
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    """Observes request handling duration"""
+    started = g.get("started")
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unknown"
+        metrics.HTTP_REQUEST_DURATION.labels(endpoint, request.method, response.status_code).observe(
+            time.perf_counter() - started)
+    return response
+
+
+@app.errorhandler(RequestError)
+def handle_request_error(e):
+    """Answers requests the app can't serve by their message"""
+    return _get_response(e.msg, status=e.status)
+
+
 @app.errorhandler(InternalServerError)
 def handle_500(e):
     """Internal server error handler"""
@@ -109,188 +117,203 @@ def handle_500(e):
     return response
 
 
-@app.route("/get-average-temperature", methods=["GET"])
-def get_avg_temp():
-    """Returns average pad temperature"""
-    return str(_get_average_temperature())
+@app.route("/get-average-temperature", methods=["GET"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/get-average-temperature", methods=["GET"])
+def get_avg_temp(zone_id):
+    """Returns average pad temperature, it's answered by 304 Not Modified until the state changes"""
+    etag = get_stats_etag(redis_client.get_state_version(), zone_id, ("avg_temperature",))
+    not_modified = get_not_modified_response(request, Response, etag)
+    if not_modified is not None:
+        return not_modified
+
+    state = redis_client.snapshot(zone_id, fans=False)
+    return tag_response(Response(str(get_state_average_temperature(state))), etag)
 
 
-@app.route("/pwm/enable/<string:mode>", methods=["POST"])
-def pwm_enable(mode):
+@app.route("/pwm/enable/<string:mode>", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/enable/<string:mode>", methods=["POST"])
+def pwm_enable(mode, zone_id):
     """Enables PWM pad controls"""
-    if mode not in ["auto", "manual"]:
-        return _get_response(app.config["BAD_MODE_MSG"], status=BAD_REQUEST)
-
-    current_ctrl_mode = redis_client.current_ctrl_mode
-    pwm_enabled = redis_client.pwm_enabled
-
-    if not _set_and_wait(app.config["CURR_TEMP_THRESHOLD"], app.config["DEFAULT_TEMPERATURE_THRESHOLD"]):
-        return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["CURR_TEMP_THRESHOLD"]))
-    if not _set_and_wait(app.config["NEW_TEMP_THRESHOLD"], app.config["DEFAULT_TEMPERATURE_THRESHOLD"]):
-        return _get_error_response(
-            app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_TEMP_THRESHOLD"]))
-
-    if pwm_enabled and mode != current_ctrl_mode:
-        if not _set_and_wait(app.config["NEW_CTRL_MODE"], mode):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_CTRL_MODE"]))
-        return _get_response(app.config["PWM_ENABLED_MSG"])
-    elif not pwm_enabled:
-        if not _set_and_wait(app.config["NEW_PWM_ENABLED"], True):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_PWM_ENABLED"]))
-        if not _set_and_wait(app.config["NEW_CTRL_MODE"], mode):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_CTRL_MODE"]))
-        if not _set_and_wait(app.config["NEW_PWM_DUTY"], app.config["PWM_DEFAULT_DUTY"]):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_PWM_DUTY"]))
-        return _get_response(app.config["PWM_ENABLED_MSG"])
-
-    return _get_response(app.config["NO_ACTION_MSG"])
-
-
-@app.route("/pwm/disable", methods=["POST"])
-def pwm_disable():
-    """Disables PWM pad controls"""
-    if redis_client.pwm_enabled:
-        if not _set_and_wait(app.config["NEW_PWM_ENABLED"], False):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_PWM_ENABLED"]))
-        if not _set_and_wait(app.config["NEW_PWM_DUTY"], 0):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_PWM_DUTY"]))
-        return _get_response(app.config["PWM_DISABLED_MSG"])
+    mode = parse_mode(mode)
+    return _run_command(*get_pwm_enable_command(redis_client.snapshot(zone_id), zone_id, mode))
+
 
-    return _get_response(app.config["NO_ACTION_MSG"])
+@app.route("/pwm/disable", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/disable", methods=["POST"])
+def pwm_disable(zone_id):
+    """Disables PWM pad controls"""
+    return _run_command(*get_pwm_disable_command(redis_client.snapshot(zone_id), zone_id))
 
 
-@app.route("/pwm/set-temp-threshold/<string:threshold>", methods=["POST"])
-def pwm_set_temp_threshold(threshold):
+@app.route("/pwm/set-temp-threshold/<string:threshold>", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/set-temp-threshold/<string:threshold>", methods=["POST"])
+def pwm_set_temp_threshold(threshold, zone_id):
     """Sets fan"s enabling temperature threshold"""
-    try:
-        threshold = float(threshold)
-    except ValueError:
-        return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_TEMP_THRESHOLD"]))
+    return _run_command(*get_threshold_command(zone_id, parse_threshold(threshold)))
 
-    if not _set_and_wait(app.config["NEW_TEMP_THRESHOLD"], threshold):
-        return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_TEMP_THRESHOLD"]))
 
-    return _get_response(app.config["TEMP_THRESHOLD_SET_MSG"])
+@app.route("/pwm/set-duty/<string:percent>", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/set-duty/<string:percent>", methods=["POST"])
+def pwm_set_duty(percent, zone_id):
+    """Sets PWM duty cycle"""
+    percent = parse_duty(percent)
+    return _run_command(*get_set_duty_command(redis_client.snapshot(zone_id), zone_id, percent))
 
 
-@app.route("/pwm/set-duty/<string:percent>", methods=["POST"])
-def pwm_set_duty(percent):
-    """Sets PWM duty cycle"""
-    try:
-        percent = int(percent)
-    except ValueError:
-        return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_PWM_DUTY"]))
+@app.route("/pwm/stop-fans", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/stop-fans", methods=["POST"])
+def stop_fans(zone_id):
+    """Explicitly stops fans"""
+    return _run_command(*get_stop_fans_command(redis_client.snapshot(zone_id), zone_id))
 
-    if redis_client.pwm_enabled and redis_client.current_ctrl_mode == app.config["MANUAL_MODE"]:
-        if not _set_and_wait(app.config["NEW_PWM_DUTY"], percent):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_PWM_DUTY"]))
-        return _get_response(app.config["DUTY_SET_MSG"].format(pwm_duty=percent))
 
-    return _get_response(app.config["NO_ACTION_MSG"])
+@app.route("/lights/on", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/lights/on", methods=["POST"])
+def lights_on(zone_id):
+    """Turns light on"""
+    return _run_command(*get_lights_command(redis_client.snapshot(zone_id), zone_id, True))
 
 
-@app.route("/pwm/stop-fans", methods=["POST"])
-def stop_fans():
-    """Explicitly stops fans"""
-    if redis_client.pwm_enabled and redis_client.current_ctrl_mode == app.config["MANUAL_MODE"]:
-        if not _set_and_wait(app.config["NEW_PWM_DUTY"], 0):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_PWM_DUTY"]))
-        return _get_response(app.config["FANS_STOPPED_MSG"])
+@app.route("/lights/off", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/lights/off", methods=["POST"])
+def lights_off(zone_id):
+    """Turns light off"""
+    return _run_command(*get_lights_command(redis_client.snapshot(zone_id), zone_id, False))
 
-    return _get_response(app.config["NO_ACTION_MSG"])
 
+def _get_states(zone_ids):
+    """Returns states of the given zones by zone id read at once"""
+    return dict(zip(zone_ids, redis_client.snapshots([get_zone(zone_id) for zone_id in zone_ids])))
 
-@app.route("/lights/on", methods=["POST"])
-def lights_on():
-    """Turns light on"""
-    if not redis_client.lights_enabled:
-        if not _set_and_wait(app.config["NEW_LIGHTS_ENABLED"], True):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_LIGHTS_ENABLED"]))
-        return _get_response(app.config["LIGHTS_ON_MSG"])
 
-    return _get_response(app.config["NO_ACTION_MSG"])
+@app.route("/control", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/control", methods=["POST"])
+def control(zone_id):
+    """Applies JSON document of desired controls of one or many zones with a single command"""
+    controls = parse_control_request(request.get_json(silent=True), zone_id)
+    values = get_control_command(_get_states(list(controls)), controls)
+    if not values:
+        return _get_response(app.config["NO_ACTION_MSG"])
+    if not _send_and_wait(values):
+        return _get_unable_to_set_response(values)
+
+    # Acknowledged command's state is already published, so it tells what's been applied
+    return jsonify({
+        "status": app.config["CONTROL_SET_MSG"],
+        "zones": get_applied_controls(_get_states(list(controls)), controls),
+    })
 
 
-@app.route("/lights/off", methods=["POST"])
-def lights_off():
-    """Turns light off"""
-    if redis_client.lights_enabled:
-        if not _set_and_wait(app.config["NEW_LIGHTS_ENABLED"], False):
-            return _get_error_response(app.config.get("UNABLE_TO_SET_PROP_MSG").format(app.config["NEW_LIGHTS_ENABLED"]))
-        return _get_response(app.config["LIGHTS_OFF_MSG"])
-
-    return _get_response(app.config["NO_ACTION_MSG"])
-
-
-@app.route("/stats", methods=["GET"])
-def stats_json():
-    """Returns overal stats in JSON"""
-    pwm_enabled = redis_client.pwm_enabled
-    curr_ctrl_mode = redis_client.current_ctrl_mode
-    curr_temp_threshold = redis_client.current_temperature_threshold
-    current_pwm_duty = redis_client.current_pwm_duty
-    t1 = redis_client.current_t1_temperature
-    t2 = redis_client.current_t2_temperature
-    rpm_a6, rpm_a12 = _get_current_rpm(pwm_enabled, current_pwm_duty)
-    lights_enabled = redis_client.lights_enabled
-
-    stats = {
-        "sensors": {
-            "t1_temperature": t1,
-            "t2_temperature": t2,
-            "avg_temperature": (t1+t2)/2 if t1 and t2 else None,
-        },
-        "controls": {
-            "current_control_mode": curr_ctrl_mode,
-            "current_temperature_threshold": curr_temp_threshold,
-            "pwm_enabled": pwm_enabled,
-            "lights_enabled": lights_enabled,
-            "pwm_duty_cycle": current_pwm_duty,
-        },
-        "fans": {
-            "rpm_a6": rpm_a6,
-            "rpm_a12": rpm_a12,
-        },
-        "systemd_services": {
-            app.config["DHT_SERVICE"]: _get_systemd_service_status(app.config["DHT_SERVICE"]),
-            app.config["PWM_SERVICE"]: _get_systemd_service_status(app.config["PWM_SERVICE"]),
-            app.config["WEB_APP_SERVICE"]: _get_systemd_service_status(app.config["WEB_APP_SERVICE"]),
-        }
-    }
-
-    return jsonify(stats)
+@app.route("/admin/reset", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/admin/reset", methods=["POST"])
+def admin_reset(zone_id):
+    """Restores default controls, PWM and lights get disabled"""
+    return _run_command(*get_reset_command(zone_id))
+
+
+@app.route("/profiles", methods=["GET"])
+def profiles_json():
+    """Returns all the scheduled profiles by name"""
+    return jsonify(get_formatted_profiles(redis_client.get_profiles()))
+
+
+@app.route("/profiles/preview", methods=["GET"])
+def profiles_preview():
+    """Returns upcoming transitions of the scheduled profiles"""
+    hours = parse_preview_hours(request.args)
+    return jsonify(get_profiles_preview(redis_client.get_profiles(), hours))
+
+
+@app.route("/profiles/<string:name>", methods=["GET"])
+def profile_json(name):
+    """Returns a scheduled profile"""
+    return jsonify(get_formatted_profile(redis_client.get_profiles(), name))
+
+
+@app.route("/profiles/<string:name>", methods=["PUT"])
+def profile_set(name):
+    """Creates or replaces a scheduled profile, the controller picks it up before the response"""
+    profile = parse_profile_request(name, request.get_json(silent=True))
+    redis_client.set_profile(name, dump_profile(profile))
+    if not _send_and_wait({}):
+        return _get_unable_to_set_response([name])
+    return jsonify({"status": app.config["PROFILE_SET_MSG"], "profile": format_profile(profile)})
+
+
+@app.route("/profiles/<string:name>", methods=["DELETE"])
+def profile_delete(name):
+    """Deletes a scheduled profile"""
+    if not redis_client.delete_profile(name):
+        return _get_response(app.config["PROFILE_NOT_FOUND_MSG"], status=NotFound.code)
+    if not _send_and_wait({}):
+        return _get_unable_to_set_response([name])
+    return _get_response(app.config["PROFILE_DELETED_MSG"])
+
+
+@app.route("/stats", methods=["GET"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/stats", methods=["GET"])
+def stats_json(zone_id):
+    """Returns overal stats in JSON, only the sections given by ?fields=sensors,fans if they're selected.
+
+    Stats are answered by 304 Not Modified until the state changes.
+    """
+    fields = parse_stats_request(request.args)
+
+    # Version is read ahead of the state, so a change in between only makes the next request read it again
+    etag = get_stats_etag(redis_client.get_state_version(), zone_id, fields)
+    not_modified = get_not_modified_response(request, Response, etag)
+    if not_modified is not None:
+        return not_modified
+
+    state = redis_client.snapshot(zone_id, sensors="sensors" in fields, fans="fans" in fields)
+    return tag_response(jsonify(get_stats(get_zone(zone_id), state, fields)), etag)
+
+
+@app.route("/zones", methods=["GET"])
+def zones_json():
+    """Returns all the zones along with their settings"""
+    return jsonify([zone._asdict() for zone in get_zones()])
+
+
+@app.route("/stats/stream", methods=["GET"])
+def stats_stream():
+    """Streams overal stats as Server-Sent Events, whole stats go first and only changes of them afterwards"""
+    stream = stats_broadcaster.stream()
+    if stream is None:
+        return _get_response(app.config["STATS_STREAM_BUSY_MSG"], status=SERVICE_UNAVAILABLE)
+    response = Response(stream, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_text():
+    """Returns metrics of all the services in Prometheus text format"""
+    data, content_type = metrics.render()
+    return Response(data, mimetype=content_type)
+
+
+@app.route("/history", methods=["GET"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/history", methods=["GET"])
+def history_json(zone_id):
+    """Returns sensors readings and fans duty history of a given time range in a resolution fitting it"""
+    start, end, resolution = parse_history_request(request.args)
+    resolution, points = read_history(redis_client, start, end, resolution=resolution, zone_id=zone_id)
+    return jsonify({
+        "start": start,
+        "end": end,
+        "resolution": resolution,
+        "points": points,
+    })
 
 
 @app.route("/")
 def index():
-    """Index page"""
-    pwm_enabled = redis_client.pwm_enabled
-    curr_ctrl_mode = redis_client.current_ctrl_mode
-    curr_temp_threshold = redis_client.current_temperature_threshold
-    current_pwm_duty = redis_client.current_pwm_duty
-    t1 = redis_client.current_t1_temperature
-    t2 = redis_client.current_t2_temperature
-    lights_enabled = redis_client.lights_enabled
-
-    data = {
-        app.config["CURR_CTRL_MODE"]: curr_ctrl_mode,
-        app.config["CURR_TEMP_THRESHOLD"]: curr_temp_threshold,
-        app.config["LIGHTS_ENABLED"]: lights_enabled,
-        app.config["PWM_ENABLED"]: pwm_enabled,
-        app.config["CURR_PWM_DUTY"]: "{}%".format(current_pwm_duty),
-        app.config["CURR_T1_TEMP"]: t1,
-        app.config["CURR_T2_TEMP"]: t2,
-        app.config["AVG_TEMP"]: (t1+t2)/2 if t1 and t2 else None,
-        app.config["DHT_SERVICE"]: _get_systemd_service_status(app.config["DHT_SERVICE"]),
-        app.config["PWM_SERVICE"]: _get_systemd_service_status(app.config["PWM_SERVICE"]),
-        app.config["WEB_APP_SERVICE"]: _get_systemd_service_status(app.config["WEB_APP_SERVICE"])
-    }
-
-    return render_template("index.html", data=data)
-
-
-# Re-init redis just in case
-atexit.register(_init_redis)
+    """Index page of the default zone"""
+    data, paths = get_index_data(redis_client.snapshot())
+    return render_template("index.html", data=data, paths=paths)
+
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0")
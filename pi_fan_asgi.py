@@ -0,0 +1,308 @@
+import asyncio
+import time
+
+import metrics
+
+from http import HTTPStatus
+from quart import Quart, Response, g, jsonify, request, render_template
+from werkzeug.exceptions import NotFound
+
+from async_redis_client import AsyncRedisClient
+from history import async_read_history
+from schedule import dump_profile, format_profile
+from stats_stream import AsyncStatsBroadcaster
+from web_common import (RequestError, get_applied_controls, get_control_command, get_formatted_profile,
+                        get_formatted_profiles, get_index_data, get_lights_command, get_not_modified_response,
+                        get_profiles_preview, get_pwm_disable_command, get_pwm_enable_command, get_reset_command,
+                        get_set_duty_command, get_state_average_temperature, get_stats, get_stats_etag,
+                        get_stop_fans_command, get_threshold_command, get_unable_to_set_msg, parse_control_request,
+                        parse_duty, parse_history_request, parse_mode, parse_preview_hours, parse_profile_request,
+                        parse_stats_request, parse_threshold, systemd_statuses, tag_response)
+from zones import get_zone, get_zones
+from logger import logger
+
+# Quart app serving the same API as the Flask one, run it by an ASGI server, e.g. hypercorn pi_fan_asgi:app
+app = Quart(__name__)
+app.config.from_object("settings")
+
+# Async Redis client
+redis_client = AsyncRedisClient()
+
+DEFAULT_ZONE = app.config["DEFAULT_ZONE"]
+
+# Single subscription fanning stats out to all the stream clients of the process
+stats_broadcaster = AsyncStatsBroadcaster(redis_client, lambda state: get_stats(get_zone(DEFAULT_ZONE), state))
+
+OK = HTTPStatus.OK.value
+INTERNAL_SERVER_ERROR = HTTPStatus.INTERNAL_SERVER_ERROR.value
+
+
+def _get_response(msg, status=OK):
+    """Wraps message into JSON response with 200 OK status"""
+    return jsonify({"status": msg}), status
+
+
+def _get_error_response(msg):
+    """Wraps message into JSON response with 500 Interal server error status"""
+    return _get_response(msg, status=INTERNAL_SERVER_ERROR)
+
+
+async def _send_and_wait(values):
+    """Sends the given values to the controller as one command and waits until it"s applied or failed."""
+    try:
+        command_id = await redis_client.send_command(values)
+        with metrics.COMMAND_WAIT_DURATION.time():
+            acked = await redis_client.wait_for_ack(command_id, app.config["SET_AND_WAIT_TIMEOUT"])
+        if not acked:
+            metrics.COMMAND_TIMEOUTS.inc()
+        return acked
+    except Exception as e:
+        logger.error(str(e))
+
+
+def _get_unable_to_set_response(values):
+    """Wraps failed command into error response"""
+    return _get_error_response(get_unable_to_set_msg(values))
+
+
+async def _run_command(values, msg):
+    """Sends a command if there's anything to change and wraps its result into response"""
+    if values and not await _send_and_wait(values):
+        return _get_unable_to_set_response(values)
+    return _get_response(msg)
+
+
+@app.before_serving
+async def warm_up():
+    """Reads services statuses off the event loop, pystemd calls are blocking"""
+    await asyncio.to_thread(systemd_statuses.get_statuses)
+
+
+@app.before_request
+async def check_zone():
+    """Rejects requests addressing unknown zones"""
+    if request.view_args and get_zone(request.view_args.get("zone_id", DEFAULT_ZONE)) is None:
+        return _get_response(app.config["UNKNOWN_ZONE_MSG"], status=NotFound.code)
+
+
+@app.before_request
+async def start_timer():
+    """Remembers when request handling has started"""
+    g.started = time.perf_counter()
+
+
+@app.after_request
+async def observe_request(response):
+    """Observes request handling duration"""
+    started = g.get("started")
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unknown"
+        metrics.HTTP_REQUEST_DURATION.labels(endpoint, request.method, response.status_code).observe(
+            time.perf_counter() - started)
+    return response
+
+
+@app.errorhandler(RequestError)
+async def handle_request_error(e):
+    """Answers requests the app can't serve by their message"""
+    return _get_response(e.msg, status=e.status)
+
+
+@app.route("/get-average-temperature", methods=["GET"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/get-average-temperature", methods=["GET"])
+async def get_avg_temp(zone_id):
+    """Returns average pad temperature, it's answered by 304 Not Modified until the state changes"""
+    etag = get_stats_etag(await redis_client.get_state_version(), zone_id, ("avg_temperature",))
+    not_modified = get_not_modified_response(request, Response, etag)
+    if not_modified is not None:
+        return not_modified
+
+    state = await redis_client.snapshot(zone_id, fans=False)
+    return tag_response(Response(str(get_state_average_temperature(state))), etag)
+
+
+@app.route("/pwm/enable/<string:mode>", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/enable/<string:mode>", methods=["POST"])
+async def pwm_enable(mode, zone_id):
+    """Enables PWM pad controls"""
+    mode = parse_mode(mode)
+    return await _run_command(*get_pwm_enable_command(await redis_client.snapshot(zone_id), zone_id, mode))
+
+
+@app.route("/pwm/disable", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/disable", methods=["POST"])
+async def pwm_disable(zone_id):
+    """Disables PWM pad controls"""
+    return await _run_command(*get_pwm_disable_command(await redis_client.snapshot(zone_id), zone_id))
+
+
+@app.route("/pwm/set-temp-threshold/<string:threshold>", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/set-temp-threshold/<string:threshold>", methods=["POST"])
+async def pwm_set_temp_threshold(threshold, zone_id):
+    """Sets fan"s enabling temperature threshold"""
+    return await _run_command(*get_threshold_command(zone_id, parse_threshold(threshold)))
+
+
+@app.route("/pwm/set-duty/<string:percent>", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/set-duty/<string:percent>", methods=["POST"])
+async def pwm_set_duty(percent, zone_id):
+    """Sets PWM duty cycle"""
+    percent = parse_duty(percent)
+    return await _run_command(*get_set_duty_command(await redis_client.snapshot(zone_id), zone_id, percent))
+
+
+@app.route("/pwm/stop-fans", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/pwm/stop-fans", methods=["POST"])
+async def stop_fans(zone_id):
+    """Explicitly stops fans"""
+    return await _run_command(*get_stop_fans_command(await redis_client.snapshot(zone_id), zone_id))
+
+
+@app.route("/lights/on", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/lights/on", methods=["POST"])
+async def lights_on(zone_id):
+    """Turns light on"""
+    return await _run_command(*get_lights_command(await redis_client.snapshot(zone_id), zone_id, True))
+
+
+@app.route("/lights/off", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/lights/off", methods=["POST"])
+async def lights_off(zone_id):
+    """Turns light off"""
+    return await _run_command(*get_lights_command(await redis_client.snapshot(zone_id), zone_id, False))
+
+
+async def _get_states(zone_ids):
+    """Returns states of the given zones by zone id read at once"""
+    return dict(zip(zone_ids, await redis_client.snapshots([get_zone(zone_id) for zone_id in zone_ids])))
+
+
+@app.route("/control", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/control", methods=["POST"])
+async def control(zone_id):
+    """Applies JSON document of desired controls of one or many zones with a single command"""
+    controls = parse_control_request(await request.get_json(silent=True), zone_id)
+    values = get_control_command(await _get_states(list(controls)), controls)
+    if not values:
+        return _get_response(app.config["NO_ACTION_MSG"])
+    if not await _send_and_wait(values):
+        return _get_unable_to_set_response(values)
+
+    # Acknowledged command's state is already published, so it tells what's been applied
+    return jsonify({
+        "status": app.config["CONTROL_SET_MSG"],
+        "zones": get_applied_controls(await _get_states(list(controls)), controls),
+    })
+
+
+@app.route("/admin/reset", methods=["POST"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/admin/reset", methods=["POST"])
+async def admin_reset(zone_id):
+    """Restores default controls, PWM and lights get disabled"""
+    return await _run_command(*get_reset_command(zone_id))
+
+
+@app.route("/profiles", methods=["GET"])
+async def profiles_json():
+    """Returns all the scheduled profiles by name"""
+    return jsonify(get_formatted_profiles(await redis_client.get_profiles()))
+
+
+@app.route("/profiles/preview", methods=["GET"])
+async def profiles_preview():
+    """Returns upcoming transitions of the scheduled profiles"""
+    hours = parse_preview_hours(request.args)
+    return jsonify(get_profiles_preview(await redis_client.get_profiles(), hours))
+
+
+@app.route("/profiles/<string:name>", methods=["GET"])
+async def profile_json(name):
+    """Returns a scheduled profile"""
+    return jsonify(get_formatted_profile(await redis_client.get_profiles(), name))
+
+
+@app.route("/profiles/<string:name>", methods=["PUT"])
+async def profile_set(name):
+    """Creates or replaces a scheduled profile, the controller picks it up before the response"""
+    profile = parse_profile_request(name, await request.get_json(silent=True))
+    await redis_client.set_profile(name, dump_profile(profile))
+    if not await _send_and_wait({}):
+        return _get_unable_to_set_response([name])
+    return jsonify({"status": app.config["PROFILE_SET_MSG"], "profile": format_profile(profile)})
+
+
+@app.route("/profiles/<string:name>", methods=["DELETE"])
+async def profile_delete(name):
+    """Deletes a scheduled profile"""
+    if not await redis_client.delete_profile(name):
+        return _get_response(app.config["PROFILE_NOT_FOUND_MSG"], status=NotFound.code)
+    if not await _send_and_wait({}):
+        return _get_unable_to_set_response([name])
+    return _get_response(app.config["PROFILE_DELETED_MSG"])
+
+
+@app.route("/stats", methods=["GET"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/stats", methods=["GET"])
+async def stats_json(zone_id):
+    """Returns overal stats in JSON, only the sections given by ?fields=sensors,fans if they're selected.
+
+    Stats are answered by 304 Not Modified until the state changes.
+    """
+    fields = parse_stats_request(request.args)
+
+    # Version is read ahead of the state, so a change in between only makes the next request read it again
+    etag = get_stats_etag(await redis_client.get_state_version(), zone_id, fields)
+    not_modified = get_not_modified_response(request, Response, etag)
+    if not_modified is not None:
+        return not_modified
+
+    state = await redis_client.snapshot(zone_id, sensors="sensors" in fields, fans="fans" in fields)
+    return tag_response(jsonify(get_stats(get_zone(zone_id), state, fields)), etag)
+
+
+@app.route("/zones", methods=["GET"])
+async def zones_json():
+    """Returns all the zones along with their settings"""
+    return jsonify([zone._asdict() for zone in get_zones()])
+
+
+@app.route("/stats/stream", methods=["GET"])
+async def stats_stream():
+    """Streams overal stats as Server-Sent Events, clients share a single subscription of the process"""
+    response = Response(stats_broadcaster.stream(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.timeout = None
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+async def metrics_text():
+    """Returns metrics of all the services in Prometheus text format"""
+    data, content_type = await asyncio.to_thread(metrics.render)
+    return Response(data, mimetype=content_type)
+
+
+@app.route("/history", methods=["GET"], defaults={"zone_id": DEFAULT_ZONE})
+@app.route("/zones/<string:zone_id>/history", methods=["GET"])
+async def history_json(zone_id):
+    """Returns sensors readings and fans duty history of a given time range in a resolution fitting it"""
+    start, end, resolution = parse_history_request(request.args)
+    resolution, points = await async_read_history(redis_client, start, end, resolution=resolution, zone_id=zone_id)
+    return jsonify({
+        "start": start,
+        "end": end,
+        "resolution": resolution,
+        "points": points,
+    })
+
+
+@app.route("/")
+async def index():
+    """Index page of the default zone"""
+    data, paths = get_index_data(await redis_client.snapshot())
+    return await render_template("index.html", data=data, paths=paths)
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0")
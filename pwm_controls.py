@@ -1,129 +1,399 @@
-import time
 import sys
+import time
 import atexit
-import RPi.GPIO as GPIO
 
+import metrics
 import settings
 
-from redis_client import RedisClient
+from redis import RedisError
+
+from checkpoint import Checkpoint
+from control_engine import get_engine
+from control_fields import CONTROL_FIELDS
+from fans import estimate_zone_rpm
+from hardware import get_backend
+from history import HistoryRecorder
+from redis_client import STATE_KEYS, get_client
+from sample_log import STATUS_DECISION, get_sample_log
+from schedule import Scheduler, load_profiles
+from state_publisher import StatePublisher
+from tach import StallDetector, TachCounter
+from temperature_filter import get_average_temperature
+from zones import get_fan_keys, get_sensor_keys, get_zone_defaults, get_zones, zone_key
 from logger import logger
 
-# GPIO initials
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
+# Redis client wrapper, the control law keeps running off the last known state while Redis is unavailable
+redis_client = get_client(fallback=True)
 
-# Redis client wrapper
-redis_client = RedisClient()
+# Writes of a tick are coalesced and published at once
+state_publisher = StatePublisher(redis_client)
 
-# Globals
-fans = None
-lights = None
+# Controls state the controller resumes from after a restart, duty of automatic modes is only saved now and then
+checkpoint = Checkpoint(volatile_keys=[zone_key(zone.id, settings.CURR_PWM_DUTY) for zone in get_zones()])
 
-def _stop_pwm_control():
-    """Stops fans and does a cleanup"""
-    global fans, lights
-    if fans:
-        fans.stop()
-        fans = None
-    
-    if lights:
-        lights.stop()
-        lights = None
+# Scheduled profiles, they're only changed along with commands
+scheduler = Scheduler()
 
-    GPIO.cleanup()
+# Every decision of the controller
+sample_log = get_sample_log("pwm_controls")
 
+# Monotonic time the loop has last started an iteration at, the supervisor tells a hung loop by it
+heartbeat = None
+
+# Zone's keys the controller is woken up by
+WATCHED_ZONE_KEYS = (
+    settings.NEW_PWM_ENABLED,
+    settings.NEW_LIGHTS_ENABLED,
+    settings.NEW_CTRL_MODE,
+    settings.NEW_PWM_DUTY,
+    settings.NEW_TEMP_THRESHOLD,
+)
+
+
+def get_safe_duty(duty):
+    """Clamps duty into 0..100 percent, PWM outputs raise on anything else"""
+    if duty is None or CONTROL_FIELDS["duty"](duty):
+        return duty
+    return max(0, min(100, int(duty)))
+
+
+class ZoneController:
+
+    """Drives PWM outputs of a single zone"""
+
+    def __init__(self, zone):
+        self.zone = zone
+        self._fans = []
+        self._fans_duty = None
+        self._lights = None
+        self._engine = None
+        self._engine_mode = None
+        self._resumed = False
+        self._history_recorder = HistoryRecorder(zone.id)
+        self._tachs = []
+        for fan, rpm_k, stalled_k in get_fan_keys(zone):
+            if fan.tach_pin is not None:
+                tach = TachCounter()
+                get_backend().tach_input(fan.tach_pin, tach.pulse)
+                self._tachs.append((fan, rpm_k, stalled_k, tach, StallDetector()))
+
+
+    def _key(self, k):
+        return zone_key(self.zone.id, k)
+
+
+    def watched_keys(self):
+        """Returns zone's keys the controller should be woken up by"""
+        keys = [self._key(k) for k in WATCHED_ZONE_KEYS]
+        # Read times change along with the temperatures, heartbeats tell stale sensors of a dead daemon
+        for _, temp_k, quality_k, _, _ in get_sensor_keys(self.zone):
+            keys.extend([temp_k, quality_k])
+        return keys
 
-def run_pwm_controls():
-    global fans, lights
-    while True:
-        # Time to sleep
-        time.sleep(settings.PWM_CTRL_TIMEOUT)
-
-        # Get all values
-        pwm_enabled = redis_client.pwm_enabled
-        new_pwm_enabled = redis_client.new_pwm_enabled
-        lights_enabled = redis_client.lights_enabled
-        new_lights_enabled = redis_client.new_lights_enabled
-        curr_ctrl_mode = redis_client.current_ctrl_mode
-        new_ctrl_mode = redis_client.new_ctrl_mode
-        curr_pwm_duty = redis_client.current_pwm_duty
-        new_pwm_duty = redis_client.new_pwm_duty
-        curr_t1_temp = redis_client.current_t1_temperature
-        curr_t2_temp = redis_client.current_t2_temperature
-        curr_temp_threshold = redis_client.current_temperature_threshold
-        new_temp_threshold = redis_client.new_temperature_threshold
+
+    def _start_fans(self, duty=settings.PWM_DEFAULT_DUTY):
+        for pin in self.zone.fans_pins:
+            try:
+                fans = get_backend().pwm_output(pin, settings.PWM_DEFAULT_FREQ)
+                fans.start(duty)
+                self._fans.append(fans)
+            except RuntimeError as e:
+                logger.error(str(e))
+        self._fans_duty = duty
+
+
+    def _start_lights(self):
+        if not self._lights:
+            self._lights = get_backend().pwm_output(self.zone.lights_pin, settings.LIGHT_DEFAULT_FREQ)
+        self._lights.start(settings.LIGHTS_PWM_DEFAULT)
+
+
+    def _resume(self, state):
+        """Brings outputs back to the state the previous run has left, automatic modes go on from the applied duty"""
+        if state.lights_enabled and self.zone.lights_pin is not None:
+            self._start_lights()
+        if state.pwm_enabled:
+            duty = state.current_pwm_duty
+            duty = settings.PWM_DEFAULT_DUTY if duty is None else get_safe_duty(duty)
+            self._start_fans(duty)
+            self._engine = get_engine(state.current_ctrl_mode)
+            self._engine_mode = state.current_ctrl_mode
+            if self._engine:
+                self._engine.resume(duty)
+        self._resumed = True
+
+
+    def _stop_fans(self):
+        for fans in self._fans:
+            fans.stop()
+            fans.close()
+        self._fans = []
+        self._fans_duty = None
+
+
+    def _set_fans_duty(self, duty):
+        """Changes fans duty cycle, GPIO is only touched if the duty differs from the applied one"""
+        if self._fans and duty != self._fans_duty:
+            for fans in self._fans:
+                fans.change_duty(duty)
+                metrics.DUTY_CHANGES.labels(fans.pin).inc()
+            self._fans_duty = duty
+
+
+    def stop(self):
+        """Stops fans and lights"""
+        self._stop_fans()
+        if self._lights:
+            self._lights.stop()
+            self._lights = None
+
+
+    def apply_changes(self, state, now=None):
+        """Applies all pending changes of a given state snapshot in one pass, returns duty applied if PWM is enabled"""
+        pwm_enabled = state.pwm_enabled
+        new_pwm_enabled = state.new_pwm_enabled
+        lights_enabled = state.lights_enabled
+        new_lights_enabled = state.new_lights_enabled
+        curr_ctrl_mode = state.current_ctrl_mode
+        new_ctrl_mode = state.new_ctrl_mode
+        curr_pwm_duty = state.current_pwm_duty
+        new_pwm_duty = state.new_pwm_duty
+        avg_temp = get_average_temperature([(t, quality) for _, t, quality in state.sensors])
+        curr_temp_threshold = state.current_temperature_threshold
+        new_temp_threshold = state.new_temperature_threshold
+        state_publisher.observe({self._key(k): v for k, v in zip(STATE_KEYS, state)})
+
+        # Outputs are off on start, so a restart goes on from the state left rather than from scratch
+        if not self._resumed:
+            self._resume(state)
+
+        # Bad manual duty is corrected, so that it neither reaches the outputs nor is kept by the state
+        if get_safe_duty(new_pwm_duty) != new_pwm_duty:
+            logger.warning("Zone {} duty {} is out of range".format(self.zone.id, new_pwm_duty))
+            new_pwm_duty = get_safe_duty(new_pwm_duty)
+            state_publisher.set(self._key(settings.NEW_PWM_DUTY), new_pwm_duty)
 
         # Temperature threshold value has changed
         if curr_temp_threshold != new_temp_threshold:
-            redis_client.set_value(settings.CURR_TEMP_THRESHOLD, new_temp_threshold)
-            continue
+            state_publisher.set(self._key(settings.CURR_TEMP_THRESHOLD), new_temp_threshold)
+            curr_temp_threshold = new_temp_threshold
 
         # Lights state has changed
-        if lights_enabled != new_lights_enabled:
-            redis_client.set_value(settings.LIGHTS_ENABLED, new_lights_enabled)
+        if lights_enabled != new_lights_enabled and self.zone.lights_pin is not None:
+            state_publisher.set(self._key(settings.LIGHTS_ENABLED), new_lights_enabled)
             if new_lights_enabled == False:
-                if lights:
-                    lights.start(0)
+                if self._lights:
+                    self._lights.start(0)
             else:
-                GPIO.setmode(GPIO.BCM)
-                GPIO.setup(settings.LIGHTS_PIN, GPIO.OUT, initial=GPIO.LOW)
-                if not lights:
-                    lights = GPIO.PWM(settings.LIGHTS_PIN, settings.LIGHT_DEFAULT_FREQ)
-                lights.start(settings.LIGHTS_PWM_DEFAULT)
-            continue
+                self._start_lights()
 
         # PWM state has changed
         if pwm_enabled != new_pwm_enabled:
-            redis_client.set_value(settings.PWM_ENABLED, new_pwm_enabled)
+            state_publisher.set(self._key(settings.PWM_ENABLED), new_pwm_enabled)
             if new_pwm_enabled == False:
-                if fans:
-                    fans.stop()
-                GPIO.cleanup()
-                fans = None
+                self._stop_fans()
+                # Engine starts over next time PWM is enabled
+                self._engine_mode = None
             else:
-                GPIO.setmode(GPIO.BCM)
-                GPIO.setup(settings.FANS_PIN, GPIO.OUT, initial=GPIO.LOW)
-                try:
-                    fans = GPIO.PWM(settings.FANS_PIN, settings.PWM_DEFAULT_FREQ)
-                except RuntimeError as e:
-                    logger.error(str(e))
-                fans.start(settings.PWM_DEFAULT_DUTY)
-            continue
+                self._start_fans()
+            pwm_enabled = new_pwm_enabled
 
         # PWM is disabled, no need to go down below
         if pwm_enabled == False:
-            continue
+            return
 
         # PWM is enabled and control mode has changed
         if curr_ctrl_mode != new_ctrl_mode:
-            redis_client.set_value(settings.CURR_CTRL_MODE, new_ctrl_mode)
-            continue
+            state_publisher.set(self._key(settings.CURR_CTRL_MODE), new_ctrl_mode)
+            curr_ctrl_mode = new_ctrl_mode
 
         # Manual mode
         if curr_ctrl_mode == settings.MANUAL_MODE and curr_pwm_duty != new_pwm_duty:
-            redis_client.set_value(settings.CURR_PWM_DUTY, new_pwm_duty)
-            if fans:
-                fans.ChangeDutyCycle(new_pwm_duty)
-                continue
-
-        # Auto mode
-        if curr_ctrl_mode == settings.AUTO_MODE and curr_t1_temp and curr_t2_temp:
-            avg_temp = (curr_t1_temp + curr_t2_temp)/2
-            if fans:
-                if avg_temp > curr_temp_threshold + 2:
-                    fans.ChangeDutyCycle(100)
-                    redis_client.set_value(settings.CURR_PWM_DUTY, 100)
-                elif avg_temp > curr_temp_threshold+1:
-                    duty = settings.PWM_DEFAULT_DUTY + 5
-                    fans.ChangeDutyCycle(duty)
-                    redis_client.set_value(settings.CURR_PWM_DUTY, duty)
-                elif avg_temp > curr_temp_threshold:
-                    fans.ChangeDutyCycle(settings.PWM_DEFAULT_DUTY)
-                    redis_client.set_value(settings.CURR_PWM_DUTY, settings.PWM_DEFAULT_DUTY)
+            state_publisher.set(self._key(settings.CURR_PWM_DUTY), new_pwm_duty)
+            curr_pwm_duty = new_pwm_duty
+            self._set_fans_duty(new_pwm_duty)
+
+        # Automatic modes, duty is held if none of the sensors is good enough
+        if self._engine_mode != curr_ctrl_mode:
+            self._engine = get_engine(curr_ctrl_mode)
+            self._engine_mode = curr_ctrl_mode
+        if self._engine and avg_temp is not None and self._fans:
+            duty = self._engine.update(avg_temp, curr_temp_threshold, now=now)
+            self._set_fans_duty(duty)
+            # Mind that the controller's own writes must not be announced over and over again
+            if duty != curr_pwm_duty:
+                state_publisher.set(self._key(settings.CURR_PWM_DUTY), duty)
+                curr_pwm_duty = duty
+
+        return curr_pwm_duty
+
+
+    def check_tachs(self, state):
+        """Publishes measured RPM and stall alarm of fans having a tach, only values that have changed are written"""
+        # Fans run at full speed while PWM is disabled, too low duty may legitimately stop them
+        expected_running = self._fans_duty is None or self._fans_duty >= settings.TACH_STALL_MIN_DUTY
+        fans = {name: (rpm, stalled) for name, rpm, stalled in state.fans}
+        for fan, rpm_k, stalled_k, _, _ in self._tachs:
+            state_publisher.observe({rpm_k: fans[fan.name][0], stalled_k: fans[fan.name][1]})
+        for fan, rpm_k, stalled_k, tach, stall_detector in self._tachs:
+            rpm = tach.get_rpm()
+            stalled = stall_detector.update(rpm, expected_running)
+            curr_rpm, curr_stalled = fans[fan.name]
+            if rpm is not None and round(rpm) != curr_rpm:
+                state_publisher.set(rpm_k, round(rpm))
+            if stalled != curr_stalled:
+                state_publisher.set(stalled_k, stalled)
+                if stalled:
+                    logger.warning("Fan {} of zone {} has stalled, {} RPM".format(fan.name, self.zone.id, rpm))
                 else:
-                    fans.ChangeDutyCycle(0)
-                    redis_client.set_value(settings.CURR_PWM_DUTY, 0)
-                continue
+                    logger.info("Fan {} of zone {} is spinning again".format(fan.name, self.zone.id))
+
+
+    def log_decision(self, state, duty, now=None):
+        """Logs applied duty along with the average temperature it's based on, duty is None if PWM is disabled"""
+        avg_temp = get_average_temperature([(t, quality) for _, t, quality in state.sensors])
+        pin = self.zone.fans_pins[0] if self.zone.fans_pins else 0
+        sample_log.append(pin, avg_temp, STATUS_DECISION, duty=duty, ts=now)
+
+
+    def get_history_entries(self, state, duty, now=None):
+        """Returns history entries of applied duty along with sensors readings"""
+        sample = {name: t for name, t, _ in state.sensors}
+        sample["duty"] = duty
+        for name, rpm in estimate_zone_rpm(self.zone, duty is not None, duty).items():
+            sample["rpm_{}".format(name)] = rpm
+        return self._history_recorder.record(sample, ts=now)
+
+
+# Controllers of all the zones run by a single loop
+controllers = [ZoneController(zone) for zone in get_zones()]
+
+# Controls keys of all the zones kept by the checkpoint
+CHECKPOINT_KEYS = tuple(k for zone in get_zones() for k in get_zone_defaults(zone))
+
+# Keys the controller is woken up by
+WATCHED_KEYS = tuple(k for controller in controllers for k in controller.watched_keys()) + (settings.COMMANDS_KEY,)
+
+
+def _stop_pwm_control():
+    """Stops fans and does a cleanup"""
+    for controller in controllers:
+        controller.stop()
+    sample_log.close()
+
+    get_backend().cleanup()
+
+
+def run_pwm_controls_tick(now=None):
+    """Runs a single controller iteration over all the zones, returns duties applied by zone id"""
+    # Commands are taken before the snapshot, so that their values are already visible in it
+    try:
+        command_ids = redis_client.pop_commands()
+    except RedisError as e:
+        logger.warning("Unable to take commands: {}".format(e))
+        command_ids = []
+
+    if command_ids or not scheduler.loaded:
+        try:
+            raw_profiles = redis_client.get_profiles()
+            scheduler.load(load_profiles(raw_profiles[name] for name in sorted(raw_profiles)))
+        except RedisError as e:
+            logger.warning("Unable to load profiles: {}".format(e))
+
+    # Profile transition goes ahead of the snapshot, so that it's applied by this very tick. Mind that the values
+    # might have been changed by commands since they were seen, so they're written anyway.
+    due_values = scheduler.get_due_values(now)
+    if due_values:
+        logger.info("Applying scheduled {}".format(due_values))
+        for k, v in due_values.items():
+            state_publisher.set(k, v, force=True)
+        try:
+            state_publisher.flush()
+        except RedisError as e:
+            logger.warning("Unable to apply scheduled values: {}".format(e))
+
+    states = redis_client.snapshots([controller.zone for controller in controllers])
+
+    duties = {}
+    history_entries = []
+    for controller, state in zip(controllers, states):
+        duty = controller.apply_changes(state, now=now)
+        duties[controller.zone.id] = duty
+        controller.check_tachs(state)
+        controller.log_decision(state, duty, now=now)
+        history_entries.extend(controller.get_history_entries(state, duty, now=now))
+
+    # Whole state of the tick becomes visible at once and before the commands are acknowledged. Unpublished
+    # values are kept by the publisher and reconciled once Redis is back.
+    try:
+        state_publisher.flush()
+        if command_ids:
+            redis_client.ack_commands(command_ids)
+        redis_client.append_streams(history_entries)
+    except RedisError as e:
+        logger.warning("Unable to publish state: {}".format(e))
+
+    sample_log.flush()
+
+    # Checkpoint follows the applied state even while Redis is unavailable
+    values = {k: state_publisher.get(k) for k in CHECKPOINT_KEYS}
+    checkpoint.save({k: v for k, v in values.items() if v is not None})
+    return duties
+
+
+def restore_state():
+    """Fills controls keys Redis doesn't have from the checkpoint, defaults go for keys it doesn't have either"""
+    saved = checkpoint.load()
+    values = {}
+    for zone in get_zones():
+        for k, v in get_zone_defaults(zone).items():
+            values[k] = saved.get(k, v)
+    restored = redis_client.set_missing_values(values)
+    if restored:
+        logger.info("Restored {} of controls keys".format(", ".join(restored)))
+
+
+def _subscribe():
+    """Subscribes to state changes and restores anything Redis might have lost meanwhile"""
+    pubsub = None
+    try:
+        pubsub = redis_client.subscribe()
+        restore_state()
+        return pubsub
+    except RedisError as e:
+        logger.warning("Unable to subscribe to state changes: {}".format(e))
+        if pubsub is not None:
+            pubsub.close()
+
+
+def run_pwm_controls():
+    global heartbeat
+    # Subscribe before the first read, so that no change slips in between
+    pubsub = _subscribe()
+    backoff = settings.REDIS_BACKOFF_SECONDS
+    while True:
+        heartbeat = time.monotonic()
+        try:
+            with metrics.LOOP_DURATION.labels("pwm_controls").time():
+                run_pwm_controls_tick()
+
+            # Sleep until a command or a new temperature arrives, fall back to a heartbeat poll
+            if pubsub is None:
+                raise RedisError("Not subscribed to state changes")
+            timeout = settings.PWM_CTRL_HEARTBEAT
+            seconds_to_next = scheduler.get_seconds_to_next()
+            if seconds_to_next is not None:
+                timeout = min(timeout, seconds_to_next)
+            redis_client.wait_for_changes(pubsub, timeout, keys=WATCHED_KEYS)
+            backoff = settings.REDIS_BACKOFF_SECONDS
+        except RedisError as e:
+            # Redis is gone, the loop goes on backing off until it's back
+            logger.warning("Redis is unavailable, retrying in {}s: {}".format(backoff, e))
+            time.sleep(backoff)
+            backoff = min(backoff*2, settings.REDIS_MAX_BACKOFF_SECONDS)
+            if pubsub is not None:
+                pubsub.close()
+            pubsub = _subscribe()
 
 
 # Do a clean-up
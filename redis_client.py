@@ -1,79 +1,429 @@
+import os
+import time
+import uuid
 import redis
 
+from collections import namedtuple
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+import metrics
 import settings
 
-class RedisClient:
+from temperature_filter import QUALITY_STALE, get_sensor_quality
+from zones import get_fan_keys, get_sensor_keys, get_zone, zone_key
+from logger import logger
 
-    """Wrapper class for redis client"""
+# Zone's state keys along with their types. Mind that the order defines the order of State fields.
+STATE_TYPES = (
+    (settings.PWM_ENABLED, bool),
+    (settings.NEW_PWM_ENABLED, bool),
+    (settings.LIGHTS_ENABLED, bool),
+    (settings.NEW_LIGHTS_ENABLED, bool),
+    (settings.CURR_CTRL_MODE, str),
+    (settings.NEW_CTRL_MODE, str),
+    (settings.CURR_PWM_DUTY, int),
+    (settings.NEW_PWM_DUTY, int),
+    (settings.CURR_TEMP_THRESHOLD, float),
+    (settings.NEW_TEMP_THRESHOLD, float),
+)
+STATE_KEYS = [k for k, _ in STATE_TYPES]
 
-    def __init__(self, user=None, password=None, host="localhost", port=6379, db=0):
-        self._conn = redis.Redis(host=host, port=port, db=db, charset="utf-8", decode_responses=True)
+# Immutable view of all the zone's state keys read at once, sensors are (name, temperature, quality) of each sensor,
+# fans are (name, measured RPM, stall alarm) of each fan, either of them is None unless it's been read
+State = namedtuple("State", STATE_KEYS + ["sensors", "fans"])
 
 
-    def _set(self, k, v):
-        self._conn.set(k, v)
+_STATE_TYPES = dict(STATE_TYPES)
 
 
-    def _get(self, k):
-        return self._conn.get(k)
+def _get_typed_value(v, t):
+    try:
+        return t(v)
+    except (TypeError, ValueError):
+        return None
 
 
-    def _get_typed_value(self, v, t):
-        try:
-            return t(v)
-        except (TypeError, ValueError):
-            return None
+def parse_value(k, v):
+    """Converts raw redis value of a given state key into its type"""
+    t = _STATE_TYPES[k]
+    if t == bool:
+        return v == "True"
+    if t == str:
+        return v
+    return _get_typed_value(v, t)
 
 
-    def set_value(self, k, v):
-        if type(v) != str:
-            v = str(v)
-        self._set(k, v)
+def get_zone_keys(zone, sensors=True, fans=True):
+    """Returns zone's state keys followed by keys of each of its sensors and fans if they're asked for"""
+    keys = [zone_key(zone.id, k) for k in STATE_KEYS]
+    if sensors:
+        for _, temp_k, quality_k, read_at_k, _ in get_sensor_keys(zone):
+            keys.extend([temp_k, quality_k, read_at_k])
+    if fans:
+        for _, rpm_k, stalled_k in get_fan_keys(zone):
+            keys.extend([rpm_k, stalled_k])
+    return keys
+
+
+def parse_state(zone, values, sensors=True, fans=True, now=None):
+    """Converts raw values of get_zone_keys() into State, sensors read too long ago are stale"""
+    n = len(STATE_KEYS)
+    sensors_values = None
+    if sensors:
+        sensors_values = []
+        for i, (name, _) in enumerate(zone.sensors):
+            t, quality, read_at = values[n + 3*i:n + 3*i + 3]
+            quality = get_sensor_quality(quality, _get_typed_value(read_at, float), now)
+            sensors_values.append((name, _get_typed_value(t, float), quality))
+        sensors_values = tuple(sensors_values)
+        n += 3*len(zone.sensors)
+    fans_values = None
+    if fans:
+        fans_values = []
+        for i, fan in enumerate(zone.fans):
+            rpm, stalled = values[n + 2*i], values[n + 2*i + 1]
+            fans_values.append((fan.name, _get_typed_value(rpm, int), stalled == "True"))
+        fans_values = tuple(fans_values)
+    return State(*[parse_value(k, v) for k, v in zip(STATE_KEYS, values)], sensors_values, fans_values)
+
+
+def parse_state_version(v):
+    """Converts raw value of the state version counter, it's 0 until anything is written"""
+    return _get_typed_value(v, int) or 0
+
+
+def queue_command(pipe, values):
+    """Queues writes of the given values along with a command for the controller to acknowledge on a pipeline.
+
+    Sync and asyncio clients share it, returns id of the command to wait for once the pipeline is executed.
+    """
+    command_id = uuid.uuid4().hex
+    # Command without values just makes the controller reload what it keeps aside, e.g. profiles
+    if values:
+        pipe.mset({k: str(v) for k, v in values.items()})
+        pipe.incr(settings.STATE_VERSION_KEY)
+    pipe.rpush(settings.COMMANDS_KEY, command_id)
+    for k in values:
+        pipe.publish(settings.STATE_CHANNEL, k)
+    pipe.publish(settings.STATE_CHANNEL, settings.COMMANDS_KEY)
+    return command_id
+
+
+def wait_for_messages(timeout, keys=None):
+    """Drives a wait for changes of the given keys shared by sync and asyncio clients.
+
+    Yields how long to wait for the next pub/sub message and takes the message back, None if there's none.
+    Drains all the notifications queued so far, so that a burst of changes wakes the caller up only once.
+    Returns True if anything of interest has changed.
+    """
+    deadline = time.monotonic() + timeout
+    changed = False
+    while True:
+        wait = 0 if changed else deadline - time.monotonic()
+        if wait < 0:
+            return changed
+        message = yield wait
+        if message is None:
+            if changed or time.monotonic() >= deadline:
+                return changed
+            continue
+        if keys is None or message["data"] in keys:
+            changed = True
+
+
+def get_pool_options(retry_class=Retry):
+    """Returns timeouts and retry policy of connection pools, asyncio ones pass their own Retry class"""
+    return {
+        "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": settings.REDIS_CONNECT_TIMEOUT,
+        "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL,
+        "retry": retry_class(
+            ExponentialBackoff(cap=settings.REDIS_MAX_BACKOFF_SECONDS, base=settings.REDIS_BACKOFF_SECONDS),
+            settings.REDIS_RETRIES,
+        ),
+        "retry_on_error": [redis.ConnectionError, redis.TimeoutError],
+        "encoding": "utf-8",
+        "decode_responses": True,
+    }
+
+
+# Connection pools by URL, pools don't survive forks, so they are kept per process
+_pools = {}
+
+
+def _get_pool(url):
+    """Returns connection pool of a given URL shared by all the clients of the current process"""
+    k = (url, os.getpid())
+    if k not in _pools:
+        _pools[k] = redis.BlockingConnectionPool.from_url(
+            url,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            **get_pool_options()
+        )
+    return _pools[k]
+
+
+class StateProperties:
+
+    """Default zone's state keys read one at a time by the clients' _get() and _get_state_value()"""
 
     @property
     def lights_enabled(self):
-        return True if self._get(settings.LIGHTS_ENABLED) == "True" else False
+        return self._get_state_value(settings.LIGHTS_ENABLED)
 
     @property
     def new_lights_enabled(self):
-        return True if self._get(settings.NEW_LIGHTS_ENABLED) == "True" else False
+        return self._get_state_value(settings.NEW_LIGHTS_ENABLED)
 
     @property
     def pwm_enabled(self):
-        return True if self._get(settings.PWM_ENABLED) == "True" else False
+        return self._get_state_value(settings.PWM_ENABLED)
 
     @property
     def new_pwm_enabled(self):
-        return True if self._get(settings.NEW_PWM_ENABLED) == "True" else False
+        return self._get_state_value(settings.NEW_PWM_ENABLED)
 
     @property
     def current_ctrl_mode(self):
-        return self._get(settings.CURR_CTRL_MODE)
+        return self._get_state_value(settings.CURR_CTRL_MODE)
 
     @property
     def new_ctrl_mode(self):
-        return self._get(settings.NEW_CTRL_MODE)
+        return self._get_state_value(settings.NEW_CTRL_MODE)
 
     @property
     def current_pwm_duty(self):
-        return self._get_typed_value(self._get(settings.CURR_PWM_DUTY), int)
+        return self._get_state_value(settings.CURR_PWM_DUTY)
 
     @property
     def new_pwm_duty(self):
-        return self._get_typed_value(self._get(settings.NEW_PWM_DUTY), int)
-
-    @property
-    def current_t1_temperature(self):
-        return self._get_typed_value(self._get(settings.CURR_T1_TEMP), float)
-
-    @property
-    def current_t2_temperature(self):
-        return self._get_typed_value(self._get(settings.CURR_T2_TEMP), float)
+        return self._get_state_value(settings.NEW_PWM_DUTY)
 
     @property
     def current_temperature_threshold(self):
-        return self._get_typed_value(self._get(settings.CURR_TEMP_THRESHOLD), float)
+        return self._get_state_value(settings.CURR_TEMP_THRESHOLD)
 
     @property
     def new_temperature_threshold(self):
-        return self._get_typed_value(self._get(settings.NEW_TEMP_THRESHOLD), float)
+        return self._get_state_value(settings.NEW_TEMP_THRESHOLD)
+
+
+class RedisClient(StateProperties):
+
+    """Wrapper class for redis client.
+
+    With fallback enabled snapshots are served from the last known good ones while Redis is unavailable,
+    sensors of those get stale once they are older than TEMP_FILTER_STALE_SECONDS.
+    """
+
+    def __init__(self, url=None, fallback=False):
+        self._conn = redis.Redis(connection_pool=_get_pool(url or settings.REDIS_URL))
+        self._fallback = fallback
+        self._last_snapshots = {}
+
+
+    @metrics.redis_call("set")
+    def _set(self, k, v):
+        pipe = self._conn.pipeline(transaction=False)
+        pipe.set(k, v)
+        pipe.incr(settings.STATE_VERSION_KEY)
+        pipe.publish(settings.STATE_CHANNEL, k)
+        pipe.execute()
+
+
+    @metrics.redis_call("set_values")
+    def set_values(self, values):
+        """Atomically writes the given values with one round trip and announces each of them"""
+        pipe = self._conn.pipeline()
+        pipe.mset({k: str(v) for k, v in values.items()})
+        pipe.incr(settings.STATE_VERSION_KEY)
+        for k in values:
+            pipe.publish(settings.STATE_CHANNEL, k)
+        pipe.execute()
+
+
+    @metrics.redis_call("set_missing_values")
+    def set_missing_values(self, values):
+        """Writes only those of the given values whose keys don't exist, returns the written keys"""
+        pipe = self._conn.pipeline()
+        for k, v in values.items():
+            pipe.set(k, str(v), nx=True)
+        written = [k for k, ok in zip(values, pipe.execute()) if ok]
+        if written:
+            pipe = self._conn.pipeline(transaction=False)
+            pipe.incr(settings.STATE_VERSION_KEY)
+            for k in written:
+                pipe.publish(settings.STATE_CHANNEL, k)
+            pipe.execute()
+        return written
+
+
+    @metrics.redis_call("get")
+    def _get(self, k):
+        return self._conn.get(k)
+
+
+    def _get_state_value(self, k):
+        return parse_value(k, self._get(k))
+
+
+    def set_value(self, k, v):
+        if type(v) != str:
+            v = str(v)
+        self._set(k, v)
+
+
+    def _get_last_snapshots(self, zones):
+        """Returns the last known good states of the given zones, their sensors are stale if they're too old"""
+        states = []
+        for zone in zones:
+            state, read_at = self._last_snapshots[zone.id]
+            if time.monotonic() - read_at > settings.TEMP_FILTER_STALE_SECONDS:
+                state = state._replace(sensors=tuple((name, t, QUALITY_STALE) for name, t, _ in state.sensors))
+            states.append(state)
+        return states
+
+
+    @metrics.redis_call("get_state_version")
+    def get_state_version(self):
+        """Returns counter of state writes, it's bumped by every one of them"""
+        return parse_state_version(self._get(settings.STATE_VERSION_KEY))
+
+
+    @metrics.redis_call("snapshot")
+    def snapshots(self, zones, sensors=True, fans=True):
+        """Reads state of all the given zones with a single MGET and returns them as immutable States.
+
+        Sensors and fans are only read if they're asked for, the last known snapshots keep the full ones only.
+        """
+        zones_keys = [get_zone_keys(zone, sensors, fans) for zone in zones]
+        try:
+            values = self._conn.mget([k for keys in zones_keys for k in keys])
+        except redis.RedisError as e:
+            if not self._fallback or any(zone.id not in self._last_snapshots for zone in zones):
+                raise
+            logger.warning("Redis is unavailable, using the last known state: {}".format(e))
+            return self._get_last_snapshots(zones)
+
+        states = []
+        read_at = time.monotonic()
+        for zone, keys in zip(zones, zones_keys):
+            state = parse_state(zone, values[:len(keys)], sensors, fans)
+            if sensors and fans:
+                self._last_snapshots[zone.id] = (state, read_at)
+            states.append(state)
+            values = values[len(keys):]
+        return states
+
+
+    def snapshot(self, zone_id=settings.DEFAULT_ZONE, sensors=True, fans=True):
+        """Reads state of a given zone with a single MGET and returns it as an immutable State"""
+        return self.snapshots([get_zone(zone_id)], sensors, fans)[0]
+
+
+    @metrics.redis_call("send_command")
+    def send_command(self, values):
+        """Atomically writes the given values and queues a command for the controller to acknowledge.
+
+        Returns id of the command to wait for.
+        """
+        pipe = self._conn.pipeline()
+        command_id = queue_command(pipe, values)
+        pipe.execute()
+        return command_id
+
+
+    @metrics.redis_call("get_profiles")
+    def get_profiles(self):
+        """Returns stored JSONs of all the scheduled profiles by name"""
+        return self._conn.hgetall(settings.PROFILES_KEY)
+
+
+    @metrics.redis_call("set_profile")
+    def set_profile(self, name, raw):
+        self._conn.hset(settings.PROFILES_KEY, name, raw)
+
+
+    @metrics.redis_call("delete_profile")
+    def delete_profile(self, name):
+        """Deletes a scheduled profile, returns False if there's no such one"""
+        return self._conn.hdel(settings.PROFILES_KEY, name) > 0
+
+
+    @metrics.redis_call("wait_for_ack")
+    def wait_for_ack(self, command_id, timeout):
+        """Blocks until the controller acknowledges a given command or timeout expires"""
+        return self._conn.blpop(settings.COMMAND_ACK_KEY.format(command_id), timeout=timeout) is not None
+
+
+    @metrics.redis_call("pop_commands")
+    def pop_commands(self):
+        """Takes all the queued commands ids"""
+        pipe = self._conn.pipeline()
+        pipe.lrange(settings.COMMANDS_KEY, 0, -1)
+        pipe.delete(settings.COMMANDS_KEY)
+        command_ids, _ = pipe.execute()
+        return command_ids
+
+
+    @metrics.redis_call("ack_commands")
+    def ack_commands(self, command_ids):
+        """Acknowledges given commands, replies expire if nobody waits for them anymore"""
+        pipe = self._conn.pipeline(transaction=False)
+        for command_id in command_ids:
+            k = settings.COMMAND_ACK_KEY.format(command_id)
+            pipe.rpush(k, 1)
+            pipe.expire(k, settings.COMMAND_ACK_TTL)
+        pipe.execute()
+
+
+    @metrics.redis_call("append_streams")
+    def append_streams(self, entries):
+        """Appends (key, fields, max length) entries to streams with one round trip"""
+        if not entries:
+            return
+        pipe = self._conn.pipeline(transaction=False)
+        for k, fields, maxlen in entries:
+            pipe.xadd(k, fields, maxlen=maxlen, approximate=True)
+        pipe.execute()
+
+
+    @metrics.redis_call("read_stream")
+    def read_stream(self, k, start_ms, end_ms):
+        """Returns fields of stream entries added within a given time range"""
+        return [fields for _, fields in self._conn.xrange(k, min=start_ms, max=end_ms)]
+
+
+    def subscribe(self):
+        """Returns pub/sub object subscribed to state changes"""
+        pubsub = self._conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(settings.STATE_CHANNEL)
+        return pubsub
+
+
+    def wait_for_changes(self, pubsub, timeout, keys=None):
+        """Blocks until any of the given keys changes or timeout expires, see wait_for_messages.
+
+        Returns True if anything of interest has changed.
+        """
+        waits = wait_for_messages(timeout, keys)
+        try:
+            wait = next(waits)
+            while True:
+                wait = waits.send(pubsub.get_message(timeout=wait))
+        except StopIteration as e:
+            return e.value
+
+
+def get_client(fallback=False):
+    """Returns client of the configured STATE_BACKEND, fallback only applies to Redis"""
+    # Other backends are built on top of this module
+    if settings.STATE_BACKEND == "shm":
+        from shm_state import ShmStateClient
+        return ShmStateClient()
+    if settings.STATE_BACKEND == "memory":
+        from memory_state import get_memory_client
+        return get_memory_client()
+    return RedisClient(fallback=fallback)
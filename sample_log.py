@@ -0,0 +1,367 @@
+"""Append-only binary log of raw sensors samples and controller decisions along with its reader.
+
+Log is a header followed by fixed-size records, so records are read by mapping the log into memory rather than
+loading it, e.g. weeks of samples are analysed off the Pi's SD card as they are:
+
+    python sample_log.py stats pi_fan_dht_sensors_samples.bin
+    python sample_log.py csv pi_fan_dht_sensors_samples.bin -o samples.csv --start 1700000000
+    python sample_log.py npy pi_fan_pwm_controls_samples.bin -o decisions.npy
+
+Rotated backups of a log are read along with it, the oldest first.
+"""
+import argparse
+import csv
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    # only the analysis needs it, the daemons just write logs
+    numpy = None
+
+import settings
+
+from logger import logger
+
+# Header of each log: magic, format version and record size. Mind to bump the version once the record changes.
+HEADER = struct.Struct("<4sHH")
+MAGIC = b"PFSL"
+VERSION = 1
+
+# Record: timestamp, pin, value, status, failed reads before it and duty. Missing value is NaN, missing duty is DUTY_NONE.
+RECORD = struct.Struct("<dHfBBB")
+RECORD_FIELDS = ("ts", "pin", "value", "status", "retries", "duty")
+DUTY_NONE = 255
+
+# Records statuses. Sensor's read either succeeds, fails, e.g. by a checksum error, or fails by an error resetting
+# the sensor. Controller's decision is duty it has applied to the pin along with the average temperature it's based on.
+STATUS_OK = 0
+STATUS_FAILED = 1
+STATUS_ERROR = 2
+STATUS_DECISION = 3
+STATUS_NAMES = {STATUS_OK: "ok", STATUS_FAILED: "failed", STATUS_ERROR: "error", STATUS_DECISION: "decision"}
+
+# Records are read in chunks of this many, so that iterating a log doesn't copy it whole
+READ_CHUNK_RECORDS = 64*1024
+
+
+def get_sample_log(name):
+    """Returns sample log of a daemon of a given name, it's disabled if there's no SAMPLE_LOG_PATH"""
+    return SampleLog(settings.SAMPLE_LOG_PATH.format(name) if settings.SAMPLE_LOG_PATH else None)
+
+
+def _read_header(path):
+    with open(path, "rb") as f:
+        return f.read(HEADER.size)
+
+
+class SampleLog:
+
+    """Buffered writer of a log rotated once it exceeds max bytes, backups are suffixed by .1 (the newest) to .N.
+
+    Records are only written by flush() or once the buffer fills up, it's a no-op if there's no path.
+    """
+
+    def __init__(self, path, max_bytes=None, backups=None):
+        self._path = path
+        self._max_bytes = max_bytes or settings.SAMPLE_LOG_MAX_BYTES
+        self._backups = settings.SAMPLE_LOG_BACKUPS if backups is None else backups
+        self._lock = threading.Lock()
+        self._f = None
+        self._size = 0
+
+
+    def _open(self):
+        # Log of another format is rotated away rather than appended to
+        if os.path.exists(self._path) and os.path.getsize(self._path) and \
+                _read_header(self._path) != HEADER.pack(MAGIC, VERSION, RECORD.size):
+            self._rotate_files()
+
+        self._f = open(self._path, "ab", buffering=settings.SAMPLE_LOG_BUFFER_BYTES)
+        self._size = self._f.tell()
+        if self._size == 0:
+            self._f.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            self._size = HEADER.size
+
+        # Record left half-written by a power loss would shift all the following ones
+        partial = (self._size - HEADER.size) % RECORD.size
+        if partial:
+            self._size -= partial
+            self._f.truncate(self._size)
+
+
+    def _rotate_files(self):
+        for i in range(self._backups - 1, 0, -1):
+            backup = "{}.{}".format(self._path, i)
+            if os.path.exists(backup):
+                os.replace(backup, "{}.{}".format(self._path, i + 1))
+        if self._backups:
+            os.replace(self._path, "{}.1".format(self._path))
+        else:
+            os.remove(self._path)
+
+
+    def _close(self):
+        if self._f is not None:
+            try:
+                self._f.close()
+            except OSError as e:
+                logger.error("Unable to close sample log {}: {}".format(self._path, e))
+            self._f = None
+
+
+    def append(self, pin, value, status, retries=0, duty=None, ts=None):
+        """Appends a record, missing value and duty are None"""
+        if self._path is None:
+            return
+        record = RECORD.pack(
+            time.time() if ts is None else ts,
+            pin,
+            math.nan if value is None else value,
+            status,
+            min(retries, 255),
+            DUTY_NONE if duty is None else duty,
+        )
+
+        with self._lock:
+            try:
+                if self._f is not None and self._size + RECORD.size > self._max_bytes:
+                    self._close()
+                    self._rotate_files()
+                if self._f is None:
+                    self._open()
+                self._f.write(record)
+                self._size += RECORD.size
+            except OSError as e:
+                # Log is opened again by the next record
+                logger.error("Unable to write sample log {}: {}".format(self._path, e))
+                self._close()
+
+
+    def flush(self):
+        with self._lock:
+            if self._f is not None:
+                try:
+                    self._f.flush()
+                except OSError as e:
+                    logger.error("Unable to write sample log {}: {}".format(self._path, e))
+                    self._close()
+
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._close()
+
+
+def get_log_paths(path):
+    """Returns paths of a log's rotated backups, the oldest first, followed by the log itself"""
+    paths = []
+    i = 1
+    while os.path.exists("{}.{}".format(path, i)):
+        paths.insert(0, "{}.{}".format(path, i))
+        i += 1
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+
+def get_records_count(path):
+    """Returns number of whole records of a log, raises ValueError if it isn't a log of the known format"""
+    if _read_header(path) != HEADER.pack(MAGIC, VERSION, RECORD.size):
+        raise ValueError("{} isn't a sample log of version {}".format(path, VERSION))
+    return (os.path.getsize(path) - HEADER.size) // RECORD.size
+
+
+def iter_records(path):
+    """Yields records of a log as tuples of RECORD_FIELDS reading them off its memory map"""
+    count = get_records_count(path)
+    if not count:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        end = HEADER.size + count*RECORD.size
+        chunk = READ_CHUNK_RECORDS*RECORD.size
+        for offset in range(HEADER.size, end, chunk):
+            yield from RECORD.iter_unpack(m[offset:min(offset + chunk, end)])
+
+
+def _get_dtype():
+    return numpy.dtype([
+        ("ts", "<f8"),
+        ("pin", "<u2"),
+        ("value", "<f4"),
+        ("status", "u1"),
+        ("retries", "u1"),
+        ("duty", "u1"),
+    ])
+
+
+def load_array(path):
+    """Returns records of a log as a read-only NumPy structured array mapped into memory"""
+    if numpy is None:
+        raise RuntimeError("NumPy is required to load sample logs as arrays")
+    count = get_records_count(path)
+    if not count:
+        return numpy.empty(0, dtype=_get_dtype())
+    return numpy.memmap(path, dtype=_get_dtype(), mode="r", offset=HEADER.size, shape=(count,))
+
+
+def _select(array, start=None, end=None):
+    if start is not None:
+        array = array[array["ts"] >= start]
+    if end is not None:
+        array = array[array["ts"] <= end]
+    return array
+
+
+def _get_total(totals, pin, status):
+    return totals.setdefault((int(pin), int(status)), {
+        "count": 0, "first_ts": math.inf, "last_ts": -math.inf, "retries_sum": 0,
+        "values_count": 0, "values_sum": 0.0, "value_min": math.inf, "value_max": -math.inf,
+        "duties_count": 0, "duties_sum": 0.0, "duty_min": math.inf, "duty_max": -math.inf,
+    })
+
+
+def _add_to_total(total, name, count, v_sum, v_min, v_max):
+    """Adds count, sum, min and max of either values or duties to the total"""
+    plural = "values" if name == "value" else "duties"
+    total["{}_count".format(plural)] += count
+    total["{}_sum".format(plural)] += v_sum
+    total["{}_min".format(name)] = min(total["{}_min".format(name)], v_min)
+    total["{}_max".format(name)] = max(total["{}_max".format(name)], v_max)
+
+
+def _add_array(totals, array):
+    """Adds records of a NumPy array to the totals"""
+    for pin in numpy.unique(array["pin"]):
+        pin_records = array[array["pin"] == pin]
+        for status in numpy.unique(pin_records["status"]):
+            records = pin_records[pin_records["status"] == status]
+            values = records["value"][~numpy.isnan(records["value"])].astype("f8")
+            duties = records["duty"][records["duty"] != DUTY_NONE].astype("f8")
+            total = _get_total(totals, pin, status)
+            total["count"] += len(records)
+            total["first_ts"] = min(total["first_ts"], float(records["ts"].min()))
+            total["last_ts"] = max(total["last_ts"], float(records["ts"].max()))
+            total["retries_sum"] += int(records["retries"].sum(dtype="u8"))
+            if len(values):
+                _add_to_total(total, "value", len(values), float(values.sum()), float(values.min()),
+                              float(values.max()))
+            if len(duties):
+                _add_to_total(total, "duty", len(duties), float(duties.sum()), float(duties.min()),
+                              float(duties.max()))
+
+
+def _add_records(totals, path, start=None, end=None):
+    """Adds records of a log to the totals a record at a time, it's the fallback if there's no NumPy"""
+    for ts, pin, value, status, retries, duty in iter_records(path):
+        if (start is not None and ts < start) or (end is not None and ts > end):
+            continue
+        total = _get_total(totals, pin, status)
+        total["count"] += 1
+        total["first_ts"] = min(total["first_ts"], ts)
+        total["last_ts"] = max(total["last_ts"], ts)
+        total["retries_sum"] += retries
+        if not math.isnan(value):
+            _add_to_total(total, "value", 1, value, value, value)
+        if duty != DUTY_NONE:
+            _add_to_total(total, "duty", 1, duty, duty, duty)
+
+
+def get_summary(paths, start=None, end=None):
+    """Returns stats of records of given logs by pin and status computed a log at a time.
+
+    Stats are records count, time span, value min/mean/max, mean failed reads before a record and duty min/mean/max.
+    Logs are summarized by NumPy if it's installed and record by record otherwise.
+    """
+    totals = {}
+    for path in paths:
+        if numpy is None:
+            _add_records(totals, path, start, end)
+        else:
+            _add_array(totals, _select(load_array(path), start, end))
+
+    summary = {}
+    for (pin, status), total in sorted(totals.items()):
+        stats = {
+            "count": total["count"],
+            "first_ts": total["first_ts"],
+            "last_ts": total["last_ts"],
+            "mean_retries": round(total["retries_sum"]/total["count"], 3),
+        }
+        if total["values_count"]:
+            stats["value_min"] = round(total["value_min"], 3)
+            stats["value_mean"] = round(total["values_sum"]/total["values_count"], 3)
+            stats["value_max"] = round(total["value_max"], 3)
+        if total["duties_count"]:
+            stats["duty_min"] = int(total["duty_min"])
+            stats["duty_mean"] = round(total["duties_sum"]/total["duties_count"], 3)
+            stats["duty_max"] = int(total["duty_max"])
+        summary.setdefault(str(pin), {})[STATUS_NAMES.get(status, str(status))] = stats
+    return summary
+
+
+def export_csv(paths, out, start=None, end=None):
+    """Writes records of given logs as CSV, missing values and duties are left empty"""
+    writer = csv.writer(out)
+    writer.writerow(RECORD_FIELDS)
+    for path in paths:
+        for ts, pin, value, status, retries, duty in iter_records(path):
+            if (start is not None and ts < start) or (end is not None and ts > end):
+                continue
+            writer.writerow([
+                ts,
+                pin,
+                "" if math.isnan(value) else round(value, 3),
+                STATUS_NAMES.get(status, status),
+                retries,
+                "" if duty == DUTY_NONE else duty,
+            ])
+
+
+def export_npy(paths, out, start=None, end=None):
+    """Saves records of given logs as a single NumPy structured array"""
+    arrays = [_select(load_array(path), start, end) for path in paths]
+    numpy.save(out, numpy.concatenate(arrays) if arrays else numpy.empty(0, dtype=_get_dtype()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["stats", "csv", "npy"], help="What to do with the records")
+    parser.add_argument("path", help="Sample log, its rotated backups are read along with it")
+    parser.add_argument("-o", "--output", help="Output file, CSV goes to stdout if it's not given")
+    parser.add_argument("--start", type=float, help="Skip records before this timestamp")
+    parser.add_argument("--end", type=float, help="Skip records after this timestamp")
+    parser.add_argument("--no-backups", action="store_true", help="Read the log only, not its rotated backups")
+    args = parser.parse_args()
+
+    paths = [args.path] if args.no_backups else get_log_paths(args.path)
+    if not paths:
+        parser.error("no such log {}".format(args.path))
+
+    try:
+        if args.command == "stats":
+            print(json.dumps(get_summary(paths, args.start, args.end), indent=2))
+        elif args.command == "csv":
+            if args.output:
+                with open(args.output, "w", newline="") as out:
+                    export_csv(paths, out, args.start, args.end)
+            else:
+                export_csv(paths, sys.stdout, args.start, args.end)
+        else:
+            if not args.output:
+                parser.error("npy needs an output file")
+            export_npy(paths, args.output, args.start, args.end)
+    except (RuntimeError, ValueError) as e:
+        parser.exit(1, "{}\n".format(e))
+
+
+if __name__ == "__main__":
+    main()
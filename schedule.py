@@ -0,0 +1,218 @@
+import json
+import time
+
+from bisect import bisect_right
+
+import settings
+
+from logger import logger
+from control_fields import CONTROL_KEYS, get_control_values, validate_control_fields
+from zones import get_zone, get_zone_defaults, zone_key
+
+MINUTES_PER_DAY = 24*60
+MINUTES_PER_WEEK = 7*MINUTES_PER_DAY
+
+
+def _parse_time(v):
+    """Returns minutes of the day of HH:MM time"""
+    try:
+        hours, minutes = (int(part) for part in v.split(":"))
+    except (AttributeError, ValueError):
+        raise ValueError("bad time {}".format(v))
+    if not (0 <= hours <= 24 and 0 <= minutes < 60) or hours*60 + minutes > MINUTES_PER_DAY:
+        raise ValueError("bad time {}".format(v))
+    return hours*60 + minutes
+
+
+def _format_time(minutes):
+    return "{:02d}:{:02d}".format(minutes // 60, minutes % 60)
+
+
+def parse_profile(name, document):
+    """Returns profile of a JSON document, raises ValueError describing what's wrong with it.
+
+    Profile sets controls fields of a zone from start till end time (HH:MM, end before start goes past midnight)
+    on given week days, 0 is Monday. Fields of overlapping profiles of a higher priority win.
+    """
+    if not isinstance(document, dict):
+        raise ValueError("JSON object expected")
+    unknown = set(document) - {"zone", "days", "start", "end", "priority", "settings"}
+    if unknown:
+        raise ValueError("unknown field {}".format(", ".join(sorted(unknown))))
+
+    zone_id = document.get("zone", settings.DEFAULT_ZONE)
+    if get_zone(zone_id) is None:
+        raise ValueError("unknown zone {}".format(zone_id))
+    days = document.get("days", list(range(7)))
+    if not isinstance(days, list) or not days or any(day not in range(7) for day in days):
+        raise ValueError("days must be a list of week days from 0 to 6")
+    priority = document.get("priority", 0)
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        raise ValueError("priority must be an integer")
+    profile_settings = document.get("settings")
+    validate_control_fields(profile_settings)
+    if not profile_settings:
+        raise ValueError("settings are empty")
+
+    return {
+        "name": name,
+        "zone": zone_id,
+        "days": sorted(set(days)),
+        "start": _parse_time(document.get("start")) % MINUTES_PER_DAY,
+        "end": _parse_time(document.get("end")) % MINUTES_PER_DAY,
+        "priority": priority,
+        "settings": profile_settings,
+    }
+
+
+def dump_profile(profile):
+    """Returns compact JSON of a profile to store"""
+    return json.dumps(profile, separators=(",", ":"))
+
+
+def load_profiles(raw_profiles):
+    """Returns profiles of their stored JSONs, broken ones are skipped"""
+    profiles = []
+    for raw in raw_profiles:
+        try:
+            profiles.append(json.loads(raw))
+        except ValueError as e:
+            logger.error("Skipping broken profile {}: {}".format(raw, e))
+    return profiles
+
+
+def format_profile(profile):
+    """Returns profile in the form it's accepted by the API"""
+    return dict(profile, start=_format_time(profile["start"]), end=_format_time(profile["end"]))
+
+
+def _get_minute_of_week(ts):
+    t = time.localtime(ts)
+    return t.tm_wday*MINUTES_PER_DAY + t.tm_hour*60 + t.tm_min
+
+
+def compile_profiles(profiles):
+    """Returns sorted minutes of week the active profiles change at along with fields by zone of each segment"""
+    intervals = []
+    for profile in profiles:
+        # Equal start and end make the whole day
+        length = (profile["end"] - profile["start"]) % MINUTES_PER_DAY or MINUTES_PER_DAY
+        for day in profile["days"]:
+            start = day*MINUTES_PER_DAY + profile["start"]
+            intervals.append((start, start + length, profile))
+
+    boundaries = sorted({start % MINUTES_PER_WEEK for start, _, _ in intervals} |
+                        {end % MINUTES_PER_WEEK for _, end, _ in intervals})
+    segments = []
+    for minute in boundaries:
+        active = [
+            profile for start, end, profile in intervals
+            if start <= minute < end or start <= minute + MINUTES_PER_WEEK < end
+        ]
+        fields = {}
+        for profile in sorted(active, key=lambda p: (p["priority"], p["name"])):
+            fields.setdefault(profile["zone"], {}).update(profile["settings"])
+        segments.append(fields)
+    return boundaries, segments
+
+
+def _get_default_fields(zone_id, names):
+    defaults = get_zone_defaults(get_zone(zone_id))
+    return {name: defaults[zone_key(zone_id, CONTROL_KEYS[name])] for name in names}
+
+
+def _get_transition(fields, previous):
+    """Returns fields by zone of moving from the previous fields by zone to the given ones"""
+    transition = {}
+    for zone_id in set(fields) | set(previous):
+        zone_fields = _get_default_fields(zone_id, set(previous.get(zone_id, {})) - set(fields.get(zone_id, {})))
+        zone_fields.update(fields.get(zone_id, {}))
+        transition[zone_id] = zone_fields
+    return transition
+
+
+class Scheduler:
+
+    """Compiled profiles telling controls values due at a given time.
+
+    Each transition comes with the next transition's time, so checking whether anything is due is O(1).
+    Fields no profile sets anymore fall back to zone defaults, e.g. lights go off once their profile ends.
+    """
+
+    def __init__(self):
+        self._boundaries, self._segments = [], []
+        self._index = None
+        self._next_at = None
+        # Fields by zone of the last applied segment, they're kept across loads to fall back from
+        self._applied = {}
+        self._profiles = None
+        self.loaded = False
+
+
+    def load(self, profiles):
+        """Compiles given profiles unless they're the loaded ones, fields of the current segment are due right away"""
+        if self.loaded and profiles == self._profiles:
+            return self
+        self._profiles = profiles
+        self._boundaries, self._segments = compile_profiles(profiles)
+        self._index = None
+        self._next_at = None
+        self.loaded = True
+        return self
+
+
+    def _locate(self, now):
+        """Returns index of a segment the given time falls into and time of the next transition"""
+        minute = _get_minute_of_week(now)
+        index = (bisect_right(self._boundaries, minute) - 1) % len(self._boundaries)
+        next_minute = self._boundaries[(index + 1) % len(self._boundaries)]
+        minutes_left = (next_minute - minute) % MINUTES_PER_WEEK or MINUTES_PER_WEEK
+        minute_started_at = now - time.localtime(now).tm_sec - now % 1
+        return index, minute_started_at + minutes_left*60
+
+
+    def get_due_values(self, now=None):
+        """Returns Redis values of a transition due by now, empty dict if none is"""
+        now = time.time() if now is None else now
+        if self._next_at is not None and now < self._next_at:
+            return {}
+
+        if self._boundaries:
+            index, self._next_at = self._locate(now)
+            if index == self._index:
+                return {}
+            fields = self._segments[index]
+        elif self._applied:
+            # Profiles are gone, so is everything they've set
+            index, fields = None, {}
+        else:
+            return {}
+
+        values = {}
+        for zone_id, zone_fields in _get_transition(fields, self._applied).items():
+            values.update(get_control_values(zone_id, zone_fields))
+        self._index = index
+        self._applied = fields
+        return values
+
+
+    def get_seconds_to_next(self, now=None):
+        """Returns seconds left till the next transition, None if there are no profiles"""
+        if self._next_at is None:
+            return None
+        now = time.time() if now is None else now
+        return max(0, self._next_at - now)
+
+
+    def preview(self, start, end):
+        """Returns (time, fields by zone) of transitions from start till end time"""
+        if not self._boundaries:
+            return []
+        transitions = []
+        index, at = self._locate(start)
+        while at <= end:
+            next_index = (index + 1) % len(self._boundaries)
+            transitions.append((at, _get_transition(self._segments[next_index], self._segments[index])))
+            index = next_index
+            _, at = self._locate(at)
+        return transitions
@@ -1,26 +1,78 @@
+# Hardware backend, "rpi" or "sim"
+HARDWARE_BACKEND = "rpi"
+
 # Fans
 FANS_PIN = 21
 PWM_DEFAULT_FREQ = 100
 PWM_DEFAULT_DUTY = 88
 DEFAULT_RPM_A6 = 3000
 DEFAULT_RPM_A12 = 2000
-PWM_CTRL_TIMEOUT = 1
+PWM_CTRL_HEARTBEAT = 10
+
+# Fans tachometers, measured RPM and stall alarm of each fan are published to these keys formatted by its name
+TACH_PULSES_PER_REVOLUTION = 2
+TACH_WINDOW_SECONDS = 5
+TACH_STALL_RPM = 200
+TACH_STALL_SECONDS = 10
+TACH_STALL_MIN_DUTY = 20
+FAN_RPM_KEY = "current_rpm_{}"
+FAN_STALLED_KEY = "fan_stalled_{}"
+
+# History, raw samples are rolled up into aggregates of each resolution, (name, bucket seconds, stream key, max length)
+HISTORY_SAMPLE_SECONDS = 5
+HISTORY_RESOLUTIONS = (
+    ("raw", HISTORY_SAMPLE_SECONDS, "history:raw", 17280),
+    ("1m", 60, "history:1m", 20160),
+    ("1h", 3600, "history:1h", 8760),
+)
+HISTORY_MAX_POINTS = 1000
+HISTORY_DEFAULT_WINDOW_SECONDS = 3600
 
 # Lights
 LIGHTS_PIN = 12
 LIGHTS_PWM_DEFAULT = 100
 LIGHT_DEFAULT_FREQ = 100
 
+# PWM driver of output pins along with their frequency, pins not listed here are driven by RPi.GPIO's software PWM.
+# "sysfs" is the kernel's hardware PWM of /sys/class/pwm, it only drives BCM 12, 13, 18 and 19 once they're given to it
+# by e.g. dtoverlay=pwm-2chan,pin=12,func=4,pin2=13,func2=4 in /boot/config.txt, software PWM is used if it isn't.
+# Mind that 4-pin fans expect 25kHz, fans have to be wired to a hardware PWM pin for that. It's opt-in, e.g.
+# {LIGHTS_PIN: ("sysfs", LIGHT_DEFAULT_FREQ)} drives the lights by hardware PWM at their usual frequency.
+PWM_CHANNELS = {}
+PWM_SYSFS_ROOT = "/sys/class/pwm"
+PWM_SYSFS_CHIP = 0
+PWM_SYSFS_EXPORT_TIMEOUT = 1
+
 # Sensors
 DHT_PIN_16 = 16
 DHT_PIN_20 = 20
 DEFAULT_TEMPERATURE_THRESHOLD = 25.1
+MIN_TEMPERATURE_THRESHOLD = -40.0
+MAX_TEMPERATURE_THRESHOLD = 80.0
 DHT_POLLING_TIMEOUT_SECONDS = 5
+DHT_READ_RETRIES = 3
+DHT_RETRY_BACKOFF_SECONDS = 2
+DHT_MAX_BACKOFF_SECONDS = 30
+TEMP_FILTER_WINDOW = 5
+TEMP_FILTER_EMA_ALPHA = 0.5
+TEMP_FILTER_MAX_JUMP = 3.0
+TEMP_FILTER_STALE_SECONDS = 60
 
 # Systemd servces names
 DHT_SERVICE = "dht_sensors.service"
 PWM_SERVICE = "pwm_controls.service"
 WEB_APP_SERVICE = "pi_fan_app.service"
+SYSTEMD_STATUS_BACKEND = "pystemd"
+SYSTEMD_STATUS_TTL = 5
+
+# Metrics of all the services are aggregated by the web app from this directory
+METRICS_DIR = "/tmp/pi_fan_metrics"
+
+# Live stats stream
+STATS_STREAM_HEARTBEAT = 15
+STATS_STREAM_QUEUE_SIZE = 32
+# Streams open at once per uWSGI process, each holds one of its threads
+STATS_STREAM_MAX_CLIENTS = 4
 
 # Response messages
 NO_ACTION_MSG = "No action taken."
@@ -34,10 +86,73 @@ LIGHTS_ON_MSG = "Lights are enabled."
 LIGHTS_OFF_MSG = "Lights are disabled."
 TEMP_THRESHOLD_SET_MSG = "New temperature threshold is set."
 UNABLE_TO_SET_PROP_MSG = "Unable to set {}"
+BAD_MODE_MSG = "Unknown control mode."
+BAD_TIME_RANGE_MSG = "Bad time range or resolution."
+UNKNOWN_ZONE_MSG = "Unknown zone."
+DEFAULTS_RESTORED_MSG = "Defaults are restored."
+CONTROL_SET_MSG = "Control is set."
+BAD_CONTROL_MSG = "Bad control document: {}."
+PROFILE_SET_MSG = "Profile is set."
+PROFILE_DELETED_MSG = "Profile is deleted."
+PROFILE_NOT_FOUND_MSG = "No such profile."
+BAD_PROFILE_MSG = "Bad profile: {}."
+BAD_PREVIEW_MSG = "Bad preview hours."
+BAD_STATS_FIELDS_MSG = "Bad stats fields: {}."
+STATS_STREAM_BUSY_MSG = "Too many live stats streams, try again later."
+
+# State backend shared by the daemons and the Flask app, "redis", "shm" or "memory". Shared memory one keeps the state
+# of a single node in a memory-mapped file, mind that it doesn't keep history and the ASGI app needs Redis anyway.
+# Memory one is only shared by the services run by supervisor.py, profiles of both are kept in a JSON file.
+STATE_BACKEND = "redis"
+STATE_SHM_PATH = "/dev/shm/pi_fan_state"
+STATE_PROFILES_PATH = "pi_fan_profiles.json"
+# Entries kept by each history stream of the memory backend, it's well below HISTORY_RESOLUTIONS max lengths to keep
+# the process small, 2880 entries are 4 hours of raw samples, 2 days of 1m and 120 days of 1h aggregates
+STATE_MEMORY_HISTORY_MAXLEN = 2880
+# Shared memory waiters are woken up by writers, polling only covers a lost wakeup
+STATE_SHM_POLL_SECONDS = 1
+STATE_SHM_READ_SPINS = 100
 
 # Redis URL
 REDIS_URL = "redis://:@localhost:6379/0"
 
+# Connection pool shared by the clients of a process, socket timeout must outlast SET_AND_WAIT_TIMEOUT blocking waits
+REDIS_MAX_CONNECTIONS = 16
+REDIS_POOL_TIMEOUT = 5
+REDIS_SOCKET_TIMEOUT = 5
+REDIS_CONNECT_TIMEOUT = 2
+REDIS_HEALTH_CHECK_INTERVAL = 30
+
+# Failed calls are retried after reconnecting with an exponential backoff
+REDIS_RETRIES = 3
+REDIS_BACKOFF_SECONDS = 0.1
+REDIS_MAX_BACKOFF_SECONDS = 10
+
+# Connection pool of the ASGI app, each request waiting for an acknowledgement holds a connection
+ASYNC_REDIS_MAX_CONNECTIONS = 64
+ASYNC_REDIS_POOL_TIMEOUT = 5
+
+# Redis pub/sub channel each state change is announced to, the message is the changed key
+STATE_CHANNEL = "state_changes"
+
+# Counter of state writes, the web apps tag responses with it to answer unchanged ones with 304 Not Modified
+STATE_VERSION_KEY = "state_version"
+
+# Sections of /stats a client may select, all of them are returned by default
+STATS_FIELDS = ("sensors", "controls", "fans", "systemd_services")
+
+# Values published by the daemons are cached to skip redundant writes, stale cache entries are written again
+STATE_PUBLISH_MAX_AGE_SECONDS = 300
+
+# Commands queue the controller acknowledges applied commands from, each on its own reply list
+COMMANDS_KEY = "commands"
+COMMAND_ACK_KEY = "command_ack:{}"
+COMMAND_ACK_TTL = 60
+
+# Scheduled profiles by name, the controller reloads them on commands
+PROFILES_KEY = "profiles"
+PROFILES_PREVIEW_HOURS = 24
+
 # Redis variables and client properties. Mind that each value corresponds to the client"s property name.
 PWM_ENABLED = "pwm_enabled"
 NEW_PWM_ENABLED = "new_pwm_enabled"
@@ -45,18 +160,81 @@ CURR_CTRL_MODE = "current_ctrl_mode"
 NEW_CTRL_MODE = "new_ctrl_mode"
 CURR_PWM_DUTY = "current_pwm_duty"
 NEW_PWM_DUTY = "new_pwm_duty"
-CURR_T1_TEMP = "current_t1_temperature"
-CURR_T2_TEMP = "current_t2_temperature"
 LIGHTS_ENABLED = "lights_enabled"
 NEW_LIGHTS_ENABLED = "new_lights_enabled"
 CURR_TEMP_THRESHOLD = "current_temperature_threshold"
 NEW_TEMP_THRESHOLD = "new_temperature_threshold"
 
+# Each sensor's filtered temperature and its quality flag are published to these keys formatted by its name
+SENSOR_TEMP_KEY = "current_{}_temperature"
+SENSOR_QUALITY_KEY = "current_{}_quality"
+# Time of the reading sensor's value is filtered up to, consumers tell a dead sensors daemon by it
+SENSOR_READ_AT_KEY = "current_{}_read_at"
+
 # Modes
 MANUAL_MODE = "manual"
 AUTO_MODE = "auto"
+PID_MODE = "pid"
+CURVE_MODE = "curve"
+CTRL_MODES = (MANUAL_MODE, AUTO_MODE, PID_MODE, CURVE_MODE)
+
+# Zones, each one has its own sensors (name, pin), fans (name, max RPM, tach pin or None) driven by its PWM pins, lights pin,
+# default threshold and mode. Keys of the default zone aren't namespaced, other zones' keys are.
+DEFAULT_ZONE = "default"
+ZONE_KEY = "zone:{zone}:{key}"
+ZONES = (
+    {
+        "id": DEFAULT_ZONE,
+        "sensors": (("t1", DHT_PIN_16), ("t2", DHT_PIN_20)),
+        "fans_pins": (FANS_PIN,),
+        "fans": (("a6", DEFAULT_RPM_A6, None), ("a12", DEFAULT_RPM_A12, None)),
+        "lights_pin": LIGHTS_PIN,
+        "threshold": DEFAULT_TEMPERATURE_THRESHOLD,
+        "mode": AUTO_MODE,
+    },
+)
+
+# Control engines, curve points are (degrees above threshold, duty)
+CONTROL_HYSTERESIS = 0.5
+FAN_CURVE = (
+    (-1.0, 0),
+    (0.0, 40),
+    (1.0, 70),
+    (2.0, 100),
+)
+PID_KP = 20.0
+PID_KI = 0.1
+PID_KD = 0.0
+PID_MIN_DUTY = 0
+PID_MAX_DUTY = 100
+PID_MIN_DUTY_STEP = 2
+
+# Controls state checkpoint the controller resumes from after a restart, relative to the working directory.
+# Mind to bump the version once the format changes, checkpoints of other versions are ignored.
+CHECKPOINT_PATH = "pi_fan_checkpoint.json"
+CHECKPOINT_VERSION = 1
+# Seconds between writes of the checkpoint if only the current duty has changed, it does on most sensors updates in
+# automatic modes
+CHECKPOINT_VOLATILE_INTERVAL = 60
+
+# Raw sensors samples and controller decisions are appended to binary logs of each daemon formatted by its name,
+# relative to the working directory, None disables them. Logs are rotated once they exceed the size.
+SAMPLE_LOG_PATH = "pi_fan_{}_samples.bin"
+SAMPLE_LOG_MAX_BYTES = 16*1024*1024
+SAMPLE_LOG_BACKUPS = 8
+SAMPLE_LOG_BUFFER_BYTES = 64*1024
+
+# Single process mode of supervisor.py serving the web app by itself. Failed tasks are restarted with an exponential
+# backoff, the process exits once a task fails too often within the window or its loop hangs, so that systemd restarts it.
+SUPERVISOR_WEB_HOST = "0.0.0.0"
+SUPERVISOR_WEB_PORT = 5000
+SUPERVISOR_CHECK_SECONDS = 1
+SUPERVISOR_BACKOFF_SECONDS = 1
+SUPERVISOR_MAX_BACKOFF_SECONDS = 60
+SUPERVISOR_MAX_FAILURES = 5
+SUPERVISOR_FAILURES_WINDOW_SECONDS = 600
+SUPERVISOR_HUNG_SECONDS = 120
 
 # Mics
-POLLING_INTERVAL = 0.2
 SET_AND_WAIT_TIMEOUT = 2
 AVG_TEMP = "average_temperature"
\ No newline at end of file
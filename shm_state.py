@@ -0,0 +1,448 @@
+import fcntl
+import json
+import mmap
+import os
+import select
+import socket
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from contextlib import contextmanager, suppress
+
+import settings
+
+from redis_client import STATE_TYPES, State, StateProperties
+from temperature_filter import get_sensor_quality
+from zones import get_fan_keys, get_sensor_keys, get_zone, get_zones, zone_key
+from logger import logger
+
+# Header: magic, format version, CRC of the slots layout and the sequence counter, it's odd while the body is written
+HEADER = struct.Struct("<4sHxxII")
+MAGIC = b"PFSS"
+VERSION = 1
+SEQ = struct.Struct("<I")
+SEQ_OFFSET = 12
+
+# Body starts with counters of state writes, sent commands and acknowledged ones followed by the slots
+COUNTERS = struct.Struct("<QII")
+N_COUNTERS = 3
+
+# Slot is a flag telling whether the value is set followed by the value of a fixed size
+STR_SIZE = 16
+_CODES = {bool: "?", int: "q", float: "d", str: "{}s".format(STR_SIZE)}
+_EMPTY = {bool: False, int: 0, float: 0.0, str: b""}
+
+
+def get_layout():
+    """Returns (key, type) of each slot, they're all the keys of all the zones"""
+    layout = []
+    for zone in get_zones():
+        layout.extend((zone_key(zone.id, k), t) for k, t in STATE_TYPES)
+        for _, temp_k, quality_k, read_at_k, _ in get_sensor_keys(zone):
+            layout.extend([(temp_k, float), (quality_k, str), (read_at_k, float)])
+        for _, rpm_k, stalled_k in get_fan_keys(zone):
+            layout.extend([(rpm_k, int), (stalled_k, bool)])
+    return layout
+
+
+def get_state(zone, values, sensors=True, fans=True, now=None):
+    """Returns State of a zone of typed values by key, unset flags are off as they are in Redis.
+
+    Sensors read too long ago are stale.
+    """
+    state = []
+    for k, t in STATE_TYPES:
+        v = values[zone_key(zone.id, k)]
+        state.append(False if v is None and t == bool else v)
+    sensors_values = None
+    if sensors:
+        sensors_values = tuple((name, values[temp_k], get_sensor_quality(values[quality_k], values[read_at_k], now))
+                               for name, temp_k, quality_k, read_at_k, _ in get_sensor_keys(zone))
+    fans_values = None
+    if fans:
+        fans_values = tuple((fan.name, values[rpm_k], bool(values[stalled_k]))
+                            for fan, rpm_k, stalled_k in get_fan_keys(zone))
+    return State(*state, sensors_values, fans_values)
+
+
+def to_type(v, t):
+    """Converts either a typed value or a stringified one into a given type, None if it can't be"""
+    if v is None:
+        return None
+    if isinstance(v, str) and t == bool:
+        return v == "True"
+    try:
+        return t(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_profiles_file(path):
+    """Returns stored JSONs of profiles by name kept in a file by the backends other than Redis"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.error("Unable to read profiles {}: {}".format(path, e))
+        return {}
+
+
+def save_profiles_file(path, profiles):
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        json.dump(profiles, f)
+    os.replace(tmp_path, path)
+
+
+def open_wakeup_socket(wakeup_dir):
+    """Returns datagram socket bound to a file of the wakeup directory, writers wake its owner up by it"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(os.path.join(wakeup_dir, "{}-{}".format(os.getpid(), uuid.uuid4().hex[:8])))
+    sock.setblocking(False)
+    return sock
+
+
+def close_wakeup_socket(sock):
+    path = sock.getsockname()
+    sock.close()
+    with suppress(FileNotFoundError):
+        os.unlink(path)
+
+
+def wait_for_wakeup(sock, timeout):
+    """Blocks until a writer wakes the socket up or timeout expires, pending wakeups are taken all at once"""
+    if select.select([sock], [], [], max(0, timeout))[0]:
+        with suppress(BlockingIOError):
+            while True:
+                sock.recv(1)
+
+
+class ShmSubscription:
+
+    """State seen by a subscriber, changes are told by comparing it with the current one"""
+
+    def __init__(self, seq, values, sock):
+        self.seq = seq
+        self.values = values
+        self.sock = sock
+
+
+    def close(self):
+        close_wakeup_socket(self.sock)
+
+
+class ShmStateClient(StateProperties):
+
+    """Counterpart of RedisClient keeping the state in a memory-mapped file of fixed-layout slots.
+
+    Writers of all the processes are serialized by a file lock and bump the sequence counter before and after
+    writing, so readers take no lock and just retry reads overlapping a write (seqlock). Waiters bind datagram
+    sockets in the wakeup directory next to the file and every write sends each of them a byte, polling only
+    covers a lost wakeup. Commands are numbered by a counter, the controller acknowledges them all up to a number.
+    Profiles are kept in a JSON file, history isn't kept at all.
+    """
+
+    def __init__(self, path=None, profiles_path=None):
+        self._path = path or settings.STATE_SHM_PATH
+        self._profiles_path = profiles_path or settings.STATE_PROFILES_PATH
+        self._wakeup_dir = "{}.wakeup".format(self._path)
+        os.makedirs(self._wakeup_dir, exist_ok=True)
+        self._notifier = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._notifier.setblocking(False)
+        self._layout = get_layout()
+        self._slots = {}
+        offset = HEADER.size + COUNTERS.size
+        for k, t in self._layout:
+            slot = struct.Struct("<?" + _CODES[t])
+            self._slots[k] = (offset, slot, t)
+            offset += slot.size
+        self._size = offset
+        # Whole body is read with a single unpack
+        self._body = struct.Struct(COUNTERS.format + "".join("?" + _CODES[t] for _, t in self._layout))
+        self._crc = zlib.crc32(",".join("{}:{}".format(k, t.__name__) for k, t in self._layout).encode())
+        self._lock = threading.Lock()
+        self._popped = None
+
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o660)
+        with self._locked():
+            header = os.pread(self._fd, HEADER.size, 0)
+            if os.fstat(self._fd).st_size != self._size or header[:-SEQ.size] != HEADER.pack(
+                    MAGIC, VERSION, self._crc, 0)[:-SEQ.size]:
+                # State of another layout, e.g. of other zones, is useless, the controller restores it from checkpoint
+                logger.info("Initializing shared state {}".format(self._path))
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self._size)
+                os.pwrite(self._fd, HEADER.pack(MAGIC, VERSION, self._crc, 0), 0)
+        self._mmap = mmap.mmap(self._fd, self._size)
+
+
+    @contextmanager
+    def _locked(self):
+        """Serializes writers of this process' threads and of the other processes"""
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+    def _get_seq(self):
+        return SEQ.unpack_from(self._mmap, SEQ_OFFSET)[0]
+
+
+    @contextmanager
+    def _write(self):
+        """Writes the body making readers retry meanwhile"""
+        with self._locked():
+            # Counter is left odd by a writer died in the middle of a write
+            seq = self._get_seq()
+            seq = seq if seq % 2 else (seq + 1) & 0xffffffff
+            SEQ.pack_into(self._mmap, SEQ_OFFSET, seq)
+            try:
+                yield
+            finally:
+                SEQ.pack_into(self._mmap, SEQ_OFFSET, (seq + 1) & 0xffffffff)
+        self._notify()
+
+
+    def _notify(self):
+        """Wakes up waiters of all the processes, sockets left behind by dead ones are removed"""
+        with os.scandir(self._wakeup_dir) as entries:
+            paths = [entry.path for entry in entries]
+        for path in paths:
+            try:
+                self._notifier.sendto(b"\0", path)
+            except BlockingIOError:
+                # Waiter hasn't taken the previous wakeups yet, one of them is enough
+                pass
+            except (ConnectionRefusedError, FileNotFoundError):
+                with suppress(FileNotFoundError):
+                    os.unlink(path)
+            except OSError as e:
+                logger.warning("Unable to wake up {}: {}".format(path, e))
+
+
+    def _read(self):
+        """Returns consistent body values read without locking"""
+        for _ in range(settings.STATE_SHM_READ_SPINS):
+            seq = self._get_seq()
+            if seq % 2 == 0:
+                body = self._body.unpack_from(self._mmap, HEADER.size)
+                if self._get_seq() == seq:
+                    return body
+            time.sleep(0)
+
+        # Writer is either slow or has died in the middle of a write, the body is read under the lock then
+        with self._locked():
+            return self._body.unpack_from(self._mmap, HEADER.size)
+
+
+    def _get_values(self, body):
+        """Returns values by key of the body, unset ones are None"""
+        values = {}
+        for i, (k, t) in enumerate(self._layout):
+            is_set, v = body[N_COUNTERS + 2*i], body[N_COUNTERS + 2*i + 1]
+            if not is_set:
+                v = None
+            elif t == str:
+                v = v.rstrip(b"\0").decode()
+            values[k] = v
+        return values
+
+
+    def _prepare(self, k, v):
+        """Returns slot's offset, struct and packed values of a given value, raises ValueError if it doesn't fit"""
+        if k not in self._slots:
+            raise ValueError("{} isn't kept by the shared state".format(k))
+        offset, slot, t = self._slots[k]
+        v = to_type(v, t)
+        if v is None:
+            return offset, slot, (False, _EMPTY[t])
+        if t == str:
+            v = v.encode()
+            if len(v) > STR_SIZE:
+                raise ValueError("{} is longer than {} bytes".format(k, STR_SIZE))
+        return offset, slot, (True, v)
+
+
+    def _put(self, values):
+        """Writes values checked by _prepare() up front, so that a bad one doesn't leave the others half-written"""
+        prepared = [self._prepare(k, v) for k, v in values.items()]
+        for offset, slot, packed in prepared:
+            slot.pack_into(self._mmap, offset, *packed)
+
+
+    def _is_set(self, k):
+        offset, slot, _ = self._slots[k]
+        return slot.unpack_from(self._mmap, offset)[0]
+
+
+    def _update_counters(self, state_versions=0, commands=0):
+        """Bumps counters of state writes and sent commands, returns the updated ones"""
+        state_version, commands_seq, acked_seq = COUNTERS.unpack_from(self._mmap, HEADER.size)
+        counters = (state_version + state_versions, (commands_seq + commands) & 0xffffffff, acked_seq)
+        COUNTERS.pack_into(self._mmap, HEADER.size, *counters)
+        return counters
+
+
+    def _get(self, k):
+        return self._get_values(self._read())[k]
+
+
+    def _get_state_value(self, k):
+        v = self._get(k)
+        # Unset flags are off as they are in Redis
+        return False if v is None and self._slots[k][2] == bool else v
+
+
+    def set_value(self, k, v):
+        self.set_values({k: v})
+
+
+    def set_values(self, values):
+        """Atomically writes the given values"""
+        with self._write():
+            self._put(values)
+            self._update_counters(state_versions=1)
+
+
+    def set_missing_values(self, values):
+        """Writes only those of the given values whose keys aren't set, returns the written keys"""
+        with self._write():
+            written = [k for k in values if k not in self._slots or not self._is_set(k)]
+            self._put({k: values[k] for k in written})
+            if written:
+                self._update_counters(state_versions=1)
+        return written
+
+
+    def get_state_version(self):
+        """Returns counter of state writes, it's bumped by every one of them"""
+        return self._read()[0]
+
+
+    def snapshots(self, zones, sensors=True, fans=True):
+        """Reads consistent state of all the given zones and returns them as immutable States"""
+        values = self._get_values(self._read())
+        return [get_state(zone, values, sensors, fans) for zone in zones]
+
+
+    def snapshot(self, zone_id=settings.DEFAULT_ZONE, sensors=True, fans=True):
+        """Reads state of a given zone and returns it as an immutable State"""
+        return self.snapshots([get_zone(zone_id)], sensors, fans)[0]
+
+
+    def send_command(self, values):
+        """Atomically writes the given values and numbers a command for the controller to acknowledge.
+
+        Returns id of the command to wait for.
+        """
+        with self._write():
+            self._put(values)
+            _, commands_seq, _ = self._update_counters(state_versions=1 if values else 0, commands=1)
+        return str(commands_seq)
+
+
+    def wait_for_ack(self, command_id, timeout):
+        """Blocks until the controller acknowledges a given command or timeout expires"""
+        # Socket is bound ahead of reading the counter, so the acknowledgement can't slip in between
+        sock = open_wakeup_socket(self._wakeup_dir)
+        try:
+            deadline = time.monotonic() + timeout
+            while self._read()[2] < int(command_id):
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return False
+                wait_for_wakeup(sock, min(wait, settings.STATE_SHM_POLL_SECONDS))
+            return True
+        finally:
+            close_wakeup_socket(sock)
+
+
+    def pop_commands(self):
+        """Takes ids of the commands sent since the last call, the first call takes the unacknowledged ones"""
+        _, commands_seq, acked_seq = self._read()[:N_COUNTERS]
+        if self._popped is None:
+            self._popped = acked_seq
+        command_ids = [str(command_id) for command_id in range(self._popped + 1, commands_seq + 1)]
+        self._popped = commands_seq
+        return command_ids
+
+
+    def ack_commands(self, command_ids):
+        """Acknowledges given commands along with all the preceding ones"""
+        if not command_ids:
+            return
+        with self._write():
+            state_version, commands_seq, acked_seq = COUNTERS.unpack_from(self._mmap, HEADER.size)
+            acked_seq = max([acked_seq] + [int(command_id) for command_id in command_ids])
+            COUNTERS.pack_into(self._mmap, HEADER.size, state_version, commands_seq, acked_seq)
+
+
+    def get_profiles(self):
+        """Returns stored JSONs of all the scheduled profiles by name"""
+        return load_profiles_file(self._profiles_path)
+
+
+    def set_profile(self, name, raw):
+        with self._locked():
+            profiles = load_profiles_file(self._profiles_path)
+            profiles[name] = raw
+            save_profiles_file(self._profiles_path, profiles)
+
+
+    def delete_profile(self, name):
+        """Deletes a scheduled profile, returns False if there's no such one"""
+        with self._locked():
+            profiles = load_profiles_file(self._profiles_path)
+            if profiles.pop(name, None) is None:
+                return False
+            save_profiles_file(self._profiles_path, profiles)
+            return True
+
+
+    def append_streams(self, entries):
+        """History isn't kept by the shared state"""
+
+
+    def read_stream(self, k, start_ms, end_ms):
+        return []
+
+
+    def subscribe(self):
+        """Returns subscription to state changes, it holds a wakeup socket until it's closed"""
+        sock = open_wakeup_socket(self._wakeup_dir)
+        seq = self._get_seq()
+        return ShmSubscription(seq, self._get_change_values(self._read()), sock)
+
+
+    def _get_change_values(self, body):
+        values = self._get_values(body)
+        values[settings.COMMANDS_KEY] = body[1]
+        return values
+
+
+    def wait_for_changes(self, subscription, timeout, keys=None):
+        """Blocks until any of the given keys changes or timeout expires, writers wake it up to check the counter.
+
+        Returns True if anything of interest has changed.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            seq = self._get_seq()
+            if seq != subscription.seq:
+                values = self._get_change_values(self._read())
+                changed = any(values.get(k) != subscription.values.get(k) for k in (values if keys is None else keys))
+                subscription.seq, subscription.values = seq, values
+                if changed:
+                    return True
+            wait = deadline - time.monotonic()
+            if wait <= 0:
+                return False
+            wait_for_wakeup(subscription.sock, min(wait, settings.STATE_SHM_POLL_SECONDS))
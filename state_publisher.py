@@ -0,0 +1,61 @@
+import time
+
+import settings
+
+
+class StatePublisher:
+
+    """Coalesces state writes of a single tick and skips values that have been published already.
+
+    Values are staged with set() and written by flush() in one transaction, so that readers never see
+    a half-updated state. Published values are cached and republished once they're older than max_age,
+    so that the state heals if the key has been overwritten by somebody else.
+    """
+
+    def __init__(self, redis_client, max_age=None):
+        self._redis_client = redis_client
+        self._max_age = settings.STATE_PUBLISH_MAX_AGE_SECONDS if max_age is None else max_age
+        self._published = {}
+        self._pending = {}
+
+
+    def observe(self, values):
+        """Updates cache with values read from Redis, e.g. with a snapshot taken at the beginning of a tick"""
+        now = time.monotonic()
+        for k, v in values.items():
+            if v is not None:
+                self._published[k] = (str(v), now)
+
+
+    def get(self, k):
+        """Returns the last published or observed value of a given key as a string"""
+        published = self._published.get(k)
+        return published[0] if published else None
+
+
+    def set(self, k, v, force=False):
+        """Stages a value unless it's the one published already, forced one is staged anyway"""
+        v = str(v)
+        published = self._published.get(k)
+        if not force and published and published[0] == v and time.monotonic() - published[1] < self._max_age:
+            self._pending.pop(k, None)
+            return
+        self._pending[k] = v
+
+
+    def flush(self):
+        """Writes all the staged values at once, returns number of keys written"""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        try:
+            self._redis_client.set_values(pending)
+        except Exception:
+            # Values staged meanwhile win over the ones that failed
+            pending.update(self._pending)
+            self._pending = pending
+            raise
+        now = time.monotonic()
+        for k, v in pending.items():
+            self._published[k] = (v, now)
+        return len(pending)
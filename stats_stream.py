@@ -0,0 +1,242 @@
+import asyncio
+import contextlib
+import json
+import os
+import queue
+import threading
+import time
+
+import settings
+
+from logger import logger
+
+_MISSING = object()
+
+
+def get_delta(old, new):
+    """Returns nested dict of values that differ between the given stats"""
+    delta = {}
+    for k, v in new.items():
+        old_v = old.get(k, _MISSING)
+        if isinstance(v, dict) and isinstance(old_v, dict):
+            nested = get_delta(old_v, v)
+            if nested:
+                delta[k] = nested
+        elif old_v != v:
+            delta[k] = v
+    return delta
+
+
+def format_event(event, data):
+    """Formats Server-Sent Event"""
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
+class StatsBroadcaster:
+
+    """Fans stats deltas out to all the connected clients from a single state subscription per process"""
+
+    def __init__(self, redis_client, get_stats):
+        self._redis_client = redis_client
+        self._get_stats = get_stats
+        self._clients = set()
+        self._streams = 0
+        self._stats = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+
+    def _ensure_started(self):
+        """Starts broadcasting thread, threads don't survive forks of uWSGI workers, so it's checked per process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stats = self._get_stats(self._redis_client.snapshot())
+            threading.Thread(target=self._run, name="stats-stream", daemon=True).start()
+            self._pid = os.getpid()
+
+
+    def _run(self):
+        pubsub = None
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._redis_client.subscribe()
+                # Services statuses aren't announced over Redis, so they are checked on heartbeats
+                self._redis_client.wait_for_changes(pubsub, settings.STATS_STREAM_HEARTBEAT)
+                self._broadcast()
+            except Exception as e:
+                # Resubscribe once Redis is back, clients keep their connections and get keep-alives meanwhile
+                logger.error(str(e))
+                pubsub = None
+                time.sleep(settings.STATS_STREAM_HEARTBEAT)
+
+
+    def _broadcast(self):
+        stats = self._get_stats(self._redis_client.snapshot())
+        delta = get_delta(self._stats, stats)
+        self._stats = stats
+        if not delta:
+            return
+
+        event = format_event("delta", delta)
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.put_nowait(event)
+            except queue.Full:
+                # Slow client falls behind, it's given the whole stats once it catches up
+                self._drop(client)
+
+
+    def _drop(self, client):
+        with self._lock:
+            self._clients.discard(client)
+        try:
+            while True:
+                client.get_nowait()
+        except queue.Empty:
+            pass
+        client.put_nowait(None)
+
+
+    def stream(self):
+        """Returns stream of the whole stats followed by their deltas, keep-alive comments go on heartbeats.
+
+        Each stream holds a thread of the WSGI server, None is returned once STATS_STREAM_MAX_CLIENTS streams are
+        open in the process, so there are threads left for the requests controlling the fans.
+        """
+        self._ensure_started()
+        with self._lock:
+            if self._streams >= settings.STATS_STREAM_MAX_CLIENTS:
+                return None
+            self._streams += 1
+
+        stream = self._stream()
+        # Started right away, so the slot is given back once the stream is closed, even if nothing was sent yet
+        next(stream)
+        return stream
+
+
+    def _stream(self):
+        client = queue.Queue(maxsize=settings.STATS_STREAM_QUEUE_SIZE)
+        try:
+            yield
+            with self._lock:
+                self._clients.add(client)
+                stats = self._stats
+
+            yield format_event("stats", stats)
+            while True:
+                try:
+                    event = client.get(timeout=settings.STATS_STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    yield format_event("stats", self._stats)
+                    with self._lock:
+                        self._clients.add(client)
+                    continue
+                yield event
+        finally:
+            with self._lock:
+                self._clients.discard(client)
+                self._streams -= 1
+
+
+class AsyncStatsBroadcaster:
+
+    """Counterpart of StatsBroadcaster for the ASGI app, a single task of the event loop holds the subscription"""
+
+    def __init__(self, redis_client, get_stats):
+        self._redis_client = redis_client
+        self._get_stats = get_stats
+        self._clients = set()
+        self._stats = None
+        self._task = None
+
+
+    def _is_running(self):
+        return (self._task is not None and not self._task.done() and
+                self._task.get_loop() is asyncio.get_running_loop())
+
+
+    async def _ensure_started(self):
+        """Starts broadcasting task, tasks don't outlive their event loop, so it's checked per loop"""
+        if self._is_running():
+            return
+        stats = self._get_stats(await self._redis_client.snapshot())
+        # Another client may have started it meanwhile
+        if not self._is_running():
+            self._stats = stats
+            self._task = asyncio.ensure_future(self._run())
+
+
+    async def _run(self):
+        pubsub = None
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = await self._redis_client.subscribe()
+                # Services statuses aren't announced over Redis, so they are checked on heartbeats
+                await self._redis_client.wait_for_changes(pubsub, settings.STATS_STREAM_HEARTBEAT)
+                await self._broadcast()
+            except Exception as e:
+                # Resubscribe once Redis is back, clients keep their connections and get keep-alives meanwhile
+                logger.error(str(e))
+                if pubsub is not None:
+                    # Connection goes back to the pool, it's shared with the requests
+                    with contextlib.suppress(Exception):
+                        await pubsub.close()
+                pubsub = None
+                await asyncio.sleep(settings.STATS_STREAM_HEARTBEAT)
+
+
+    async def _broadcast(self):
+        stats = self._get_stats(await self._redis_client.snapshot())
+        delta = get_delta(self._stats, stats)
+        self._stats = stats
+        if not delta:
+            return
+
+        event = format_event("delta", delta)
+        for client in list(self._clients):
+            try:
+                client.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow client falls behind, it's given the whole stats once it catches up
+                self._drop(client)
+
+
+    def _drop(self, client):
+        self._clients.discard(client)
+        while not client.empty():
+            client.get_nowait()
+        client.put_nowait(None)
+
+
+    async def stream(self):
+        """Yields the whole stats first and their deltas afterwards, keep-alive comments go on heartbeats"""
+        await self._ensure_started()
+        client = asyncio.Queue(maxsize=settings.STATS_STREAM_QUEUE_SIZE)
+        self._clients.add(client)
+
+        try:
+            yield format_event("stats", self._stats)
+            while True:
+                try:
+                    event = await asyncio.wait_for(client.get(), settings.STATS_STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    yield format_event("stats", self._stats)
+                    self._clients.add(client)
+                    continue
+                yield event
+        finally:
+            self._clients.discard(client)
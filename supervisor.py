@@ -0,0 +1,122 @@
+"""Runs sensors readings, PWM controls and the web app as threads of a single process sharing the state in memory.
+
+It takes the place of dht_sensors, pwm_controls and pi_fan_app services, nginx is to proxy to SUPERVISOR_WEB_PORT:
+
+    python supervisor.py
+"""
+import signal
+import sys
+import threading
+import time
+
+import settings
+
+# Services share the state of this process, so it goes before they're imported
+settings.STATE_BACKEND = "memory"
+
+import dht_sensors
+import pwm_controls
+
+from logger import logger
+
+
+def run_web_app():
+    """Serves the Flask app by a threaded WSGI server, live stats streams hold a thread each"""
+    from werkzeug.serving import make_server
+    from pi_fan_app import app
+    make_server(settings.SUPERVISOR_WEB_HOST, settings.SUPERVISOR_WEB_PORT, app, threaded=True).serve_forever()
+
+
+class Task:
+
+    """Service loop run on its own thread, it's restarted with an exponential backoff once it fails.
+
+    Loop telling the time of its last iteration by heartbeat is considered hung once it's too old.
+    """
+
+    def __init__(self, name, target, heartbeat=None):
+        self.name = name
+        self._target = target
+        self._heartbeat = heartbeat
+        self._thread = None
+        self._started_at = None
+        self._restart_at = None
+        self._backoff = settings.SUPERVISOR_BACKOFF_SECONDS
+        self._failures = []
+
+
+    def _run(self):
+        try:
+            self._target()
+        except Exception as e:
+            logger.exception("{} has failed: {}".format(self.name, e))
+        else:
+            logger.error("{} has stopped".format(self.name))
+
+
+    def start(self):
+        logger.info("Starting {}".format(self.name))
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._started_at = time.monotonic()
+        self._restart_at = None
+        self._thread.start()
+
+
+    def is_hung(self, now):
+        if self._heartbeat is None or not self._thread.is_alive():
+            return False
+        last_seen = max(self._heartbeat() or 0, self._started_at)
+        return now - last_seen > settings.SUPERVISOR_HUNG_SECONDS
+
+
+    def check(self, now):
+        """Restarts the task once it's died and its backoff has passed, returns False if it fails too often"""
+        if self._thread.is_alive():
+            if now - self._started_at > settings.SUPERVISOR_FAILURES_WINDOW_SECONDS:
+                self._backoff = settings.SUPERVISOR_BACKOFF_SECONDS
+            return True
+
+        if self._restart_at is None:
+            self._failures = [t for t in self._failures if now - t < settings.SUPERVISOR_FAILURES_WINDOW_SECONDS]
+            self._failures.append(now)
+            if len(self._failures) > settings.SUPERVISOR_MAX_FAILURES:
+                return False
+            logger.warning("Restarting {} in {}s".format(self.name, self._backoff))
+            self._restart_at = now + self._backoff
+            self._backoff = min(self._backoff*2, settings.SUPERVISOR_MAX_BACKOFF_SECONDS)
+
+        if now >= self._restart_at:
+            self.start()
+        return True
+
+
+def _exit(signum, frame):
+    # Exit runs atexit handlers, e.g. the one stopping fans
+    sys.exit(0)
+
+
+def run_supervisor():
+    tasks = [
+        Task("dht_sensors", dht_sensors.run_sensors_readings, heartbeat=lambda: dht_sensors.heartbeat),
+        Task("pwm_controls", pwm_controls.run_pwm_controls, heartbeat=lambda: pwm_controls.heartbeat),
+        Task("web_app", run_web_app),
+    ]
+    signal.signal(signal.SIGTERM, _exit)
+    for task in tasks:
+        task.start()
+
+    while True:
+        time.sleep(settings.SUPERVISOR_CHECK_SECONDS)
+        now = time.monotonic()
+        for task in tasks:
+            # Threads can't be killed, so the process is restarted by systemd instead
+            if task.is_hung(now):
+                logger.error("{} has hung, exiting".format(task.name))
+                sys.exit(1)
+            if not task.check(now):
+                logger.error("{} keeps failing, exiting".format(task.name))
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_supervisor()
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+
+import settings
+
+from logger import logger
+
+UNKNOWN_STATUS = "unknown"
+
+
+class PystemdBackend:
+
+    """Reads units states over D-Bus, units are loaded once and reused"""
+
+    def __init__(self):
+        from pystemd.systemd1 import Unit
+        self._unit_cls = Unit
+        self._units = {}
+
+
+    def get_status(self, service_name):
+        unit = self._units.get(service_name)
+        if unit is None:
+            unit = self._unit_cls(service_name)
+            unit.load()
+            self._units[service_name] = unit
+        try:
+            return unit.Unit.ActiveState.decode("utf-8")
+        except Exception:
+            # Reload the unit next time, e.g. D-Bus connection might be gone
+            self._units.pop(service_name, None)
+            raise
+
+
+class StaticBackend:
+
+    """Stand-in backend serving statuses it was given, e.g. off a systemd host or in tests"""
+
+    def __init__(self, statuses=None):
+        self._statuses = dict(statuses or {})
+
+
+    def set_status(self, service_name, status):
+        self._statuses[service_name] = status
+
+
+    def get_status(self, service_name):
+        return self._statuses.get(service_name, UNKNOWN_STATUS)
+
+
+BACKENDS = {
+    "pystemd": PystemdBackend,
+    "static": StaticBackend,
+}
+
+
+def get_backend(name=None):
+    """Returns instance of a configured status backend"""
+    return BACKENDS[name or settings.SYSTEMD_STATUS_BACKEND]()
+
+
+class SystemdStatusCache:
+
+    """In-memory cache of services statuses refreshed by a background thread, zero TTL reads them on each call"""
+
+    def __init__(self, services, backend, ttl=None):
+        self._services = list(services)
+        self._backend = backend
+        self._ttl = settings.SYSTEMD_STATUS_TTL if ttl is None else ttl
+        if self._ttl < 0:
+            raise ValueError("TTL must not be negative")
+        self._statuses = {s: UNKNOWN_STATUS for s in self._services}
+        self._refreshed = False
+        self._lock = threading.Lock()
+        self._pid = None
+
+
+    def _run(self):
+        while True:
+            time.sleep(self._ttl)
+            self.refresh()
+
+
+    def _ensure_started(self):
+        """Starts refreshing thread, threads don't survive forks of uWSGI workers, so it's checked per process"""
+        if not self._ttl:
+            self.refresh()
+            return
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if not self._refreshed:
+                self.refresh()
+            threading.Thread(target=self._run, name="systemd-status", daemon=True).start()
+            self._pid = os.getpid()
+
+
+    def refresh(self):
+        """Re-reads all the statuses from the backend"""
+        statuses = {}
+        for service_name in self._services:
+            try:
+                statuses[service_name] = self._backend.get_status(service_name)
+            except Exception as e:
+                logger.error(str(e))
+                statuses[service_name] = UNKNOWN_STATUS
+        self._statuses = statuses
+        self._refreshed = True
+
+
+    def get_status(self, service_name):
+        self._ensure_started()
+        return self._statuses.get(service_name, UNKNOWN_STATUS)
+
+
+    def get_statuses(self):
+        self._ensure_started()
+        return dict(self._statuses)
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from collections import deque
+
+import settings
+
+
+class TachCounter:
+
+    """Counts fan tach pulses and computes RPM over a sliding window, pulses come from GPIO callback threads"""
+
+    def __init__(self, pulses_per_revolution=None, window=None):
+        self._pulses_per_revolution = pulses_per_revolution or settings.TACH_PULSES_PER_REVOLUTION
+        self._window = window or settings.TACH_WINDOW_SECONDS
+        self._pulses = deque()
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+
+
+    def pulse(self, count=1, ts=None):
+        """Registers pulses, mind that it's called off the main loop, so it has to be cheap"""
+        ts = time.monotonic() if ts is None else ts
+        with self._lock:
+            self._pulses.append((ts, count))
+
+
+    def get_rpm(self, now=None):
+        """Returns RPM over the sliding window, None until the first window is over"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            while self._pulses and self._pulses[0][0] < now - self._window:
+                self._pulses.popleft()
+            pulses = sum(count for _, count in self._pulses)
+        if now - self._started < self._window:
+            return None
+        return pulses*60/self._window/self._pulses_per_revolution
+
+
+class StallDetector:
+
+    """Raises stall alarm once a fan expected to spin stays below TACH_STALL_RPM for TACH_STALL_SECONDS"""
+
+    def __init__(self, stall_rpm=None, stall_seconds=None):
+        self._stall_rpm = settings.TACH_STALL_RPM if stall_rpm is None else stall_rpm
+        self._stall_seconds = settings.TACH_STALL_SECONDS if stall_seconds is None else stall_seconds
+        self._slow_since = None
+
+
+    def update(self, rpm, expected_running, now=None):
+        """Returns True if the fan is stalled"""
+        now = time.monotonic() if now is None else now
+        if rpm is None or not expected_running or rpm >= self._stall_rpm:
+            self._slow_since = None
+            return False
+        if self._slow_since is None:
+            self._slow_since = now
+        return now - self._slow_since >= self._stall_seconds
+
+
+class SimTachSource(threading.Thread):
+
+    """Simulated pulse source feeding a callback with pulses of a fan spinning at a given RPM"""
+
+    def __init__(self, callback, get_rpm, pulses_per_revolution=None, interval=0.1):
+        super().__init__(name="sim-tach", daemon=True)
+        self._callback = callback
+        self._get_rpm = get_rpm
+        self._pulses_per_revolution = pulses_per_revolution or settings.TACH_PULSES_PER_REVOLUTION
+        self._interval = interval
+        self._carry = 0.0
+
+
+    def run(self):
+        while True:
+            time.sleep(self._interval)
+            pulses = self._get_rpm()*self._pulses_per_revolution/60*self._interval + self._carry
+            count = int(pulses)
+            self._carry = pulses - count
+            if count:
+                self._callback(count)
@@ -0,0 +1,91 @@
+import time
+
+from collections import deque
+
+import settings
+
+# Quality flags published along with each filtered temperature
+QUALITY_OK = "ok"
+QUALITY_STALE = "stale"
+QUALITY_NO_DATA = "no_data"
+
+
+class TemperatureFilter:
+
+    """Median-of-N window followed by an EMA, rejects spikes and detects stale sensors"""
+
+    def __init__(self, window=None, alpha=None, max_jump=None, stale_seconds=None):
+        window = settings.TEMP_FILTER_WINDOW if window is None else window
+        if window < 1:
+            raise ValueError("window must have at least one reading")
+        self._window = deque(maxlen=window)
+        self._alpha = alpha if alpha is not None else settings.TEMP_FILTER_EMA_ALPHA
+        self._max_jump = max_jump if max_jump is not None else settings.TEMP_FILTER_MAX_JUMP
+        self._stale_seconds = stale_seconds if stale_seconds is not None else settings.TEMP_FILTER_STALE_SECONDS
+        self._rejected = 0
+        self._value = None
+        self._updated_at = None
+
+
+    def _median(self):
+        values = sorted(self._window)
+        middle = len(values)//2
+        if len(values) % 2:
+            return values[middle]
+        return (values[middle - 1] + values[middle])/2
+
+
+    def add(self, value, ts=None):
+        """Adds a raw reading, returns False if it was rejected as an outlier"""
+        ts = time.time() if ts is None else ts
+
+        # A spike is dropped, unless it keeps coming for a whole window, then it's a real change of temperature
+        # and the filter starts over from it, e.g. also when a bad first reading has anchored the window
+        if self._window and abs(value - self._median()) > self._max_jump:
+            if self._rejected < self._window.maxlen:
+                self._rejected += 1
+                return False
+            self._window.clear()
+            self._value = None
+        self._rejected = 0
+
+        self._window.append(value)
+        median = self._median()
+        if self._value is None:
+            self._value = median
+        else:
+            self._value = self._alpha*median + (1 - self._alpha)*self._value
+        self._updated_at = ts
+        return True
+
+
+    @property
+    def updated_at(self):
+        """Time of the last reading the filtered value is based on, None until there's one"""
+        return self._updated_at
+
+
+    def get(self, now=None):
+        """Returns filtered value along with its quality flag"""
+        now = time.time() if now is None else now
+        if self._value is None:
+            return None, QUALITY_NO_DATA
+        value = round(self._value, 2)
+        if now - self._updated_at > self._stale_seconds:
+            return value, QUALITY_STALE
+        return value, QUALITY_OK
+
+
+def get_sensor_quality(quality, read_at, now=None):
+    """Returns published quality of a sensor, it's stale once its reading gets too old, e.g. if its daemon is dead"""
+    now = time.time() if now is None else now
+    if quality == QUALITY_OK and (read_at is None or now - read_at > settings.TEMP_FILTER_STALE_SECONDS):
+        return QUALITY_STALE
+    return quality
+
+
+def get_average_temperature(readings):
+    """Averages (value, quality) readings of good quality only, returns None if there are none"""
+    values = [v for v, quality in readings if v is not None and quality == QUALITY_OK]
+    if values:
+        return sum(values)/len(values)
@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+
+from temperature_filter import QUALITY_OK, QUALITY_STALE, TemperatureFilter, get_sensor_quality
+
+POLL_SECONDS = 5
+
+
+def _feed(temperature_filter, values, started=0):
+    for i, value in enumerate(values):
+        temperature_filter.add(value, ts=started + i*POLL_SECONDS)
+    return started + len(values)*POLL_SECONDS
+
+
+def test_spike_is_rejected():
+    temperature_filter = TemperatureFilter(window=5, alpha=0.5, max_jump=3.0)
+    now = _feed(temperature_filter, [22.0]*5)
+
+    assert not temperature_filter.add(40.0, ts=now)
+    assert temperature_filter.get(now=now) == (22.0, QUALITY_OK)
+
+
+def test_step_change_is_accepted_after_a_window():
+    temperature_filter = TemperatureFilter(window=5, alpha=0.5, max_jump=3.0)
+    now = _feed(temperature_filter, [22.0]*5)
+
+    # Rejected for a window of readings, then the filter starts over from the new temperature
+    now = _feed(temperature_filter, [27.0]*6, started=now)
+
+    assert temperature_filter.get(now=now) == (27.0, QUALITY_OK)
+
+
+def test_bad_first_reading_does_not_anchor_window():
+    temperature_filter = TemperatureFilter(window=5, alpha=0.5, max_jump=3.0)
+    now = _feed(temperature_filter, [85.0] + [22.0]*6)
+
+    assert temperature_filter.get(now=now) == (22.0, QUALITY_OK)
+
+
+def test_sensor_quality_is_stale_once_reading_is_too_old():
+    assert get_sensor_quality(QUALITY_OK, 1000, now=1000 + settings.TEMP_FILTER_STALE_SECONDS) == QUALITY_OK
+    assert get_sensor_quality(QUALITY_OK, 1000, now=1001 + settings.TEMP_FILTER_STALE_SECONDS) == QUALITY_STALE
+    assert get_sensor_quality(QUALITY_OK, None, now=1000) == QUALITY_STALE
@@ -0,0 +1,384 @@
+import math
+import time
+import zlib
+
+import settings
+
+from http import HTTPStatus
+
+from control_fields import CONTROL_FIELDS, get_control_values, is_valid_threshold, validate_control_fields
+from fans import estimate_zone_rpm
+from schedule import Scheduler, format_profile, load_profiles, parse_profile
+from systemd_status import SystemdStatusCache, get_backend
+from temperature_filter import get_average_temperature
+from zones import get_zone, get_zone_defaults, zone_key
+
+# Services the web apps report statuses of
+SYSTEMD_SERVICES = (settings.DHT_SERVICE, settings.PWM_SERVICE, settings.WEB_APP_SERVICE)
+
+# Systemd services statuses
+systemd_statuses = SystemdStatusCache(
+    SYSTEMD_SERVICES,
+    get_backend(settings.SYSTEMD_STATUS_BACKEND),
+    ttl=settings.SYSTEMD_STATUS_TTL,
+)
+
+
+class RequestError(Exception):
+
+    """Request the web apps can't serve, they answer it by the message with a given status"""
+
+    def __init__(self, msg, status=HTTPStatus.BAD_REQUEST.value):
+        super().__init__(msg)
+        self.msg = msg
+        self.status = status
+
+
+def key(zone_id, name):
+    """Returns zone's Redis key of a given settings name"""
+    return zone_key(zone_id, getattr(settings, name))
+
+
+def get_state_average_temperature(state):
+    """Gets average temperature from the available sensors of good quality"""
+    return get_average_temperature([(t, quality) for _, t, quality in state.sensors])
+
+
+def get_unable_to_set_msg(names):
+    """Returns message of a command the controller hasn't acknowledged"""
+    return settings.UNABLE_TO_SET_PROP_MSG.format(", ".join(names))
+
+
+def parse_mode(mode):
+    """Returns control mode of a path, raises RequestError if it isn't known"""
+    if mode not in settings.CTRL_MODES:
+        raise RequestError(settings.BAD_MODE_MSG)
+    return mode
+
+
+def parse_threshold(v):
+    """Returns temperature threshold of a path, raises RequestError if it isn't a valid one"""
+    try:
+        threshold = float(v)
+    except ValueError:
+        threshold = None
+    if not is_valid_threshold(threshold):
+        raise RequestError(get_unable_to_set_msg([settings.NEW_TEMP_THRESHOLD]), HTTPStatus.INTERNAL_SERVER_ERROR.value)
+    return threshold
+
+
+def parse_duty(v):
+    """Returns duty of a path, raises RequestError unless it's an integer percent"""
+    try:
+        duty = int(v)
+    except ValueError:
+        duty = None
+    if not CONTROL_FIELDS["duty"](duty):
+        raise RequestError(get_unable_to_set_msg([settings.NEW_PWM_DUTY]), HTTPStatus.INTERNAL_SERVER_ERROR.value)
+    return duty
+
+
+def get_pwm_enable_command(state, zone_id, mode):
+    """Returns values enabling PWM in a given mode along with the response message"""
+    values = {
+        key(zone_id, "CURR_TEMP_THRESHOLD"): get_zone(zone_id).threshold,
+        key(zone_id, "NEW_TEMP_THRESHOLD"): get_zone(zone_id).threshold,
+    }
+    msg = settings.NO_ACTION_MSG
+
+    if state.pwm_enabled and mode != state.current_ctrl_mode:
+        values[key(zone_id, "NEW_CTRL_MODE")] = mode
+        msg = settings.PWM_ENABLED_MSG
+    elif not state.pwm_enabled:
+        values[key(zone_id, "NEW_PWM_ENABLED")] = True
+        values[key(zone_id, "NEW_CTRL_MODE")] = mode
+        values[key(zone_id, "NEW_PWM_DUTY")] = settings.PWM_DEFAULT_DUTY
+        msg = settings.PWM_ENABLED_MSG
+
+    return values, msg
+
+
+def get_pwm_disable_command(state, zone_id):
+    """Returns values disabling PWM along with the response message, values are None if there's nothing to do"""
+    if state.pwm_enabled:
+        return {key(zone_id, "NEW_PWM_ENABLED"): False, key(zone_id, "NEW_PWM_DUTY"): 0}, settings.PWM_DISABLED_MSG
+    return None, settings.NO_ACTION_MSG
+
+
+def get_set_duty_command(state, zone_id, percent):
+    """Returns values setting manual duty along with the response message, values are None if there's nothing to do"""
+    if state.pwm_enabled and state.current_ctrl_mode == settings.MANUAL_MODE:
+        return {key(zone_id, "NEW_PWM_DUTY"): percent}, settings.DUTY_SET_MSG.format(pwm_duty=percent)
+    return None, settings.NO_ACTION_MSG
+
+
+def get_stop_fans_command(state, zone_id):
+    """Returns values stopping fans along with the response message, values are None if there's nothing to do"""
+    if state.pwm_enabled and state.current_ctrl_mode == settings.MANUAL_MODE:
+        return {key(zone_id, "NEW_PWM_DUTY"): 0}, settings.FANS_STOPPED_MSG
+    return None, settings.NO_ACTION_MSG
+
+
+def get_lights_command(state, zone_id, enabled):
+    """Returns values switching lights along with the response message, values are None if there's nothing to do"""
+    if state.lights_enabled != enabled:
+        msg = settings.LIGHTS_ON_MSG if enabled else settings.LIGHTS_OFF_MSG
+        return {key(zone_id, "NEW_LIGHTS_ENABLED"): enabled}, msg
+    return None, settings.NO_ACTION_MSG
+
+
+def get_threshold_command(zone_id, threshold):
+    """Returns values setting temperature threshold along with the response message"""
+    return {key(zone_id, "NEW_TEMP_THRESHOLD"): threshold}, settings.TEMP_THRESHOLD_SET_MSG
+
+
+def get_reset_command(zone_id):
+    """Returns values restoring zone's default controls along with the response message.
+
+    Outputs are switched by the controller applying the command, so their current values aren't touched.
+    """
+    values = get_zone_defaults(get_zone(zone_id))
+    values.pop(key(zone_id, "PWM_ENABLED"))
+    values.pop(key(zone_id, "LIGHTS_ENABLED"))
+    return values, settings.DEFAULTS_RESTORED_MSG
+
+
+def parse_control_document(document, zone_id):
+    """Returns control fields by zone id of a document, raises ValueError describing what's wrong with it.
+
+    Document is either fields of a given zone or {"zones": {zone id: fields}} addressing any zones at once.
+    """
+    if not isinstance(document, dict):
+        raise ValueError("JSON object expected")
+    controls = document.get("zones") if "zones" in document else {zone_id: document}
+    if not isinstance(controls, dict):
+        raise ValueError("zones must be an object")
+
+    for control_zone_id, fields in controls.items():
+        if get_zone(control_zone_id) is None:
+            raise ValueError("unknown zone {}".format(control_zone_id))
+        validate_control_fields(fields)
+    return controls
+
+
+def parse_control_request(document, zone_id):
+    """Returns control fields by zone id of a request's document, raises RequestError describing what's wrong"""
+    try:
+        return parse_control_document(document, zone_id)
+    except ValueError as e:
+        raise RequestError(settings.BAD_CONTROL_MSG.format(e))
+
+
+def get_control_command(states, controls):
+    """Returns values applying control fields by zone id, states are the current ones by zone id"""
+    values = {}
+    for zone_id, fields in controls.items():
+        # Fans start with the default duty unless it's given, disabled ones are left with zero one
+        if "pwm_enabled" in fields and not fields["pwm_enabled"]:
+            values[key(zone_id, "NEW_PWM_DUTY")] = 0
+        elif fields.get("pwm_enabled") and not states[zone_id].pwm_enabled:
+            values[key(zone_id, "NEW_PWM_DUTY")] = settings.PWM_DEFAULT_DUTY
+        values.update(get_control_values(zone_id, fields))
+    return values
+
+
+def get_applied_controls(states, controls):
+    """Returns names of control fields the controller has applied and not applied by zone id.
+
+    Mind that some fields only apply in certain states, e.g. duty is only applied in manual mode.
+    """
+    current = {
+        "pwm_enabled": lambda state: state.pwm_enabled,
+        "mode": lambda state: state.current_ctrl_mode,
+        "threshold": lambda state: state.current_temperature_threshold,
+        "duty": lambda state: state.current_pwm_duty,
+        "lights_enabled": lambda state: state.lights_enabled,
+    }
+    applied = {}
+    for zone_id, fields in controls.items():
+        names = [name for name, v in fields.items() if current[name](states[zone_id]) == v]
+        applied[zone_id] = {"applied": names, "not_applied": [name for name in fields if name not in names]}
+    return applied
+
+
+def get_formatted_profiles(raw_profiles):
+    """Returns stored profiles by name in the form they're accepted by the API"""
+    return {profile["name"]: format_profile(profile) for profile in load_profiles(raw_profiles.values())}
+
+
+def get_formatted_profile(raw_profiles, name):
+    """Returns a stored profile in the form it's accepted by the API, raises RequestError if there's no such one"""
+    profile = get_formatted_profiles(raw_profiles).get(name)
+    if profile is None:
+        raise RequestError(settings.PROFILE_NOT_FOUND_MSG, HTTPStatus.NOT_FOUND.value)
+    return profile
+
+
+def parse_profile_request(name, document):
+    """Returns profile of a request's document, raises RequestError describing what's wrong with it"""
+    try:
+        return parse_profile(name, document)
+    except ValueError as e:
+        raise RequestError(settings.BAD_PROFILE_MSG.format(e))
+
+
+def parse_preview_hours(args):
+    """Returns hours of a profiles preview request, raises RequestError unless they're within a week"""
+    try:
+        hours = float(args.get("hours", settings.PROFILES_PREVIEW_HOURS))
+    except ValueError:
+        raise RequestError(settings.BAD_PREVIEW_MSG)
+    if not 0 < hours <= 24*7:
+        raise RequestError(settings.BAD_PREVIEW_MSG)
+    return hours
+
+
+def get_profiles_preview(raw_profiles, hours, now=None):
+    """Returns transitions of stored profiles within given hours from now"""
+    now = time.time() if now is None else now
+    scheduler = Scheduler().load(load_profiles(raw_profiles[name] for name in sorted(raw_profiles)))
+    return [{"at": at, "zones": fields} for at, fields in scheduler.preview(now, now + hours*3600)]
+
+
+def parse_stats_fields(v):
+    """Returns stats sections of a comma separated selector, all of them if it's not given.
+
+    Raises ValueError naming unknown sections.
+    """
+    if v is None:
+        return settings.STATS_FIELDS
+    fields = {field.strip() for field in v.split(",") if field.strip()}
+    unknown = fields - set(settings.STATS_FIELDS)
+    if unknown or not fields:
+        raise ValueError(", ".join(sorted(unknown)) or "none")
+    return tuple(field for field in settings.STATS_FIELDS if field in fields)
+
+
+def parse_stats_request(args):
+    """Returns stats sections selected by a request, raises RequestError naming unknown ones"""
+    try:
+        return parse_stats_fields(args.get("fields"))
+    except ValueError as e:
+        raise RequestError(settings.BAD_STATS_FIELDS_MSG.format(e))
+
+
+def parse_history_request(args, now=None):
+    """Returns start, end and resolution of a history request, the last HISTORY_DEFAULT_WINDOW_SECONDS by default.
+
+    Raises RequestError unless it's a finite time range and a known resolution.
+    """
+    now = time.time() if now is None else now
+    try:
+        end = float(args.get("end", now))
+        start = float(args.get("start", end - settings.HISTORY_DEFAULT_WINDOW_SECONDS))
+    except ValueError:
+        raise RequestError(settings.BAD_TIME_RANGE_MSG)
+
+    resolution = args.get("resolution")
+    resolutions = [None] + [name for name, _, _, _ in settings.HISTORY_RESOLUTIONS]
+    if not math.isfinite(start) or not math.isfinite(end) or start > end or resolution not in resolutions:
+        raise RequestError(settings.BAD_TIME_RANGE_MSG)
+    return start, end, resolution
+
+
+def tag_response(response, etag):
+    """Tags response of either app with a given ETag clients have to revalidate"""
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def get_not_modified_response(request, response_class, etag):
+    """Returns 304 Not Modified response if the client already has a given ETag, None otherwise"""
+    if request.if_none_match.contains(etag):
+        return tag_response(response_class("", status=HTTPStatus.NOT_MODIFIED.value), etag)
+
+
+def get_stats_etag(version, zone_id, fields=settings.STATS_FIELDS):
+    """Returns ETag of stats sections of a given zone at a given state version.
+
+    Systemd statuses aren't kept in Redis, so they're a part of the tag if they're selected.
+    """
+    parts = [zone_id] + list(fields)
+    if "systemd_services" in fields:
+        parts.extend(systemd_statuses.get_status(service_name) for service_name in SYSTEMD_SERVICES)
+    return "{}-{:08x}".format(version, zlib.crc32(",".join(map(str, parts)).encode()))
+
+
+def get_stats(zone, state, fields=settings.STATS_FIELDS):
+    """Returns overal stats of a given zone's state, only the given sections of it if they're selected"""
+    pwm_enabled = state.pwm_enabled
+    current_pwm_duty = state.current_pwm_duty
+    stats = {}
+
+    if "sensors" in fields:
+        sensors = {}
+        for name, t, quality in state.sensors:
+            sensors["{}_temperature".format(name)] = t
+            sensors["{}_quality".format(name)] = quality
+        sensors["avg_temperature"] = get_state_average_temperature(state)
+        stats["sensors"] = sensors
+
+    if "controls" in fields:
+        stats["controls"] = {
+            "current_control_mode": state.current_ctrl_mode,
+            "current_temperature_threshold": state.current_temperature_threshold,
+            "pwm_enabled": pwm_enabled,
+            "lights_enabled": state.lights_enabled,
+            "pwm_duty_cycle": current_pwm_duty,
+        }
+
+    if "fans" in fields:
+        # Measured RPM of fans having a tach, estimated one otherwise
+        fans = {}
+        measured = {name: (rpm, stalled) for name, rpm, stalled in state.fans}
+        for fan in zone.fans:
+            rpm, stalled = measured[fan.name]
+            if fan.tach_pin is None or rpm is None:
+                rpm = estimate_zone_rpm(zone, pwm_enabled, current_pwm_duty)[fan.name]
+            fans["rpm_{}".format(fan.name)] = rpm
+            if fan.tach_pin is not None:
+                fans["{}_stalled".format(fan.name)] = stalled
+        stats["fans"] = fans
+
+    if "systemd_services" in fields:
+        stats["systemd_services"] = {
+            service_name: systemd_statuses.get_status(service_name) for service_name in SYSTEMD_SERVICES
+        }
+
+    return stats
+
+
+def get_index_data(state):
+    """Returns values of the index page along with stats paths the dashboard keeps them up to date by"""
+    data = {
+        settings.CURR_CTRL_MODE: state.current_ctrl_mode,
+        settings.CURR_TEMP_THRESHOLD: state.current_temperature_threshold,
+        settings.LIGHTS_ENABLED: state.lights_enabled,
+        settings.PWM_ENABLED: state.pwm_enabled,
+        settings.CURR_PWM_DUTY: "{}%".format(state.current_pwm_duty),
+    }
+
+    paths = {
+        settings.CURR_CTRL_MODE: "controls.current_control_mode",
+        settings.CURR_TEMP_THRESHOLD: "controls.current_temperature_threshold",
+        settings.LIGHTS_ENABLED: "controls.lights_enabled",
+        settings.PWM_ENABLED: "controls.pwm_enabled",
+        settings.CURR_PWM_DUTY: "controls.pwm_duty_cycle",
+        settings.AVG_TEMP: "sensors.avg_temperature",
+    }
+
+    for name, t, quality in state.sensors:
+        temp_k = settings.SENSOR_TEMP_KEY.format(name)
+        quality_k = settings.SENSOR_QUALITY_KEY.format(name)
+        data[temp_k] = t
+        data[quality_k] = quality
+        paths[temp_k] = "sensors.{}_temperature".format(name)
+        paths[quality_k] = "sensors.{}_quality".format(name)
+
+    data[settings.AVG_TEMP] = get_state_average_temperature(state)
+    for service_name in SYSTEMD_SERVICES:
+        data[service_name] = systemd_statuses.get_status(service_name)
+        paths[service_name] = "systemd_services.{}".format(service_name)
+
+    return data, paths
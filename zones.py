@@ -0,0 +1,86 @@
+from collections import namedtuple
+
+import settings
+
+# Zone settings, see settings.ZONES
+Zone = namedtuple("Zone", ["id", "sensors", "fans_pins", "fans", "lights_pin", "threshold", "mode"])
+
+# Fan of a zone, tach pin is None if the fan's speed isn't measured
+Fan = namedtuple("Fan", ["name", "max_rpm", "tach_pin"])
+
+_zones = None
+
+
+def get_zones():
+    """Returns all the configured zones"""
+    global _zones
+    if _zones is None:
+        _zones = [
+            Zone(
+                id=z["id"],
+                sensors=tuple(z.get("sensors", ())),
+                fans_pins=tuple(z.get("fans_pins", ())),
+                fans=tuple(Fan(*(tuple(f) + (None,))[:3]) for f in z.get("fans", ())),
+                lights_pin=z.get("lights_pin"),
+                threshold=z.get("threshold", settings.DEFAULT_TEMPERATURE_THRESHOLD),
+                mode=z.get("mode", settings.AUTO_MODE),
+            )
+            for z in settings.ZONES
+        ]
+    return _zones
+
+
+def get_zone(zone_id):
+    """Returns zone of a given id, None if there's no such zone"""
+    for zone in get_zones():
+        if zone.id == zone_id:
+            return zone
+
+
+def zone_key(zone_id, k):
+    """Returns Redis key namespaced by a given zone, keys of the default zone are kept as they are"""
+    if zone_id == settings.DEFAULT_ZONE:
+        return k
+    return settings.ZONE_KEY.format(zone=zone_id, key=k)
+
+
+def get_zone_defaults(zone):
+    """Returns default values of zone's controls keys"""
+    return {
+        zone_key(zone.id, settings.PWM_ENABLED): False,
+        zone_key(zone.id, settings.NEW_PWM_ENABLED): False,
+        zone_key(zone.id, settings.LIGHTS_ENABLED): False,
+        zone_key(zone.id, settings.NEW_LIGHTS_ENABLED): False,
+        zone_key(zone.id, settings.CURR_CTRL_MODE): zone.mode,
+        zone_key(zone.id, settings.NEW_CTRL_MODE): zone.mode,
+        zone_key(zone.id, settings.CURR_PWM_DUTY): 0,
+        zone_key(zone.id, settings.NEW_PWM_DUTY): 0,
+        zone_key(zone.id, settings.CURR_TEMP_THRESHOLD): zone.threshold,
+        zone_key(zone.id, settings.NEW_TEMP_THRESHOLD): zone.threshold,
+    }
+
+
+def get_sensor_keys(zone):
+    """Returns (name, temperature key, quality key, read time key, pin) of each zone's sensor"""
+    return [
+        (
+            name,
+            zone_key(zone.id, settings.SENSOR_TEMP_KEY.format(name)),
+            zone_key(zone.id, settings.SENSOR_QUALITY_KEY.format(name)),
+            zone_key(zone.id, settings.SENSOR_READ_AT_KEY.format(name)),
+            pin,
+        )
+        for name, pin in zone.sensors
+    ]
+
+
+def get_fan_keys(zone):
+    """Returns (fan, measured RPM key, stall alarm key) of each zone's fan"""
+    return [
+        (
+            fan,
+            zone_key(zone.id, settings.FAN_RPM_KEY.format(fan.name)),
+            zone_key(zone.id, settings.FAN_STALLED_KEY.format(fan.name)),
+        )
+        for fan in zone.fans
+    ]